@@ -0,0 +1,931 @@
+import collections
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from server import Client, HistorySpill, LineFramer, Link, OutputFlusher, SendQueue, Server, TimingWheel, TlsSession, parseMessage, raiseFileLimit, receiveHandoff, sendHandoff
+
+# Micro-benchmarks for the server's command handling. They drive Server.handleLine directly with sockets that
+# discard their output, so only the server's own work is measured. Run all of them with: python benchmark.py
+# or a single one with: python benchmark.py privmsg
+
+
+# Socket stand-in that goes through the normal send queue but throws the output away, counting delivered lines
+class NullSocket(SendQueue):
+
+    __slots__ = ()
+
+    delivered = 0
+
+    def drain(self):
+        NullSocket.delivered += len(self.queue)
+        self.queue.clear()
+        self.queuedBytes = 0
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+# Records the longest line written, to check replies stay within the 512 byte limit
+class LongestLineSocket(NullSocket):
+
+    __slots__ = ('longest',)
+
+    def __init__(self, server):
+        NullSocket.__init__(self, server)
+        self.longest = 0
+
+    def drain(self):
+        for data in self.queue:
+            self.longest = max([self.longest] + [len(line) + 2 for line in bytes(data).split(b'\r\n') if line])
+
+        NullSocket.drain(self)
+
+
+# Registers a client through the normal NICK/USER path
+def connectClient(server, nickname):
+
+    client = Client('', '', '', NullSocket(server), ('127.0.0.1', 0))
+    server.handleLine(client, b'NICK ' + nickname.encode())
+    server.handleLine(client, b'USER ' + nickname.encode() + b' 0 * :' + nickname.encode())
+    return client
+
+
+# Runs line through handleLine count times and returns the cost of one call in microseconds
+def timeLine(server, client, line, count):
+
+    start = time.perf_counter()
+
+    for i in range(count):
+        server.handleLine(client, line)
+
+    return (time.perf_counter() - start) / count * 1e6
+
+
+# PRIVMSG cost to a nick and to a small channel as the number of users on the server grows
+def benchPrivmsg():
+
+    print('users      channel PRIVMSG (us)   nick PRIVMSG (us)')
+
+    for users in (100, 1000, 10000, 100000):
+
+        server = Server('Bench')
+
+        clients = [connectClient(server, 'u' + str(i)) for i in range(users)]
+
+        # Fill the channel list too, lookups used to scan every channel
+        for i in range(0, users, 10):
+            server.handleLine(clients[i], b'JOIN #c' + str(i).encode())
+
+        server.handleLine(clients[0], b'JOIN #bench')
+        server.handleLine(clients[-1], b'JOIN #bench')
+
+        channelCost = timeLine(server, clients[0], b'PRIVMSG #bench :hello', 20000)
+        nickCost = timeLine(server, clients[0], b'PRIVMSG u' + str(users - 1).encode() + b' :hello', 20000)
+
+        print(str(users).ljust(11) + ('%.2f' % channelCost).ljust(23) + '%.2f' % nickCost)
+
+
+# CPU cost per delivered message for channel PRIVMSG, JOIN and PART as the channel grows
+def benchFanout():
+
+    print('members    PRIVMSG (ns/delivery)   JOIN+PART (ns/delivery)')
+
+    for members in (10, 100, 1000, 5000):
+
+        server = Server('Bench')
+
+        clients = [connectClient(server, 'u' + str(i)) for i in range(members)]
+
+        for client in clients:
+            server.handleLine(client, b'JOIN #bench')
+
+        count = max(20, 200000 // members)
+
+        NullSocket.delivered = 0
+        start = time.perf_counter()
+
+        for i in range(count):
+            server.handleLine(clients[0], b'PRIVMSG #bench :hello everyone in the channel')
+
+        privmsgCost = (time.perf_counter() - start) / NullSocket.delivered * 1e9
+
+        NullSocket.delivered = 0
+        start = time.perf_counter()
+
+        for i in range(count):
+            server.handleLine(clients[0], b'PART #bench :brb')
+            server.handleLine(clients[0], b'JOIN #bench')
+
+        joinPartCost = (time.perf_counter() - start) / NullSocket.delivered * 1e9
+
+        print(str(members).ljust(11) + ('%.0f' % privmsgCost).ljust(24) + '%.0f' % joinPartCost)
+
+
+# One PRIVMSG to N channels against N single channel PRIVMSGs, with every member in all of the channels so the
+# multi-target command also saves the duplicate deliveries
+def benchMultitarget():
+
+    print('targets    N commands (us)   1 command (us)   deliveries (N)   deliveries (1)')
+
+    for targets in (2, 5, 10): # Clients can't join more than 10 channels
+
+        server = Server('Bench')
+
+        server.FLOOD_RATE = server.FLOOD_BURST = 1e9
+        clients = [connectClient(server, 'u' + str(i)) for i in range(50)]
+        names = [b'#c' + str(i).encode() for i in range(targets)]
+
+        for client in clients:
+            for name in names:
+                server.handleLine(client, b'JOIN ' + name)
+
+        singles = [b'PRIVMSG ' + name + b' :hello from a bot' for name in names]
+        multi = b'PRIVMSG ' + b','.join(names) + b' :hello from a bot'
+        count = 2000
+
+        NullSocket.delivered = 0
+        start = time.perf_counter()
+
+        for i in range(count):
+            for line in singles:
+                server.handleLine(clients[0], line)
+
+        singleCost = (time.perf_counter() - start) / count * 1e6
+        singleDeliveries = NullSocket.delivered // count
+
+        NullSocket.delivered = 0
+        multiCost = timeLine(server, clients[0], multi, count)
+        multiDeliveries = NullSocket.delivered // count
+
+        print(str(targets).ljust(11) + ('%.1f' % singleCost).ljust(18) + ('%.1f' % multiCost).ljust(17) + str(singleDeliveries).ljust(17) + str(multiDeliveries))
+
+
+# Clients rejoining 10 channels after a restart, with a JOIN per channel or one JOIN for all of them: time and writes
+def benchRejoin():
+
+    names = [b'#c' + str(i).encode() for i in range(10)]
+    print('clients    per channel (ms)   writes     one JOIN (ms)   writes')
+
+    for count in (100, 500, 1000):
+
+        results = []
+
+        for lines in ([b'JOIN ' + name for name in names], [b'JOIN ' + b','.join(names)]):
+
+            server = Server('Bench')
+
+            server.FLOOD_RATE = server.FLOOD_BURST = 1e9
+            clients = [connectClient(server, 'u' + str(i)) for i in range(count)]
+
+            NullSocket.delivered = 0
+            start = time.perf_counter()
+
+            for client in clients:
+                for line in lines:
+                    server.handleLine(client, line)
+
+            results.append(((time.perf_counter() - start) * 1e3, NullSocket.delivered))
+
+        print(str(count).ljust(11) + ('%.0f' % results[0][0]).ljust(19) + str(results[0][1]).ljust(11) + ('%.0f' % results[1][0]).ljust(16) + str(results[1][1]))
+
+
+# NAMES and WHO for one big channel: time, peak memory while replying, and the longest line sent
+def benchNames():
+
+    print('members    NAMES (ms)   peak (KiB)   WHO (ms)   peak (KiB)   longest line')
+
+    for members in (1000, 5000, 20000):
+
+        server = Server('Bench')
+
+        server.FLOOD_RATE = server.FLOOD_BURST = 1e9
+        clients = [connectClient(server, 'u' + str(i)) for i in range(members)]
+
+        for client in clients:
+            server.joinChannel(client, '#bench') # Without the JOIN replies, each of which would list the channel
+
+        server.channels.find('#bench').getClientList() # Build the shared member snapshot first, it isn't part of the reply
+        sock = LongestLineSocket(server)
+        client = clients[0]
+        client.socket = sock
+        results = []
+
+        for line in (b'NAMES #bench', b'WHO #bench'):
+            tracemalloc.start()
+            start = time.perf_counter()
+            server.handleLine(client, line)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append((elapsed * 1e3, peak / 1024))
+
+        print(str(members).ljust(11) + ('%.1f' % results[0][0]).ljust(13) + ('%.0f' % results[0][1]).ljust(13) + ('%.1f' % results[1][0]).ljust(11) + ('%.0f' % results[1][1]).ljust(13) + str(sock.longest))
+
+
+# Takes 64 KiB between two writeReady() calls like a socket whose kernel buffer fills up, the rest waits in the queue
+class ChokedSocket(NullSocket):
+
+    __slots__ = ('lines', 'room')
+
+    def __init__(self, server):
+        NullSocket.__init__(self, server)
+        self.lines = 0
+        self.room = 65536
+
+    def drain(self):
+
+        while self.queue and len(self.queue[0]) <= self.room:
+            data = self.queue.pop(0)
+            self.room -= len(data)
+            self.queuedBytes -= len(data)
+            self.lines += data.count(b'\n')
+
+    def writeReady(self):
+
+        with self.lock:
+            self.room = 65536
+            self.flush()
+
+        return bool(self.queue or self.streams)
+
+
+# LIST, WHOIS and ISON on a server with 100k channels: the cost of keeping the name and member count indexes up to date
+# while channels come and go, and of each query. LIST is streamed to a socket taking 64 KiB per write, the longest step is
+# how long it holds up the other clients.
+def benchQueries():
+
+    server = Server('Bench')
+
+    server.FLOOD_RATE = server.FLOOD_BURST = 1e9
+    clients = [connectClient(server, 'u' + str(i)) for i in range(20000)]
+
+    start = time.perf_counter()
+
+    for i in range(100000): # A few big channels, most with a member or two
+        for client in clients[:1 + 1000 // (1 + i) + i % 2]:
+            server.joinChannel(client, '#c' + str(i))
+
+    created = time.perf_counter() - start
+    start = time.perf_counter()
+
+    for i in range(1000): # Churn among the small channels
+        server.partChannel(clients[0], server.channels.find('#c' + str(50000 + i)))
+        server.joinChannel(clients[0], '#c' + str(50000 + i))
+
+    churn = time.perf_counter() - start
+
+    print('100000 channels created in %.0f ms, %.1f us per channel, part and rejoin of a small channel %.1f us' % (created * 1e3, created / 100000 * 1e6, churn / 2000 * 1e6))
+    print('query                lines      total (ms)   longest step (ms)   peak (KiB)')
+
+    client = clients[0]
+
+    for line in (b'LIST', b'LIST >50', b'LIST <2', b'LIST #c123*', b'LIST #c1?', b'WHOIS u1234', b'WHOIS u19*'):
+
+        results = []
+
+        for traced in (False, True): # Peak memory from a second run, tracing slows it down
+
+            sock = ChokedSocket(server)
+            client.socket = sock
+            steps = []
+
+            if traced:
+                tracemalloc.start()
+
+            start = time.perf_counter()
+            server.handleLine(client, line)
+            steps.append(time.perf_counter() - start)
+
+            while True:
+                step = time.perf_counter()
+                more = sock.writeReady()
+                steps.append(time.perf_counter() - step)
+
+                if not more:
+                    break
+
+            results.append((time.perf_counter() - start, max(steps)))
+
+        (elapsed, longest) = results[0]
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(line.decode().ljust(21) + str(sock.lines).ljust(11) + ('%.1f' % (elapsed * 1e3)).ljust(13) + ('%.2f' % (longest * 1e3)).ljust(20) + '%.0f' % (peak / 1024))
+
+    client.socket = NullSocket(server)
+    nicks = ' '.join('u' + str(i * 397) if i % 2 else 'gone' + str(i) for i in range(50)).encode()
+    ison = timeLine(server, client, b'ISON ' + nicks, 2000)
+    polls = [b'PRIVMSG ' + nick + b' :ping' for nick in nicks.split()]
+    start = time.perf_counter()
+
+    for i in range(200):
+        for poll in polls:
+            server.handleLine(client, poll)
+
+    polled = (time.perf_counter() - start) / 200 * 1e6
+    print('presence of 50 nicks: ISON %.0f us, a PRIVMSG to each %.0f us' % (ison, polled))
+
+
+# Channel history: memory per stored message, CHATHISTORY replay rate, and appending to and reading back the spill files
+def benchHistory():
+
+    server = Server('Bench')
+    channelCount = 1000
+
+    server.FLOOD_RATE = server.FLOOD_BURST = 1e9
+    client = connectClient(server, 'u0')
+    names = [b'#c' + str(i).encode() for i in range(channelCount)]
+
+    for name in names:
+        server.joinChannel(client, name.decode())
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    for i in range(server.HISTORY_LINES):
+        for name in names:
+            server.handleLine(client, b'PRIVMSG ' + name + b' :message number ' + str(i).encode() + b' sent to the channel')
+
+    stored = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    count = 1000
+    start = time.perf_counter()
+
+    for i in range(count):
+        server.handleLine(client, b'CHATHISTORY LATEST #c0 * 100')
+
+    replayed = count * server.HISTORY_LINES / (time.perf_counter() - start)
+
+    print('bytes per stored message (ring of %d lines): %.0f' % (server.HISTORY_LINES, stored / (server.HISTORY_LINES * channelCount)))
+    print('CHATHISTORY replay: %.0f lines/s' % replayed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        spill = HistorySpill(directory, '#bench', 16 * 1048576, 4)
+        data = b':u0!u0@127.0.0.1 PRIVMSG #bench :message sent to the channel\r\n'
+        count = 100000
+        start = time.perf_counter()
+
+        for i in range(count):
+            spill.append(data, i)
+
+        appended = count / (time.perf_counter() - start)
+        start = time.perf_counter()
+        lines = spill.getLines(count)
+        read = len(lines) / (time.perf_counter() - start)
+        spill.close()
+
+    print('spill append: %.0f lines/s, read back: %.0f lines/s' % (appended, read))
+
+
+# NullSocket with a real (unconnected) socket behind it, for the hot restart to hand over
+class HandoverSocket(NullSocket):
+
+    __slots__ = ('sock',)
+
+    def __init__(self, server):
+        NullSocket.__init__(self, server)
+        self.sock = socket.socket()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+
+# Time taken by each step of a hot restart: taking the state, sending it with the sockets and restoring it in a new Server
+def benchRestart():
+
+    raiseFileLimit()
+
+    try:
+        import resource
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except ImportError:
+        limit = 2048
+
+    count = min(10000, (limit - 200) // 2) # Each socket is open twice once it's received
+    server = Server('Bench')
+    clients = []
+
+    server.FLOOD_RATE = server.FLOOD_BURST = 1e9
+
+    for i in range(count):
+        client = Client('', '', '', HandoverSocket(server), ('127.0.0.1', 0))
+        server.connections[client] = (LineFramer(), collections.deque())
+        server.handleLine(client, b'NICK u' + str(i).encode())
+        server.handleLine(client, b'USER u 0 * :u')
+        server.handleLine(client, b'JOIN #c' + str(i % 100).encode())
+        clients.append(client)
+
+    for i in range(100):
+        server.handleLine(clients[i], b'PRIVMSG #c' + str(i).encode() + b' :a line of history')
+
+    start = time.perf_counter()
+    (state, fds) = server.getRestartState()
+    taken = time.perf_counter() - start
+
+    (old, new) = socket.socketpair()
+    received = []
+    start = time.perf_counter()
+    receiver = threading.Thread(target=lambda: received.append(receiveHandoff(new)))
+    receiver.start()
+    sendHandoff(old, state, fds)
+    receiver.join()
+    handed = time.perf_counter() - start
+    old.close()
+    new.close()
+
+    successor = Server('Bench')
+    start = time.perf_counter()
+    restored = successor.restoreState(*received[0])
+    rebuilt = time.perf_counter() - start
+
+    print('%d clients in 100 channels' % count)
+    print('state taken in %.1f ms, handed over in %.1f ms, restored in %.1f ms' % (taken * 1e3, handed * 1e3, rebuilt * 1e3))
+
+    for (client, sock, output) in restored:
+        sock.close()
+
+    for client in clients:
+        client.getClientSocket()[0].close()
+
+
+# Ports nothing is listening on
+def getFreePorts(count):
+
+    sockets = [socket.create_server(('127.0.0.1', 0)) for i in range(count)]
+    ports = [s.getsockname()[1] for s in sockets]
+
+    for s in sockets:
+        s.close()
+
+    return ports
+
+
+# One handshake between a client SSL object and a TlsSession, in memory. Returns (seconds the server side took, the client's session).
+def handshakeInMemory(serverContext, clientContext, session):
+
+    incoming = ssl.MemoryBIO()
+    outgoing = ssl.MemoryBIO()
+    client = clientContext.wrap_bio(incoming, outgoing, server_hostname='localhost', session=session)
+    server = TlsSession(serverContext)
+    spent = 0.0
+    done = False
+
+    while not done:
+        try:
+            client.do_handshake()
+        except ssl.SSLWantReadError:
+            pass
+
+        start = time.perf_counter()
+        (output, done) = server.handshake(outgoing.read())
+        spent += time.perf_counter() - start
+        incoming.write(output)
+
+    try:
+        client.read() # Takes the session tickets
+    except ssl.SSLWantReadError:
+        pass
+
+    return (spent, client.session)
+
+
+# Connects count clients over TLS from a few threads, each sends a PING and waits for the answer. Returns (connections per
+# second, how many resumed session).
+def connectTls(port, context, session, count, threads=8):
+
+    resumed = []
+
+    def connect():
+        for i in range(count // threads):
+            with context.wrap_socket(socket.create_connection(('127.0.0.1', port)), server_hostname='localhost', session=session) as conn:
+                conn.sendall(b'PING :bench\r\n')
+                conn.recv(512)
+                resumed.append(conn.session_reused)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=connect) for i in range(threads)]
+
+    for t in workers:
+        t.start()
+
+    for t in workers:
+        t.join()
+
+    return (len(resumed) / (time.perf_counter() - start), sum(resumed))
+
+
+# TLS connect rates with full and with resumed handshakes, and the PING round trip of a connected client meanwhile, which
+# shows whether the handshakes hold other clients up. Needs the openssl command for a self-signed certificate.
+def benchTls():
+
+    count = 800
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        cert = os.path.join(directory, 'cert.pem')
+        key = os.path.join(directory, 'key.pem')
+
+        try:
+            subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert, '-days', '1',
+                            '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost'], check=True, capture_output=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('no certificate, openssl failed: %s' % e)
+            return
+
+        context = ssl.create_default_context(cafile=cert)
+        server = Server('Bench')
+        server.configure({'TLS_CERT': cert, 'TLS_KEY': key})
+        serverContext = server.createTlsContext()
+        (spent, session) = handshakeInMemory(serverContext, context, None)
+        full = sum(handshakeInMemory(serverContext, context, None)[0] for i in range(count)) / count
+        resumed = sum(handshakeInMemory(serverContext, context, session)[0] for i in range(count)) / count
+        print('server side of a handshake: full %.0f us, resumed %.0f us' % (full * 1e6, resumed * 1e6))
+
+        for mode in ('threaded', 'asyncio'):
+
+            # In its own process, the client threads here would hold it up otherwise
+            (plainPort, tlsPort) = getFreePorts(2)
+            server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'), mode,
+                                       '--listen', '127.0.0.1:%d' % plainPort, '--set', 'TLS_LISTENERS=["127.0.0.1:%d"]' % tlsPort,
+                                       '--set', 'TLS_CERT=' + cert, '--set', 'TLS_KEY=' + key, '--set', 'LOG_LEVEL=WARNING'])
+
+            for i in range(100):
+                try:
+                    conn = context.wrap_socket(socket.create_connection(('127.0.0.1', tlsPort)), server_hostname='localhost')
+                    break
+                except OSError: # Not listening yet
+                    time.sleep(0.05)
+
+            with conn:
+                conn.sendall(b'PING :bench\r\n')
+                conn.recv(512) # The session tickets come with the first answer
+                session = conn.session
+
+            # A connected client pinging the server the whole time
+            done = threading.Event()
+            roundTrips = []
+
+            def ping():
+                with socket.create_connection(('127.0.0.1', plainPort)) as conn:
+                    while not done.is_set():
+                        start = time.perf_counter()
+                        conn.sendall(b'PING :bench\r\n')
+                        conn.recv(512)
+                        roundTrips.append(time.perf_counter() - start)
+                        time.sleep(0.001)
+
+            pinger = threading.Thread(target=ping)
+            pinger.start()
+            (full, ignored) = connectTls(tlsPort, context, None, count)
+            done.set()
+            pinger.join()
+            (resumed, reused) = connectTls(tlsPort, context, session, count)
+            server.terminate()
+            server.wait()
+
+            roundTrips.sort()
+            print('%-8s full handshakes %.0f connections/s, resumed %.0f connections/s (%d of %d resumed)' % (mode, full, resumed, reused, count))
+            print('%-8s PING round trip during full handshakes: p50 %.2f ms, p99 %.2f ms' % ('', roundTrips[len(roundTrips) // 2] * 1e3, roundTrips[len(roundTrips) * 99 // 100] * 1e3))
+
+
+# Lines per second through the parser and through the whole dispatch path
+def benchParser():
+
+    lines = [
+        b'PRIVMSG #bench :hello everyone in the channel',
+        b'PRIVMSG u1 :a direct message',
+        b':u0!u0@127.0.0.1 PRIVMSG #bench :with a prefix',
+        b'JOIN #bench',
+        b'PART #bench :brb',
+        b'NICK u0',
+        b'WHO #bench',
+        b'MODE #bench',
+    ]
+    count = 100000
+
+    start = time.perf_counter()
+
+    for i in range(count // len(lines)):
+        for line in lines:
+            parseMessage(line)
+
+    elapsed = time.perf_counter() - start
+    print('parseMessage: %.0f lines/s' % (count // len(lines) * len(lines) / elapsed))
+
+    server = Server('Bench')
+
+    sender = connectClient(server, 'u0')
+    connectClient(server, 'u1')
+    server.handleLine(sender, b'JOIN #bench')
+
+    start = time.perf_counter()
+
+    for i in range(count // len(lines)):
+        for line in lines:
+            server.handleLine(sender, line)
+
+    elapsed = time.perf_counter() - start
+
+    print('handleLine:   %.0f lines/s' % (count // len(lines) * len(lines) / elapsed))
+
+
+# Memory per connected client and per channel membership, 100k clients spread over 10k channels
+def benchMemory():
+
+    clientCount = 100000
+    channelCount = 10000
+    joinsPerClient = 3
+
+    server = Server('Bench')
+
+    tracemalloc.start()
+
+    before = tracemalloc.get_traced_memory()[0]
+    clients = []
+
+    for i in range(clientCount):
+        client = Client('', '', '', NullSocket(server), ('10.0.' + str(i % 256) + '.1', 40000 + i % 20000))
+        server.handleLine(client, b'NICK u' + str(i).encode())
+        server.handleLine(client, b'USER u' + str(i).encode() + b' 0 * :Real Name')
+        clients.append(client)
+
+    afterClients = tracemalloc.get_traced_memory()[0]
+
+    for (i, client) in enumerate(clients):
+        for j in range(joinsPerClient):
+            server.handleLine(client, b'JOIN #c' + str((i + j * 3331) % channelCount).encode())
+
+    afterJoins = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    memberships = clientCount * joinsPerClient
+    print('clients: %d, channels: %d, memberships: %d' % (len(server.clients), len(server.channels), memberships))
+    print('bytes per client (with socket wrapper): %.0f' % ((afterClients - before) / clientCount))
+    print('bytes per channel membership (including the channels): %.0f' % ((afterJoins - afterClients) / memberships))
+
+
+# Timing wheel cost with 100k connections: scheduling, and one tick with its expired timers set again
+def benchTimers():
+
+    wheel = TimingWheel(512)
+    clients = [Client('', '', '', None, ('127.0.0.1', 0)) for i in range(100000)]
+
+    start = time.perf_counter()
+
+    for (i, client) in enumerate(clients):
+        wheel.schedule(client, 1 + i % 90, 1.0) # Spread like idle clients over PING_INTERVAL
+
+    print('schedule: %.2f us per client' % ((time.perf_counter() - start) / len(clients) * 1e6))
+
+    ticks = 512
+    expired = 0
+    start = time.perf_counter()
+
+    for i in range(ticks):
+        for client in wheel.advance():
+            expired += 1
+            wheel.schedule(client, 90, 1.0)
+
+    elapsed = time.perf_counter() - start
+    print('tick: %.0f us average, %d timers expired per tick, %d scheduled' % (elapsed / ticks * 1e6, expired / ticks, len(wheel)))
+
+
+# Counts the messages from the stress test's sender threads a client receives
+class CountingSocket(NullSocket):
+
+    __slots__ = ('messages',)
+
+    def __init__(self, server):
+        NullSocket.__init__(self, server)
+        self.messages = 0
+
+    def drain(self):
+        self.messages += sum(1 for data in self.queue if b' PRIVMSG #stress :message ' in data)
+        NullSocket.drain(self)
+
+
+# Keeps the JOIN and PART lines sent to a client, to check each one changes what the client knows about the channel
+class MembershipSocket(NullSocket):
+
+    __slots__ = ('members', 'duplicates', 'phantoms')
+
+    def __init__(self, server):
+        NullSocket.__init__(self, server)
+        self.members = collections.defaultdict(set) # Channel name -> nicks
+        self.duplicates = 0 # JOINs for a nick already in the channel
+        self.phantoms = 0 # PARTs for a nick that isn't
+
+    def drain(self):
+
+        for line in b''.join(self.queue).split(b'\r\n'):
+            fields = line.decode().split(' ')
+
+            if len(fields) < 3 or fields[1] not in ('JOIN', 'PART'):
+                continue
+
+            (nickname, members) = (fields[0][1:].partition('!')[0], self.members[fields[2]])
+
+            if fields[1] == 'JOIN':
+                self.duplicates += nickname in members
+                members.add(nickname)
+            else:
+                self.phantoms += nickname not in members
+                members.discard(nickname)
+
+        NullSocket.drain(self)
+
+
+# Links two servers over a socket pair while the clients of the first one JOIN and PART, so the live events overlap the burst.
+# The second server's observer, a member of every channel, must see each JOIN and PART once, and end up with the same members
+# as the first server.
+def benchBurst():
+
+    (clientCount, channelCount, changes) = (20000, 500, 5000)
+
+    (local, remote) = (Server('A'), Server('B'))
+    local.FLOOD_RATE = local.FLOOD_BURST = 1e9
+    names = ['#c' + str(i) for i in range(channelCount)]
+    clients = [connectClient(local, 'u' + str(i)) for i in range(clientCount)]
+
+    for (i, client) in enumerate(clients):
+        for j in range(3):
+            local.handleLine(client, b'JOIN ' + names[(i + j * 7) % channelCount].encode())
+
+    observer = Client('observer', 'o', 'Observer', None, ('127.0.0.1', 0))
+    observer.socket = MembershipSocket(remote)
+    observer.registered = True
+    remote.clients.add('observer', observer)
+
+    for name in names:
+        remote.joinChannel(observer, name)
+
+    (linkSocket, peerSocket) = socket.socketpair()
+    linkSocket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16384) # The burst takes many writes, with changes in between
+    linkSocket.setblocking(False)
+    local.startLinks = lambda: None
+    local.flusher = OutputFlusher(local)
+    local.flusher.start()
+
+    link = Link(local, linkSocket, 'pair')
+    local.linkHandshake(link, b'SERVER\tB\tsecret')
+    peer = Link(remote, socket.socketpair()[0], 'pair') # Only read from
+    peer.peerName = 'A'
+
+    peerSocket.settimeout(0.1)
+    buffer = b''
+    start = time.perf_counter()
+
+    for i in range(changes + 1000): # Changes while the burst is read, then only reads until nothing comes any more
+
+        if i < changes:
+            client = clients[(i * 7919) % clientCount]
+            name = names[(i * 31) % channelCount]
+            local.handleLine(client, (b'PART ' if local.channels.find(name).hasClient(client) else b'JOIN ') + name.encode())
+
+        try:
+            data = peerSocket.recv(8192)
+        except socket.timeout:
+            if i >= changes:
+                break
+
+            continue
+
+        lines = (buffer + data).split(b'\n')
+        buffer = lines.pop()
+        remote.handleLinkLines(peer, lines)
+
+    elapsed = time.perf_counter() - start
+    local.flusher.stop()
+    linkSocket.close()
+    peerSocket.close()
+
+    expected = {name: {c.getNickname() for c in local.channels.find(name).getClientList()} for name in names}
+    seen = {name: observer.socket.members[name] - {'observer'} for name in names}
+    differing = sum(1 for name in names if seen[name] != expected[name])
+
+    print('burst of %d clients with %d JOINs and PARTs during it: %.0f ms' % (clientCount, changes, elapsed * 1e3))
+    print('duplicate JOINs %d, PARTs for non-members %d, channels whose members differ %d of %d' % (observer.socket.duplicates, observer.socket.phantoms, differing, channelCount))
+
+
+# Threads sending to a channel while other threads JOIN, PART and QUIT it. Every member that stays should get every message.
+def benchStress():
+
+    members = 50
+    senders = 4
+    messages = 2000
+    churners = 8
+
+    server = Server('Bench')
+    errors = []
+    sending = threading.Event()
+
+    def connect(nickname):
+        client = Client('', '', '', CountingSocket(server), ('127.0.0.1', 0))
+        server.handleLine(client, b'NICK ' + nickname.encode())
+        server.handleLine(client, b'USER ' + nickname.encode() + b' 0 * :' + nickname.encode())
+        return client
+
+    def run(work):
+        try:
+            work()
+        except Exception as e:
+            errors.append(repr(e))
+
+    def send(client):
+        for i in range(messages):
+            server.handleLine(client, b'PRIVMSG #stress :message ' + str(i).encode())
+
+    def churn(number):
+        i = 0
+
+        while sending.is_set():
+            client = connect('c' + str(number) + 'x' + str(i % 100))
+            server.handleLine(client, b'JOIN #stress')
+            server.handleLine(client, b'PRIVMSG #stress :from a churning client')
+            server.handleLine(client, b'PART #stress :churn' if i % 2 else b'JOIN 0')
+            server.handleLine(client, b'JOIN #stress')
+            server.clientDisconnected('QUIT :churn', client)
+            i += 1
+
+    server.FLOOD_RATE = server.FLOOD_BURST = 1e9
+    stable = [connect('m' + str(i)) for i in range(members)]
+    sending_clients = [connect('s' + str(i)) for i in range(senders)]
+
+    for client in stable + sending_clients:
+        server.handleLine(client, b'JOIN #stress')
+
+    for client in stable:
+        client.getClientSocket()[0].messages = 0 # Only count what is sent from here on
+
+    switchInterval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6) # Switch threads as often as possible to provoke races
+
+    try:
+        sending.set()
+        churnThreads = [threading.Thread(target=run, args=(lambda n=n: churn(n),)) for n in range(churners)]
+        sendThreads = [threading.Thread(target=run, args=(lambda c=c: send(c),)) for c in sending_clients]
+
+        start = time.perf_counter()
+
+        for t in churnThreads + sendThreads:
+            t.start()
+
+        for t in sendThreads:
+            t.join()
+
+        elapsed = time.perf_counter() - start
+        sending.clear()
+
+        for t in churnThreads:
+            t.join()
+    finally:
+        sys.setswitchinterval(switchInterval)
+
+    expected = senders * messages
+    counts = [client.getClientSocket()[0].messages for client in stable]
+    lost = sum(expected - count for count in counts if count < expected)
+    duplicated = sum(count - expected for count in counts if count > expected)
+
+    print('%d sender threads, %d churn threads, %d members: %.0f messages/s' % (senders, churners, members, expected / elapsed))
+    print('deliveries to staying members: %d expected, %d lost, %d duplicated, exceptions: %d' % (members * expected, lost, duplicated, len(errors)))
+    print('channel members left: %d, clients left: %d' % (server.channels.find('#stress').getMemberCount(), len(server.clients)))
+
+    for error in errors[:5]:
+        print('  ' + error)
+
+
+BENCHMARKS = {
+    'privmsg': benchPrivmsg,
+    'fanout': benchFanout,
+    'multitarget': benchMultitarget,
+    'names': benchNames,
+    'query': benchQueries,
+    'rejoin': benchRejoin,
+    'history': benchHistory,
+    'restart': benchRestart,
+    'tls': benchTls,
+    'parser': benchParser,
+    'memory': benchMemory,
+    'timers': benchTimers,
+    'stress': benchStress,
+    'burst': benchBurst,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or list(BENCHMARKS):
+        print('== ' + name)
+        BENCHMARKS[name]()
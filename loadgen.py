@@ -0,0 +1,565 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from server import raiseFileLimit
+
+# Load generator for the IRC server. Starts the server on localhost (or uses a running one with --no-server), connects
+# thousands of clients through NICK/USER and runs the scenarios below against them. Reports the connect rate, messages per
+# second and p50/p99/p999 end-to-end delivery latency, and writes them as JSON with --output so runs can be compared
+# between modes and commits:
+#   python loadgen.py --mode asyncio --clients 2000 --output asyncio.json
+# With --servers N it starts N linked servers in a chain and spreads the clients over them, latencies are then also given by
+# the number of links between sender and receiver. The restart scenario hands a single server over to a new process and
+# shows how long the clients waited. The servers started here serve their metrics, which give the socket writes per line
+# sent for each scenario.
+
+SCENARIOS = ('connect', 'join', 'channel', 'dm', 'nick', 'restart', 'quit')
+
+
+# Short base 36 numbers, nicknames have to stay under 10 characters
+def base36(number):
+
+    digits = ''
+
+    while True:
+        (number, digit) = divmod(number, 36)
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'[digit] + digits
+
+        if number == 0:
+            return digits
+
+
+# Percentiles in milliseconds of a list of latencies in nanoseconds
+def getPercentiles(latencies):
+
+    if not latencies:
+        return None
+
+    latencies.sort()
+    result = {}
+
+    for (name, fraction) in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+        result[name] = round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] / 1e6, 3)
+
+    return result
+
+
+# One synthetic client. Every received line goes to the scenario currently running.
+class LoadClient:
+
+    def __init__(self, runner, index):
+        self.runner = runner
+        self.index = index
+        self.nickname = 'lg' + base36(index)
+        self.writer = None
+        self.registered = asyncio.Event()
+        self.sentAt = 0 # perf_counter_ns() of the last timed command
+
+    # Server the client is on, the servers are linked in a chain so the hops between two clients is the difference
+    def getServer(self):
+        return self.index % self.runner.args.servers
+
+    async def connect(self, host, port):
+
+        (reader, self.writer) = await asyncio.open_connection(host, port + self.getServer(), limit=1 << 20) # NAMES replies get long
+        self.send('NICK ' + self.nickname, 'USER ' + self.nickname + ' 0 * :Load client')
+        asyncio.ensure_future(self.readLines(reader))
+        await self.registered.wait()
+
+    def send(self, *lines):
+        self.writer.write(''.join(line + '\r\n' for line in lines).encode())
+
+    async def readLines(self, reader):
+
+        while True:
+
+            try:
+                line = await reader.readline()
+            except (ConnectionError, ValueError):
+                return
+
+            if not line:
+                return
+
+            now = time.perf_counter_ns()
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+
+            if not self.registered.is_set():
+                if ' 001 ' in line:
+                    self.registered.set()
+            else:
+                self.runner.handler(self, line, now)
+
+    def close(self):
+        self.writer.close()
+
+
+class LoadRunner:
+
+    def __init__(self, args):
+        self.args = args
+        self.clients = [LoadClient(self, i) for i in range(args.clients)]
+        self.servers = [] # Server processes started by main()
+        self.metricsPorts = [] # Metrics endpoints of the servers and workers, see getMetricsPorts()
+        self.handler = lambda client, line, now: None
+        self.latencies = []
+        self.hopLatencies = {} # Hops -> latencies, with several servers
+        self.expected = 0
+        self.received = 0
+        self.done = None
+
+    # Counts one expected line, the scenario ends when all of them have arrived
+    def count(self, latency=None, hops=None):
+
+        self.received += 1
+
+        if latency is not None:
+            self.latencies.append(latency)
+
+            if hops is not None:
+                self.hopLatencies.setdefault(hops, []).append(latency)
+
+        if self.received >= self.expected:
+            self.done.set()
+
+    # Runs send() with the given line handler and waits for expected lines or the timeout
+    async def measure(self, handler, expected, send):
+
+        self.handler = handler
+        self.latencies = []
+        self.hopLatencies = {}
+        self.expected = expected
+        self.received = 0
+        self.done = asyncio.Event()
+
+        counters = await self.getCounters()
+        start = time.perf_counter()
+        send()
+
+        try:
+            await asyncio.wait_for(self.done.wait(), self.args.timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        elapsed = time.perf_counter() - start
+        self.handler = lambda client, line, now: None
+        await asyncio.sleep(0.1) # Lets the servers finish writing the lines nobody waits for
+        counters = dict((name, value - counters[name]) for (name, value) in (await self.getCounters()).items())
+
+        result = {
+            'seconds': round(elapsed, 3),
+            'messages': self.received,
+            'expected': expected,
+            'messagesPerSecond': round(self.received / elapsed, 1),
+            'latencyMs': getPercentiles(self.latencies),
+        }
+
+        if counters.get('ircd_sent_lines_total'):
+            result['writesPerLine'] = round(counters['ircd_socket_writes_total'] / counters['ircd_sent_lines_total'], 3)
+
+        if self.hopLatencies:
+            result['latencyByHopsMs'] = dict((str(hops), getPercentiles(latencies)) for (hops, latencies) in sorted(self.hopLatencies.items()))
+
+        return result
+
+    # Server counters summed over every server and worker, from their metrics endpoints
+    async def getCounters(self):
+
+        counters = {'ircd_socket_writes_total': 0, 'ircd_sent_lines_total': 0}
+
+        for port in self.metricsPorts:
+
+            try:
+                (reader, writer) = await asyncio.open_connection('localhost', port)
+                writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+                text = (await reader.read()).decode()
+                writer.close()
+            except OSError: # Not serving metrics, e.g. during a restart
+                continue
+
+            for line in text.splitlines():
+                (name, sep, value) = line.partition(' ')
+
+                if name in counters:
+                    counters[name] += int(value)
+
+        return counters
+
+    # Links between the servers of two clients, None with a single server
+    def getHops(self, client, sender):
+        return abs(client.getServer() - sender.getServer()) if self.args.servers > 1 else None
+
+    # Connects and registers every client, at most --concurrency at a time
+    async def runConnect(self):
+
+        pending = asyncio.Semaphore(self.args.concurrency)
+        latencies = []
+
+        async def connect(client):
+            async with pending:
+                start = time.perf_counter_ns()
+                await client.connect(self.args.host, self.args.port)
+                latencies.append(time.perf_counter_ns() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[connect(client) for client in self.clients])
+        elapsed = time.perf_counter() - start
+
+        return {
+            'seconds': round(elapsed, 3),
+            'messages': len(self.clients),
+            'expected': len(self.clients),
+            'connectsPerSecond': round(len(self.clients) / elapsed, 1),
+            'latencyMs': getPercentiles(latencies),
+        }
+
+    # Every client joins #storm at once, timed until each sees its own JOIN
+    async def runJoin(self):
+
+        def handler(client, line, now):
+            if line.startswith(':' + client.nickname + '!') and ' JOIN #storm ' in line:
+                self.count(now - client.sentAt)
+
+        def send():
+            for client in self.clients:
+                client.sentAt = time.perf_counter_ns()
+                client.send('JOIN #storm')
+
+        return await self.measure(handler, len(self.clients), send)
+
+    # --senders clients each send --messages PRIVMSGs to #storm, timed per delivery
+    async def runChannel(self):
+
+        senders = self.clients[:self.args.senders]
+
+        def handler(client, line, now):
+            (head, sep, text) = line.partition(' PRIVMSG #storm :t')
+            if sep:
+                (sentAt, sep, sender) = text.partition(' ')
+                self.count(now - int(sentAt), self.getHops(client, self.clients[int(sender)]))
+
+        def send():
+            for i in range(self.args.messages):
+                for client in senders:
+                    client.send('PRIVMSG #storm :t' + str(time.perf_counter_ns()) + ' ' + str(client.index))
+
+        return await self.measure(handler, len(senders) * self.args.messages * (len(self.clients) - 1), send)
+
+    # Clients in pairs, each sends --messages PRIVMSGs to its partner
+    async def runDm(self):
+
+        pairs = len(self.clients) // 2 * 2
+
+        def handler(client, line, now):
+            (head, sep, text) = line.partition(' PRIVMSG ' + client.nickname + ' :t')
+            if sep:
+                self.count(now - int(text), self.getHops(client, self.clients[client.index ^ 1]))
+
+        def send():
+            for i in range(self.args.messages):
+                for client in self.clients[:pairs]:
+                    client.send('PRIVMSG ' + self.clients[client.index ^ 1].nickname + ' :t' + str(time.perf_counter_ns()))
+
+        return await self.measure(handler, pairs * self.args.messages, send)
+
+    # --senders clients change nick --messages times each, timed until every member of #storm sees the change
+    async def runNick(self):
+
+        renamers = self.clients[:self.args.senders]
+        sentAt = {}
+
+        def handler(client, line, now):
+            parts = line.split(' ', 3)
+
+            if len(parts) == 3 and parts[1] == 'NICK':
+                if parts[0].startswith(':' + client.nickname + '!'): # Own change
+                    client.nickname = parts[2]
+                else:
+                    self.count(now - sentAt[parts[2]])
+
+        def send():
+            for i in range(self.args.messages):
+                for client in renamers:
+                    nickname = 'r' + base36(client.index) + 'x' + base36(i)
+                    sentAt[nickname] = time.perf_counter_ns()
+                    client.send('NICK ' + nickname)
+
+        return await self.measure(handler, len(renamers) * self.args.messages * (len(self.clients) - 1), send)
+
+    # The server hands over to a new process started with --takeover (hot restart) while --senders clients send a PING every
+    # millisecond, timed until each PONG: the slowest waited out the handover. Then every client sends a PING, so all of them
+    # have to be still connected for the scenario to complete.
+    async def runRestart(self):
+
+        senders = self.clients[:self.args.senders]
+        old = self.servers[0]
+
+        def handler(client, line, now):
+            (head, sep, sentAt) = line.partition(' :t')
+            if sep and ' PONG ' in head:
+                self.count(now - int(sentAt))
+
+        self.handler = handler
+        self.latencies = []
+        self.expected = float('inf') # Known once the pings have been sent
+        self.received = 0
+        self.done = asyncio.Event()
+
+        start = time.perf_counter()
+        self.servers[0] = subprocess.Popen(old.args + ['--takeover'], cwd=os.path.dirname(os.path.abspath(__file__)))
+        sent = 0
+
+        while old.poll() is None and time.perf_counter() - start < self.args.timeout:
+            for client in senders:
+                client.send('PING :t' + str(time.perf_counter_ns()))
+
+            sent += len(senders)
+            await asyncio.sleep(0.001)
+
+        handedOver = time.perf_counter() - start
+
+        for client in self.clients:
+            client.send('PING :t' + str(time.perf_counter_ns()))
+
+        self.expected = sent + len(self.clients)
+
+        if self.received >= self.expected:
+            self.done.set()
+
+        try:
+            await asyncio.wait_for(self.done.wait(), self.args.timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        elapsed = time.perf_counter() - start
+        self.handler = lambda client, line, now: None
+
+        return {
+            'seconds': round(elapsed, 3),
+            'messages': self.received,
+            'expected': self.expected,
+            'messagesPerSecond': round(self.received / elapsed, 1),
+            'latencyMs': getPercentiles(self.latencies),
+            'pauseMs': round(max(self.latencies, default=0) / 1e6, 3),
+            'handoverSeconds': round(handedOver, 3), # Including the new process starting up
+        }
+
+    # Every client but the first quits at once, timed until the first one sees each QUIT
+    async def runQuit(self):
+
+        observer = self.clients[0]
+        sentAt = {}
+
+        def handler(client, line, now):
+            if client is observer and ' QUIT ' in line:
+                nickname = line[1:line.index('!')]
+
+                if nickname in sentAt:
+                    self.count(now - sentAt[nickname])
+
+        def send():
+            for client in self.clients[1:]:
+                sentAt[client.nickname] = time.perf_counter_ns()
+                client.send('QUIT :load test over')
+
+        return await self.measure(handler, len(self.clients) - 1, send)
+
+    async def run(self, scenarios):
+
+        results = {'connect': await self.runConnect()}
+
+        joined = False
+
+        for name in scenarios:
+
+            if name in ('channel', 'nick', 'quit') and not joined: # These run in #storm
+                await self.runJoin()
+
+            joined = joined or name == 'join'
+
+            if name != 'connect':
+                results[name] = await getattr(self, 'run' + name.capitalize())()
+
+        for client in self.clients:
+            client.close()
+
+        return results
+
+
+# Starts the servers, each one linked to the one before, and waits until they accept connections and are all linked
+def startServers(args):
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    host = '[' + args.host + ']' if ':' in args.host else args.host
+    processes = []
+
+    for i in range(args.servers):
+
+        command = [sys.executable, os.path.join(directory, 'server.py'), args.mode] + ([str(args.workers)] if args.workers else [])
+        command += ['--name', 'Load' + str(i), '--listen', host + ':' + str(args.port + i), '--set', 'LOG_LEVEL=WARNING']
+        command += ['--set', 'METRICS_PORT=' + str(args.port + 2000 + 100 * i)] # Workers add their id, see getMetricsPorts()
+
+        if not args.flood_control:
+            command += ['--set', 'FLOOD_RATE=1e9', '--set', 'FLOOD_BURST=1e9']
+
+        for setting in args.set:
+            command += ['--set', setting]
+
+        if canRestart(args):
+            command += ['--set', 'RESTART_PATH=' + os.path.join(tempfile.gettempdir(), 'loadgen-%d.restart' % args.port)]
+
+        if args.servers > 1: # A LINKS connection made before the server it goes to listens is retried after LINK_RETRY
+            command += ['--set', 'LINK_LISTEN=' + host + ':' + str(args.port + 1000 + i), '--set', 'LINK_RETRY=0.2']
+
+            if i > 0:
+                command += ['--set', 'LINKS=' + json.dumps([host + ':' + str(args.port + 999 + i)])]
+
+        processes.append(subprocess.Popen(command, cwd=directory))
+
+    deadline = time.time() + 10
+
+    for i in range(args.servers):
+
+        while True:
+
+            try:
+                socket.create_connection((args.host, args.port + i), timeout=1).close()
+
+                # Every server knows all the others once the tree is complete
+                if args.servers == 1 or getMetric(args.port + 2000 + 100 * i, 'ircd_linked_servers') == args.servers - 1:
+                    break
+            except OSError:
+                pass
+
+            if time.time() > deadline:
+                for process in processes:
+                    process.kill()
+
+                sys.exit('Server did not start' if args.servers == 1 else 'Servers did not start or link up')
+
+            time.sleep(0.1)
+
+    return processes
+
+
+# Value of a gauge or counter from a server's metrics endpoint, None if it doesn't have it
+def getMetric(port, name):
+
+    with socket.create_connection(('localhost', port), timeout=1) as sock:
+        sock.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+        text = b''.join(iter(lambda: sock.recv(65536), b'')).decode()
+
+    for line in text.splitlines():
+        if line.partition(' ')[0] == name:
+            return int(line.partition(' ')[2])
+
+    return None
+
+
+# Metrics ports of the servers started here and of their workers
+def getMetricsPorts(args):
+
+    workers = (args.workers or os.cpu_count() or 1) if args.mode == 'workers' else 1
+    return [args.port + 2000 + 100 * i + worker for i in range(args.servers) for worker in range(workers)]
+
+
+# Hot restart needs a single server in threaded or asyncio mode, started here so it can be restarted
+def canRestart(args):
+    return not args.no_server and args.servers == 1 and args.mode != 'workers'
+
+
+def getCommit():
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Load generator for the IRC server')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run in order, all of them by default: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--mode', default='threaded', choices=('threaded', 'asyncio', 'workers'))
+    parser.add_argument('--workers', type=int, help='worker processes in workers mode')
+    parser.add_argument('--host', default='::1')
+    parser.add_argument('--port', type=int, default=50100)
+    parser.add_argument('--no-server', action='store_true', help='use a server already listening on --host and --port')
+    parser.add_argument('--servers', type=int, default=1, help='linked servers on consecutive ports, the clients are spread over them')
+    parser.add_argument('--flood-control', action='store_true', help="keep the server's flood control, off by default so it doesn't cap the rates")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='server setting, e.g. COALESCE_BYTES=0 to compare with write coalescing off')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--senders', type=int, default=10, help='clients sending to the channel and changing nick')
+    parser.add_argument('--messages', type=int, default=20, help='messages (or nick changes) per sending client')
+    parser.add_argument('--concurrency', type=int, default=50, help='connections being set up at once')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for each scenario')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario ' + name)
+
+    if args.servers > 1 and args.mode == 'workers':
+        parser.error('linked servers need the threaded or asyncio mode')
+
+    if 'restart' in args.scenarios and not canRestart(args):
+        parser.error('restart needs a single threaded or asyncio server started by loadgen')
+
+    raiseFileLimit()
+    servers = [] if args.no_server else startServers(args)
+    runner = LoadRunner(args)
+    runner.servers = servers # The restart scenario replaces the server process
+    runner.metricsPorts = [] if args.no_server else getMetricsPorts(args)
+
+    try:
+        results = asyncio.run(runner.run(args.scenarios or [name for name in SCENARIOS if name != 'restart' or canRestart(args)]))
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+    report = {
+        'mode': args.mode,
+        'workers': args.workers,
+        'servers': args.servers,
+        'clients': args.clients,
+        'senders': args.senders,
+        'messages': args.messages,
+        'floodControl': args.flood_control,
+        'settings': args.set,
+        'commit': getCommit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scenarios': results,
+    }
+
+    print('scenario   seconds   msgs/s      p50 ms    p99 ms    p999 ms   complete')
+
+    for (name, result) in results.items():
+        latency = result['latencyMs'] or {'p50': 0, 'p99': 0, 'p999': 0}
+        rate = result.get('connectsPerSecond', result.get('messagesPerSecond'))
+        print(name.ljust(11) + str(result['seconds']).ljust(10) + str(rate).ljust(12) + str(latency['p50']).ljust(10) + str(latency['p99']).ljust(10) + str(latency['p999']).ljust(10) + '%d/%d' % (result['messages'], result['expected']))
+
+        if 'writesPerLine' in result:
+            print('  %s socket writes per line sent' % result['writesPerLine'])
+
+        if 'pauseMs' in result:
+            print('  longest wait %s ms, handed over %s s after starting the new process' % (result['pauseMs'], result['handoverSeconds']))
+
+        for (hops, latency) in result.get('latencyByHopsMs', {}).items():
+            print(('  %s hops' % hops).ljust(31) + str(latency['p50']).ljust(10) + str(latency['p99']).ljust(10) + str(latency['p999']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,53 @@
+import argparse
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import datetime
+import fnmatch
+import itertools
+import json
+import logging
+import logging.handlers
+import math
+import mmap
+import os
+import queue
+import select
+import selectors
+import signal
 import socket
+import ssl
+import struct
+import subprocess
+import sys
 import threading
+import time
+import types
 
-# Client class that holds general information about the client
+# Client class that holds general information about the client. Uses __slots__ as the server may hold 100k of them.
 class Client:
-    
+
+    __slots__ = ('nickname', 'username', 'realname', 'socket', 'host', 'port', 'channels', 'registered', 'prefix', 'prefixBytes', 'tokens', 'tokensAt', 'lastActive', 'pingSentAt', 'timerSlot')
+
     # Constructor
     def __init__(self, nickname, username, realname, clientSock, address):
         self.nickname = nickname
         self.username = username
         self.realname = realname
-        self.clientSocket = (clientSock, address)
-        self.clientAddress = address
-        self.channelList = []
+        self.socket = clientSock
+        self.host = sys.intern(str(address[0])) # Many clients share a host, keep one copy of the string
+        self.port = address[1]
+        self.channels = {} # Channel -> None, an insertion ordered set
+        self.registered = False # True once NICK and USER have been accepted
+        self.prefix = None # Cached ':nick!user@host', rebuilt after NICK
+        self.prefixBytes = None
+        self.tokens = 0.0 # Flood control bucket, full on the first command as it was last filled at time 0
+        self.tokensAt = 0.0
+        self.lastActive = time.monotonic() # Time of the last command, for PING
+        self.pingSentAt = 0.0 # Time of an unanswered PING, 0 if there is none
+        self.timerSlot = None # Slot of the server's timing wheel holding this client
 
     # Functions
     def getRealname(self):
@@ -22,6 +58,13 @@ class Client:
 
     def changeNickname(self, nickname):
         self.nickname = nickname
+        self.prefix = None
+        self.prefixBytes = None
+
+    def changeUsername(self, username):
+        self.username = username
+        self.prefix = None
+        self.prefixBytes = None
 
     def getNickname(self):
         return self.nickname
@@ -31,597 +74,4395 @@ class Client:
 
     # Returns socket object and address, needed for inter-client communication
     def getClientSocket(self):
-        return self.clientSocket
+        return (self.socket, (self.host, self.port))
     
     #Returns specifically address and port
     def getClientAddress(self):
-        return self.clientAddress
+        return (self.host, self.port)
+
+    def getHost(self):
+        return self.host
+
+    # Source of messages from this client, ':nick!user@host'
+    def getPrefix(self):
+        if self.prefix is None:
+            self.prefix = ':' + self.nickname + '!' + self.username + '@' + self.host
+
+        return self.prefix
+
+    def getPrefixBytes(self):
+        if self.prefixBytes is None:
+            self.prefixBytes = self.getPrefix().encode()
+
+        return self.prefixBytes
     
     def leaveChannel(self, channel):
-        if channel in self.channelList:
-            self.channelList.remove(channel)
+        self.channels.pop(channel, None)
 
     def addToChannel(self, channel):
-        self.channelList.append(channel)
+        self.channels[channel] = None
 
-    #Used for error checking
+    #Used for error checking, iterating gives the channels in the order they were joined
     def getChannels(self):
-        return self.channelList
+        return self.channels
+
+    def isRegistered(self):
+        return self.registered
+
+    # True for clients connected to another worker process
+    def isRemote(self):
+        return False
+
+
+# Client connected to another worker process or another server. Messages to it are forwarded over the worker bus or the links.
+class RemoteClient(Client):
+
+    __slots__ = ('worker',)
+
+    def __init__(self, nickname, username, realname, server, worker, address):
+        Client.__init__(self, nickname, username, realname, BusSocket(server, self), address)
+        self.registered = True
+        self.worker = worker # Id of the worker process, or name of the server, holding the connection
+
+    def isRemote(self):
+        return True
 
 
 # Server class that holds information about the server the user is connected to, including the available commands the server offers   
 class Server:
     
     # Constructor
-    def __init__(self, serverName):
+    def __init__(self, serverName, mode='threaded'):
         self.serverName = serverName
-        self.clientList = [] # Client objects
-        self.channelList = [] # Channel objects
+        self.mode = mode # 'threaded' (one thread per client) or 'asyncio' (one event loop for all clients)
+        self.clients = Registry() # Client objects by nickname
+        self.channels = Registry() # Channel objects by channel name
+        self.memberCounts = MemberCounts() # The channels by member count, for LIST
 
         self.HOST = 'fc00:1337::17'
         self.PORT = 50000
+        self.LISTENERS = None # Addresses to listen on instead of HOST and PORT, e.g. ['[::]:6667', '0.0.0.0:6667']
+        self.BACKLOG = 1024 # Connections the kernel queues per listener before they are accepted, capped by net.core.somaxconn
+        self.ACCEPT_BATCH = 64 # Connections accepted per wakeup in threaded mode
+        self.TCP_NODELAY = True # Send small replies straight away
+        self.SO_SNDBUF = None # Socket buffer sizes in bytes, the system default if None
+        self.SO_RCVBUF = None
 
-        self.socket()
+        # TLS. TLS_LISTENERS take TLS connections with the TLS_CERT certificate chain and TLS_KEY private key (PEM files), which
+        # reloadCertificates() (SIGHUP from the command line) loads again without dropping anyone. Sessions resume from tickets or
+        # the session cache, so a reconnecting client skips the key exchange. In asyncio mode the handshakes run on a pool of
+        # TLS_HANDSHAKE_THREADS threads, in threaded mode on the client's own thread, never on the thread handling other clients.
+        self.TLS_LISTENERS = [] # ['[::]:6697', ...]
+        self.TLS_CERT = None
+        self.TLS_KEY = None # None if the key is in TLS_CERT
+        self.TLS_HANDSHAKE_THREADS = 4
+        self.tlsContext = None
+        self.tlsListeners = set() # Listening sockets taking TLS connections
+        self.tlsLock = threading.Lock() # Held while the certificate is loaded and while SSL objects copy it
+        self.handshakePool = None
+        self.tlsStats = {'handshakes': 0, 'resumed': 0, 'failed': 0} # Completed handshakes, how many of them resumed a session, and failed ones
 
-    # Validation for NICK message
-    def checkNickMessage(self, message):
-        nickMessage = message.split() # Allows to validate individual elements
+        # Outbound queue limits. A client over either high-water mark for SENDQ_TIMEOUT seconds, or over four times the byte limit, is disconnected.
+        self.SENDQ_BYTES = 1048576
+        self.SENDQ_LINES = 10000
+        self.SENDQ_TIMEOUT = 10.0
+        self.sendqStats = {'dropped': 0, 'evicted': 0} # Messages dropped for evicted clients and number of evicted clients
+        self.flusher = None # Writes queued output in threaded mode
 
-        # More than 2 parameters or nickname > 10 characters
-        if len(nickMessage) != 2 or len(nickMessage[1]) >= 10:
-            replyCode = ReplyCode('432')
-            return replyCode.getMessage() # error nickname
-        
-        # nick name in use.
-        for client in self.clientList:
-            if client.getNickname() == nickMessage[1]:
-                replyCode = ReplyCode('433')
-                return replyCode.getMessage() 
+        # Write coalescing. While a batch of input is handled (the lines from one read, or in asyncio mode everything in one pass
+        # of the event loop), output is only queued, and every client it went to is written once when the batch ends, so a JOIN
+        # and the NAMES after it, or the lines of a busy channel, go out in one send. A batch ends after COALESCE_LINES input
+        # lines at the most, and a client with COALESCE_BYTES waiting is written straight away. 0 bytes turns it off.
+        self.COALESCE_LINES = 64
+        self.COALESCE_BYTES = 65536
+        self.batches = threading.local() # .sockets written when the thread's batch ends, .lines handled in it
+
+        # Flood control. Every command costs tokens from a bucket of FLOOD_BURST that refills at FLOOD_RATE per second; channel messages
+        # cost FANOUT_COST more per member. A client out of tokens has its input held back until the bucket refills, and is disconnected
+        # if more than FLOOD_RECVQ bytes of input pile up.
+        self.FLOOD_RATE = 10.0
+        self.FLOOD_BURST = 20.0
+        self.FLOOD_RECVQ = 16384
+        self.FANOUT_COST = 0.02
+        self.COMMAND_COSTS = {'NICK': 3, 'JOIN': 2, 'PART': 2, 'WHO': 5, 'NAMES': 5, 'STATS': 5, 'CHATHISTORY': 5, 'LIST': 5, 'WHOIS': 2} # Others cost 1
+        self.MAX_TARGETS = 20 # Channels and nicks in one PRIVMSG, NOTICE or WHOIS, each one after the first costs 1 more
+        self.WHOIS_MATCHES = 10 # Nicks a WHOIS mask like a* answers for
+        self.floodStats = {'throttled': 0, 'killed': 0} # Times input was held back and clients disconnected for flooding
+
+        # Liveness. Clients that have been idle for PING_INTERVAL seconds are sent a PING and dropped if nothing comes back within
+        # PING_TIMEOUT, connections that haven't registered after REGISTRATION_TIMEOUT are dropped. Checked on a timing wheel of TIMER_TICK second slots.
+        self.PING_INTERVAL = 90.0
+        self.PING_TIMEOUT = 60.0
+        self.REGISTRATION_TIMEOUT = 30.0
+        self.TIMER_TICK = 1.0
+        self.timers = TimingWheel(512)
+        self.timeoutStats = {'pings': 0, 'registration': 0, 'ping': 0} # PINGs sent and clients dropped for each timeout
+
+        # Logging. Records go through a queue to a background thread, received lines are only logged at DEBUG and then one in LOG_SAMPLE.
+        self.LOG_LEVEL = 'INFO'
+        self.LOG_SAMPLE = 100
+        self.TRAFFIC_LINES = 1000 # Recently received lines kept in memory for dumpTraffic()
+        self.traffic = collections.deque(maxlen=self.TRAFFIC_LINES) # (time, nickname, line)
+        self.linesSeen = 0
+        self.logListener = None
+
+        # Channel history. The last HISTORY_LINES messages of a channel, at most HISTORY_BYTES of them, are kept as the lines that were
+        # sent. CHATHISTORY returns up to HISTORY_LIMIT of them and a client joining a channel is sent the last HISTORY_REPLAY. With
+        # HISTORY_DIR set, older lines go on to append-only files there, at most HISTORY_SEGMENTS of HISTORY_SEGMENT bytes per channel.
+        self.HISTORY_LINES = 100
+        self.HISTORY_BYTES = 32768
+        self.HISTORY_LIMIT = 500
+        self.HISTORY_REPLAY = 0
+        self.HISTORY_DIR = None
+        self.HISTORY_SEGMENT = 1048576
+        self.HISTORY_SEGMENTS = 4
+
+        # Metrics, read with the STATS command or scraped in Prometheus text format from METRICS_PORT (TCP on localhost) or METRICS_PATH (Unix socket)
+        self.METRICS_PORT = None
+        self.METRICS_PATH = None
+        self.metrics = Metrics()
+
+        self.workerId = None # Set in worker processes when running with several workers
+        self.bus = None # Transport to the worker bus hub
+
+        # Links to other servers, which form a spanning tree. LINK_LISTEN accepts links, LINKS are connected to at startup and
+        # again LINK_RETRY seconds after they are lost. Both ends must have the same LINK_PASSWORD and different names.
+        self.LINK_LISTEN = None # 'host:port'
+        self.LINKS = [] # ['host:port', ...]
+        self.LINK_PASSWORD = None
+        self.LINK_RETRY = 10.0
+        self.links = {} # Linked servers by name
+        self.servers = {} # Every other server on the network by name -> the link it is reached through
+        self.linkConnections = set() # Open link connections, including those still in the handshake
+        self.linkListener = None
+        self.linksStopped = threading.Event()
+
+        # Hot restart. A server with RESTART_PATH set waits there (Unix socket) for a new process started with --takeover, and hands
+        # it the listeners, every client socket and the nick, channel and history state before exiting, so the clients stay
+        # connected. It waits up to RESTART_TIMEOUT seconds for the new process to confirm, and carries on if it doesn't.
+        self.RESTART_PATH = None
+        self.RESTART_TIMEOUT = 10.0
+        self.restartListener = None
+        self.frozen = False # Set while handing over, readers stop before reading anything more
+        self.busyReaders = 0 # Threaded mode readers not waiting for input
+        self.thaw = threading.Condition(threading.Lock()) # Notified when busyReaders drops to 0 and when frozen is cleared
+
+        # Running state, see start() and stop()
+        self.listeners = []
+        self.connections = {} # Local clients with an open connection, registered or not -> (LineFramer, deque of lines not handled yet)
+        self.serveThread = None
+        self.stopping = False
+        self.ready = threading.Event() # Set once the asyncio listeners accept connections
+        self.loop = None
+        self.stopEvent = None
+        self.wakeup = None # Socket pair waking the threaded accept loop for stop()
+        self.timerThread = None
+        self.workerPids = []
+        self.metricsSocket = None
+
+        # ':server NNN ' for every numeric, encoded once
+        self.numerics = {}
+
+        for code in REPLIES:
+            self.numerics[code] = (':' + serverName + ' ' + code + ' ').encode()
+
+        # Command dispatch table, command name -> (handler, needs registration)
+        self.commands = {}
+        self.registerCommand('NICK', self.onNick, False)
+        self.registerCommand('USER', self.onUser, False)
+        self.registerCommand('QUIT', self.onQuit, False)
+        self.registerCommand('CAP', self.onIgnored, False)
+        self.registerCommand('PING', self.onPing, False)
+        self.registerCommand('PONG', self.onPong, False)
+        self.registerCommand('MODE', self.onIgnored)
+        self.registerCommand('JOIN', self.onJoin)
+        self.registerCommand('PART', self.onPart)
+        self.registerCommand('PRIVMSG', self.onPrivmsg)
+        self.registerCommand('NOTICE', self.onPrivmsg)
+        self.registerCommand('WHO', self.onWho)
+        self.registerCommand('NAMES', self.onNames)
+        self.registerCommand('LIST', self.onList)
+        self.registerCommand('WHOIS', self.onWhois)
+        self.registerCommand('ISON', self.onIson)
+        self.registerCommand('CHATHISTORY', self.onChathistory)
+        self.registerCommand('STATS', self.onStats)
+
+    # Validation for NICK message, returns the nickname or a ReplyCode
+    def checkNickMessage(self, message, client=None):
+        nickMessage = message.getArguments() # Allows to validate individual elements
+
+        # More than 1 parameter or nickname > 10 characters
+        if len(nickMessage) != 1 or len(nickMessage[0]) >= 10:
+            return ReplyCode('432', nickMessage[0] if nickMessage else '*') # error nickname
 
-        return nickMessage[1]
+        # nick name in use, a client may change the case of its own nickname.
+        holder = self.clients.find(nickMessage[0])
 
-    #Validates USER message
+        if holder is not None and holder is not client:
+            return ReplyCode('433', nickMessage[0])
+
+        return nickMessage[0]
+
+    #Validates USER message, returns [username, realname] or a ReplyCode
     def checkUserMessage(self, message, nick):
-        userMessage = message.split(' ', 4) #Max 4 splits, so real name isn't split
-        realnameCheck = userMessage[4]
+        userMessage = message.getArguments()
+
+        # Needs username, mode, unused and a real name after the colon
+        if len(userMessage) != 4 or message.trailing is None:
+            return ReplyCode('461', 'USER')
 
         # Checks if user mode is an integer.
         try:
-            int(userMessage[2])
+            int(userMessage[1])
         except ValueError as identifier:
-            replyCode = ReplyCode('461')
-            return replyCode.getMessage()
+            return ReplyCode('461', 'USER')
 
         # checks if user command is valid.
-        if realnameCheck[0] != ':' or int(userMessage[2]) > 7 or userMessage[3] != '*' :
-            replyCode = ReplyCode('461')
-            return replyCode.getMessage()
-        
-        # Returns username and nickname
-        realname = realnameCheck.replace(':', "") # real name without : is used for socket communication
-        username = userMessage[1]
+        if int(userMessage[1]) > 7 or userMessage[2] != '*' :
+            return ReplyCode('461', 'USER')
+
+        # Returns username and real name
+        realname = userMessage[3]
+        username = userMessage[0]
         return [username, realname]
-    
-    #Validate JOIN message
+
+    #Validate JOIN message. Returns 0 to leave all channels, a ReplyCode, or a list of the (channel name, key) pairs to join
+    #and the ReplyCodes for the names that aren't valid.
     def checkJoinMessage(self, message, sender):
-        # JOIN (#,&,+,!)<channel name>
-        joinMessage = message.split()
-        channelName = joinMessage[1]
-        commaCheck = channelName.split(',') # Checked later to see if there are commas in name.
+        # JOIN (#,&,+,!)<channel name>{,<channel name>} [<key>{,<key>}]
+        joinMessage = message.getArguments()
+
+        if len(joinMessage) == 0 or len(joinMessage) > 2:
+            return ReplyCode('461', 'JOIN')
 
         # If the user wants to leave all channels
-        if channelName == '0':
+        if joinMessage[0] == '0':
             return 0
-        
-        # Max channel limit is 10.
-        if (len(sender.getChannels()) > 9):
-            replyCode = ReplyCode('405')
-            return replyCode.getMessage()
-        
-        if (channelName[0] == '#' or channelName[0] == '&' or channelName[0] == '+' or channelName[0] == '!') and len(channelName) <= 50 and len(joinMessage) == 2 and len(commaCheck) == 1: # Correct input, client can join channel
-            return channelName
 
-        else: # Error
-            replyCode = ReplyCode('403')
-            return replyCode.getMessage()
+        keys = joinMessage[1].split(',') if len(joinMessage) == 2 else [] # Given in the same order as the channels
+        joins = []
+        errors = []
+
+        for (i, channelName) in enumerate(joinMessage[0].split(',')):
+
+            if channelName[:1] in ('#', '&', '+', '!') and len(channelName) <= 50 and CHANNEL_NAME_FORBIDDEN.isdisjoint(channelName): # Correct input, client can join channel
+                joins.append((channelName, keys[i] if i < len(keys) and keys[i] else None))
+            else: # Error
+                errors.append(ReplyCode('403', channelName))
+
+        return [joins, errors]
 
-    #Validate PART message
+    #Validate PART message, returns the lines to send to the parting client
     def checkPartMessage(self, message, client):
-        partMessage = message.split(' ', 2)
-        removeList = partMessage[1].split(',') # Channels which user wants to leave, can be multiple at once
+        partMessage = message.getArguments()
+
+        if len(partMessage) == 0 or len(partMessage) > 2: # Error
+            return ReplyCode('461', 'PART').render(self, client)
+
+        removeList = partMessage[0].split(',') # Channels which user wants to leave, can be multiple at once
+        reason = (' :' + partMessage[1]) if len(partMessage) == 2 else ''
+        replies = [] # Several messages must be sent when leaving more than one channel
+        parted = []
+
+        for leaveChan in removeList:
+
+            chan = self.channels.find(leaveChan) if leaveChan[:1] in ('#', '&', '+', '!') else None
+
+            if chan is None or not chan.hasClient(client):
+                replies.append(ReplyCode('442', leaveChan).render(self, client))
+                continue
+
+            self.partChannel(client, chan)
+
+            msg = client.getPrefix() + ' PART ' + chan.getChannelName() + reason
+            data = (msg + '\r\n').encode()
+
+            replies.append(data)
+            parted.append((chan, data))
+
+            self.busPublish('PART', client.getNickname(), chan.getChannelName(), msg)
+
+        self.chargeFlood(client, max(len(parted) - 1, 0) * self.COMMAND_COSTS.get('PART', 1)) # Each channel after the first costs another PART
+        self.broadcastBatch(parted) # Broadcast to users in the channels, one write each
+
+        return b''.join(replies)
+
+    # Validate QUIT message
+    def checkQuitMessage(self, message):
+        quitMessage = message.getArguments()
+        return ':' + (quitMessage[0] if quitMessage else '') #Returns quit message
+
+    # Checks PRIVMSG and NOTICE. Returns a list of the text, the channels and the clients named in the comma separated target
+    # list (dicts of each target to the name the sender used, so every target appears once) and a ReplyCode for every target
+    # that doesn't exist. If nothing can be sent the list only holds a ReplyCode.
+    # Only the targets are decoded, the text is relayed as the original bytes.
+    def checkPrivMessage(self, message, sender):
+
+        # Checks if command has a target and a text
+        if len(message.params) == 0:
+            return [ReplyCode('411', message.command)]
 
-        if (partMessage[1][0] == '#' or partMessage[1][0] == '&' or partMessage[1][0] == '+' or partMessage[1][0] == '!') and (len(partMessage) == 3 or len(partMessage) == 2): # Correct input
+        if message.trailing is None and len(message.params) < 2:
+            return [ReplyCode('412')]
 
-            if len(removeList) == 1: # Leave from 1 channel
+        msg = message.trailing if message.trailing is not None else message.params[1].encode()
 
-                for chan in self.channelList:
+        if len(msg) < 1: #if message is empty
+            return [ReplyCode('412')]
 
-                    if removeList[0] == chan.getChannelName(): # Leave provided channel
+        targets = message.params[0].split(',') # Channels and nicks, any mix of them
 
-                        client.leaveChannel(chan.getChannelName())
-                        chan.removeClient(client)
+        if len(targets) > self.MAX_TARGETS:
+            return [ReplyCode('407', message.params[0])]
 
-                        if chan.isEmpty():
-                            self.channelList.remove(chan) # Delete channels with no users
+        channels = {}
+        clients = {}
+        errors = []
 
-                        returnMessage = ':' + client.getNickname() + '!' + client.getNickname() + '@' + str(client.getClientAddress()[0]) + ' ' + message
+        for target in targets:
 
-                        self.broadcastToChannel(chan, returnMessage) # Tell 
+            if target[:1] in ('#', '&', '+', '!'): # Validate channel name prefix
+                targetChannel = self.channels.find(target)
 
-                        return returnMessage
+                if targetChannel is None:
+                    errors.append(ReplyCode('403', target))
+                else:
+                    channels.setdefault(targetChannel, target)
+
+            elif target:
+                targetClient = self.clients.find(target)
 
+                if targetClient is None:
+                    errors.append(ReplyCode('401', target))
                 else:
-                    returnMessage = ':' + client.getNickname() + ' 442 ' + client.getNickname() + ' ' + removeList[0] + " :You're not in that channel"
-                    return returnMessage
+                    clients.setdefault(targetClient, target)
 
-            elif len(removeList) > 1: # Client wants to leave multiple channels
-                returnMessage = ''
-                x = 0 # Iterator for all channels user wants to be removed from
-                for leaveChan in removeList:
+            else: # Empty name between two commas
+                errors.append(ReplyCode('411', message.command))
 
-                    if (removeList[x][0] == '#' or removeList[x][0] == '&' or removeList[x][0] == '+' or removeList[x][0] == '!') and (len(partMessage) == 3 or len(partMessage) == 2): # Correct input
+        return [msg, channels, clients, errors]
 
-                        for chan in self.channelList:
+    # Validate WHO message, returns an iterable of the reply lines
+    def checkWhoMessage(self, message, client):
+        incomingData = message.getArguments()
 
-                            if leaveChan == chan.getChannelName(): # Valid channel
+        if len(incomingData) == 0:
+            return (ReplyCode('461', 'WHO').render(self, client),)
 
-                                client.leaveChannel(chan.getChannelName())
-                                chan.removeClient(client)
+        channel = self.channels.find(incomingData[0])
 
-                                if chan.isEmpty():
-                                    self.channelList.remove(chan)
+        if channel is None: # if the channel doesn't exist
+            return (ReplyCode('403', incomingData[0]).render(self, client),)
 
-                                msg = ':' + client.getNickname() + '!' + client.getNickname() + '@' + str(client.getClientAddress()[0]) + ' ' + 'PART ' + leaveChan + ' ' + partMessage[2] + '\r\n'
+        if not channel.hasClient(client): # client not in channel
+            return (ReplyCode('442', incomingData[0]).render(self, client),)
 
-                                returnMessage += msg # Appended as several messages must be sent
+        return self.generateWho(client, channel, incomingData[0])
 
-                                self.broadcastToChannel(chan, msg) # Broadcast to users in channel
-                        x += 1 # Next channel in list
-                
-                return returnMessage
+    # WHO reply lines for a channel, a 352 line per member then 315. Generated as they are sent, members are read from the
+    # snapshot taken when the reply starts.
+    def generateWho(self, client, channel, name):
 
-            else: # Error
-                replyCode = ReplyCode('461')
-                
-                returnMessage = ':' + client.getNickname() + ' 461 ' + client.getNickname() + ' :' + replyCode.getMessage()
-                return returnMessage
+        head = self.numerics['352'] + (client.getNickname() + ' ' + name + ' ').encode()
+        server = ' ' + self.serverName + ' '
 
-    # Validate QUIT message
-    def checkQuitMessage(self, message):
-    	quitMessage = message.split(' ', 1)
-    	return quitMessage[1] #Returns quit message
+        for c in channel.getClientList():
+            line = head + (c.getUsername() + ' ' + c.getHost() + server + c.getNickname() + ' H :0 ' + c.getRealname()).encode()
+            yield line[:510] + b'\r\n' # Long real names are cut to fit the line limit
 
-    # Checks PRIVMSG command. Returns a list consisting of a message, a target (either client or channel object) and broadcast boolean (True if to broadcast to channel and false to send to either sender or target client).
-    def checkPrivMessage(self, message, sender):
-        # Splits main message into parts for validation
-        sendMessage = message.split(' ', 2)
+        yield ReplyCode('315', name).render(self, client) # Signifies end of list of users
 
-        # Checks if command has right number of elements
-        if len(sendMessage) < 3:
-            replyCode = ReplyCode('461')
-            return [replyCode.getMessage(), sender, False] # False to only broadcast to sender.
+    # NAMES reply lines for a channel: 353 lines with as many nicks as fit in 512 bytes, then 366. Generated as they are sent,
+    # like generateWho().
+    def generateNames(self, client, channel):
 
-        target = sendMessage[1] # Can be user or channel
-        msg = sendMessage[2]
-        returnMessage = ''
+        head = self.numerics['353'] + (client.getNickname() + ' = ' + channel.getChannelName() + ' :').encode()
 
-        # If a message is being sent to clients in the channel.
-        if (target[0] == '#' or target[0] == '&' or target[0] == '+' or target[0] == '!' ): # Validate channel name prefix
-            
-            if len(msg) < 1: #if message is empty
-                replyCode = ReplyCode('412')
-                return [replyCode.getMessage(), sender, False]
-            
-            # Find channel in list of channels
-            for targetChannel in self.channelList:
-                
-                # compare channel names
-                if target == targetChannel.getChannelName():
-                    
-                    # Return message to broadcast and channel object.
-                    returnMessage = ':' + sender.getNickname() + '!' + sender.getNickname() + '@' + str(sender.getClientAddress()[0]) + ' ' + message
+        yield from packWords(head, (c.getNickname().encode() for c in channel.getClientList()))
+        yield ReplyCode('366', channel.getChannelName()).render(self, client)
 
-                    return [returnMessage, targetChannel, True] #True for broadcasting to channel
+    # LIST reply lines, a 322 line per channel with its member count then 323. Channels come from the name index for masks,
+    # from the member count index, largest first, when there are only member count limits, and in name order otherwise.
+    # Generated as they are sent.
+    def generateList(self, client, masks, low, high):
 
-            # if channel does not exist
-            else:
-                replyCode = ReplyCode('403')
-                return [replyCode.getMessage(), sender, False] # False for only sending msg to sender.
-        
-        # If sending priv message to specific user.
+        head = self.numerics['322'] + (client.getNickname() + ' ').encode()
+
+        if masks:
+            channels = ((c, c.getMemberCount()) for mask in masks for c in self.channels.match(mask))
+        elif low > 1 or high < sys.maxsize:
+            channels = self.memberCounts.getRange(low, high)
         else:
-            # Searching for specific client.
-            for targetClient in self.clientList:
-                
-                # compares client names
-                if target == targetClient.getNickname():
-                    
-                    # returns message to send to target client.
-                    returnMessage = ':' + sender.getNickname() + '!' + sender.getNickname() + '@' + str(sender.getClientAddress()[0]) + ' ' + message
+            channels = ((c, c.getMemberCount()) for c in self.channels.match('*'))
 
-                    return [returnMessage, targetClient, False] # False for only sending msg to sender.
-            
-            # If specified client is not found.
-            else:
-                replyCode = ReplyCode('401')
-                return [replyCode.getMessage(), sender, False] # False for only sending msg to sender.
+        seen = set() if len(masks) > 1 else None # A channel matching several masks is listed once
 
-    # Validate WHO message
-    def checkWhoMessage(self, message, client):
-        incomingData = message.split()
-        returnMessage = ''
+        for (channel, count) in channels:
 
-        for channel in self.channelList:
-            
-            if incomingData[1] == channel.getChannelName(): # Valid channel
+            if seen is not None:
+                if channel in seen:
+                    continue
+                seen.add(channel)
 
-                clients = channel.getClientList() # So we can send information about the clients
-            
-                if client in clients: # Client is in the channel
+            if low <= count <= high: # Channels that closed meanwhile have 0
+                yield head + (channel.getChannelName() + ' ' + str(count) + ' :').encode() + b'\r\n'
 
-                    for c in clients:
+        yield ReplyCode('323').render(self, client)
 
-                        msg = ':' + self.serverName + ' 352 ' + client.getNickname() + ' ' + incomingData[1] + ' ' + c.getUsername() + ' ' + str(c.getClientAddress()[0]) + ' ' + self.serverName + ' ' + c.getNickname() + ' H :0 ' + c.getRealname() + '\r\n'
-                    
-                        returnMessage += msg # Used to send information about clients
-                    
-                    msg = ':' + self.serverName + ' 315 ' + client.getNickname() + ' ' + incomingData[1] + ' :End of WHO list\r\n' # Signifies end of list of users
-                    
-                    returnMessage += msg
-                    return returnMessage
+    # WHOIS reply lines for one nick: 311 user, host and real name, 319 channels, 312 server
+    def generateWhois(self, client, target):
 
-                # client not in channel
-                else:
-                    replyCode = ReplyCode('441')
-                    return replyCode.getMessage()
+        head = (client.getNickname() + ' ' + target.getNickname() + ' ').encode()
+        line = self.numerics['311'] + head + (target.getUsername() + ' ' + target.getHost() + ' * :' + target.getRealname()).encode()
+        yield line[:510] + b'\r\n'
 
-                break
-        
-        # if there are no channels in the server
-        else:
-            replyCode = ReplyCode('403')
-            return replyCode.getMessage()
+        yield from packWords(self.numerics['319'] + head + b':', (c.getChannelName().encode() for c in list(target.getChannels())))
 
-    # Reusable, required for WHO to work, sending just the information about the clients doesn't fit specification
-    def sendNamesList(self, channel, senderName):
-        
-        msg = ':' + self.serverName + ' 353 ' + senderName + ' = ' + channel.getChannelName() + ' :'
+        server = target.worker if target.isRemote() and isinstance(target.worker, str) else self.serverName # Linked server or a worker of this one
+        yield self.numerics['312'] + head + (server + ' :' + REPLIES['312'][1] + '\r\n').encode()
+
+    # Reusable, retrieves client socket objects and sends them message. The message is encoded once and the same bytes are queued for every member.
+    # Returns True when some members are on other workers.
+    def broadcastToChannel(self, channel, message, exclude=None):
+
+        if self.channels.find(channel.getChannelName()) is channel: # Channel exists
+
+            data = message if isinstance(message, bytes) else (message + '\r\n').encode()
+
+            start = time.perf_counter()
+            remoteMembers = False
+            recipients = 0
+
+            for client in channel.getClientList():
+
+                if client.isRemote(): # Remote clients are delivered by the worker holding the connection
+                    remoteMembers = True
+                    continue
+
+                if client is exclude:
+                    continue
+
+                client.getClientSocket()[0].sendall(data)
+                recipients += 1
+
+            self.metrics.broadcastDone(channel, recipients, time.perf_counter() - start)
+            return remoteMembers
+
+        return False
+
+    # The channel's history, created on first use. Its spill files are opened then, so a channel that is created again finds the
+    # lines it had before. Every worker sees every channel message, so each one spills to its own subdirectory.
+    def getHistory(self, channel):
+
+        if channel.history is None:
+            with channel.lock:
+                if channel.history is None:
+                    spill = None
+
+                    if self.HISTORY_DIR:
+                        directory = self.HISTORY_DIR if self.workerId is None else os.path.join(self.HISTORY_DIR, str(self.workerId))
+                        os.makedirs(directory, exist_ok=True)
+                        spill = HistorySpill(directory, channel.getChannelName(), self.HISTORY_SEGMENT, self.HISTORY_SEGMENTS)
+
+                    channel.history = History(self.HISTORY_LINES, self.HISTORY_BYTES, spill)
+
+        return channel.history
+
+    # Keeps a line sent to a channel for CHATHISTORY and replays
+    def recordHistory(self, channel, data):
+
+        if self.HISTORY_LINES:
+            self.getHistory(channel).append(data, time.time())
+
+    # Sends a line to each channel of a list of (channel, line), with the lines for a member that is in several of the channels
+    # joined into one write. Returns True when some members are on other workers.
+    def broadcastBatch(self, lines, exclude=None):
 
-        for client in channel.getClientList():
-            msg += ' ' + client.getNickname()
+        if len(lines) == 1: # Nothing to join
+            return self.broadcastToChannel(lines[0][0], lines[0][1], exclude)
 
-        return msg
+        outgoing = {} # Client -> its lines
+        remoteMembers = False
 
-    # Reusable, retrieves client socket objects and sends them message.
-    def broadcastToChannel(self, channel, message):
+        for (channel, data) in lines:
 
-        if channel in self.channelList: # Channel exists
+            if self.channels.find(channel.getChannelName()) is not channel: # Closed meanwhile
+                continue
+
+            start = time.perf_counter()
+            recipients = 0
+
+            for client in channel.getClientList():
+
+                if client.isRemote():
+                    remoteMembers = True
+                elif client is not exclude:
+                    outgoing.setdefault(client, []).append(data)
+                    recipients += 1
+
+            self.metrics.broadcastDone(channel, recipients, time.perf_counter() - start)
+
+        for (client, data) in outgoing.items():
+            client.getClientSocket()[0].sendall(data[0] if len(data) == 1 else b''.join(data))
+
+        return remoteMembers
+
+    # Sends a message to the local members of several channels, once to each member. The copy for a channel is head, the target
+    # name the sender used and tail. Returns the clients it was sent to and whether some members are on other workers.
+    def broadcastToChannels(self, channels, head, tail, exclude=None):
+
+        recipients = set()
+        remoteMembers = False
+
+        if exclude is not None:
+            recipients.add(exclude)
+
+        for (channel, target) in channels.items():
+
+            if self.channels.find(channel.getChannelName()) is not channel: # Closed meanwhile
+                continue
+
+            data = head + target.encode() + tail
+            start = time.perf_counter()
+            count = len(recipients)
+            self.recordHistory(channel, data)
 
             for client in channel.getClientList():
-                (conn, address) = client.getClientSocket()
-                conn.sendall((message + '\r\n').encode())
 
-    # Tells all clients that share channel with sender of nickname change.
-    def broadcastNickChange(self, sender, oldNickname):
+                if client.isRemote():
+                    remoteMembers = True
+                elif client not in recipients:
+                    recipients.add(client)
+                    client.getClientSocket()[0].sendall(data)
+
+            self.metrics.broadcastDone(channel, len(recipients) - count, time.perf_counter() - start)
 
-        clientChannels = sender.getChannels()
+        recipients.discard(exclude)
+        return (recipients, remoteMembers)
 
-        for chan in clientChannels:
+    # Tells all clients that share channel with sender of nickname change, once each.
+    def broadcastNickChange(self, sender, message):
+
+        data = (message + '\r\n').encode()
+        notified = set()
+
+        for chan in sender.getChannels():
 
             for cl in chan.getClientList():
                 
-                if cl == sender: # Don't send to client that changed nick
+                if cl == sender or cl.isRemote() or cl in notified: # Don't send to client that changed nick
                     continue
 
-                (conn, address) = cl.getClientSocket()
-                conn.sendall((':' + oldNickname + '!' + oldNickname + '@' + str(address[0]) + ' NICK ' + sender.getNickname() + '\r\n').encode())
+                notified.add(cl)
+                cl.getClientSocket()[0].sendall(data)
 
     # Tells all clients which share channel with sender that sender is leaving.
     def broadcastQuitMessage(self, sender, message):
-        
-        for client in self.clientList:
 
-            if client == sender:
+        data = (message + '\r\n').encode()
+
+        for client in self.clients:
+
+            if client == sender or client.isRemote():
                 continue
             
-            (conn, address) = client.getClientSocket()
-            conn.sendall((message + '\r\n').encode())
+            client.getClientSocket()[0].sendall(data)
 
     # Handles clients diconnecting with and without QUIT message. Removes clients from channels in which they are in.
+    # Its nick may already belong to someone else after a nick collision, see claimNick().
     def clientDisconnected(self, line, client):
 
-        address = client.getClientAddress()
+        if not client.isRegistered(): # Already cleaned up
+            return
+
+        client.registered = False
 
-        broadcastMessage = ':' + client.getNickname() + '!' + client.getNickname() + '@' + str(address[0]) + ' ' + line
+        broadcastMessage = client.getPrefix() + ' ' + line
 
         self.broadcastQuitMessage(client, broadcastMessage)
+        self.busPublish('QUIT', client.getNickname(), broadcastMessage)
         
-        clientChannels = client.getChannels() # Used so we can remove client from current channels
+        for c in list(client.getChannels()): # Remove client from current channels
+            self.partChannel(client, c)
 
-        for c in clientChannels:
-            c.removeClient(client)
+        self.clients.remove(client.getNickname(), client)
+        del client # Delete client object
 
-            if c.isEmpty():
-                self.channelList.remove(c)
+    # Adds client to the channel called name, creating the channel if needed, and returns it
+    def joinChannel(self, client, name, key=None):
 
-        self.clientList.remove(client)
-        del client # Delete client object
+        while True:
+            channel = self.channels.find(name)
 
-    def handleClient(self, conn, addr): # Runs from connection to termination
+            if channel is None: # Channel doesn't exists, create it
+                channel = self.channels.setdefault(name, Channel(name, key))
 
-        print('Connected by ', addr)
-        nickname = ''
-        realname = ''
+            if channel.addClient(client): # Channel object list which stores clients
+                client.addToChannel(channel) # Client object list which stores channels
+                self.memberCounts.update(channel)
+                return channel
+
+            self.channels.remove(name, channel) # Its last member just left, make sure it's gone and create a new one
+
+    # Removes client from channel and deletes the channel once its last member has left
+    def partChannel(self, client, channel):
+
+        client.leaveChannel(channel)
+        closed = channel.removeClient(client)
+        self.memberCounts.update(channel)
+
+        if closed:
+            self.channels.remove(channel.getChannelName(), channel) # Delete channels with no users
+
+            if channel.history is not None:
+                channel.history.close()
+
+    # Sets up a connection just accepted (threaded mode). Done on the accepting thread, so a hot restart that stops accepting
+    # knows every connection a reader thread has been started for. tls is set for a connection on one of the TLS_LISTENERS.
+    def addConnection(self, rawConn, addr, tls=False):
+
+        log.info('Connected by %s', addr)
+        self.metrics.accepted += 1
+
+        if tls:
+            conn = TlsThreadedSocket(rawConn, self, self.newTlsSession())
+        else:
+            conn = ThreadedSocket(rawConn, self) # Queues output so a slow reader never blocks the sender
+
+        client = Client('', '', '', conn, addr) # Not registered until NICK and USER are received
+        self.connections[client] = (LineFramer(), collections.deque())
+        self.timers.schedule(client, self.REGISTRATION_TIMEOUT, self.TIMER_TICK)
+
+        if self.stopping: # Accepted just before stop()
+            self.dropClient(client, 'Server shutting down')
+
+        return client
+
+    def handleClient(self, rawConn, client): # Runs from connection to termination (threaded mode)
+
+        self.readerWaiting(False)
+        conn = client.getClientSocket()[0]
+        session = conn.session if isinstance(conn, TlsThreadedSocket) else None
+
+        try:
+            if session is not None and not self.handshakeBlocking(rawConn, client, session):
+                return False
+
+            return self.readClient(rawConn, client, session)
+        finally:
+            self.connections.pop(client, None) # Before the timer, so checkLiveness() sees it gone if it sets the timer again
+            self.timers.remove(client)
+            self.readerWaiting(True)
+
+    # Counts the reader threads handling input, a hot restart waits until there are none. One that is done waiting stops here
+    # while a hot restart is under way, before it reads anything.
+    def readerWaiting(self, waiting):
+
+        with self.thaw:
+
+            if waiting:
+                self.busyReaders -= 1
+
+                if not self.busyReaders:
+                    self.thaw.notify_all()
+            else:
+                while self.frozen:
+                    self.thaw.wait()
+
+                self.busyReaders += 1
+
+    # Runs the TLS handshake on the client's thread (threaded mode). Returns False if it failed, the registration timeout
+    # ends a client that never finishes it.
+    def handshakeBlocking(self, rawConn, client, session):
+
+        data = b''
+
+        try:
+            while True:
+                (output, done) = session.handshake(data)
+
+                if output:
+                    rawConn.sendall(output)
+
+                if done:
+                    break
+
+                data = rawConn.recv(65536)
+
+                if not data:
+                    raise ConnectionError('Connection closed')
+
+                self.metrics.bytesIn += len(data)
+        except OSError as e: # ssl.SSLError too
+            self.handshakeDone(client, session, e)
+            rawConn.close()
+            return False
+
+        self.handshakeDone(client, session)
+        (framer, pending) = self.connections[client]
+        pending.extend(framer.feed(session.decrypt(b''))) # Sent straight after the handshake, in the same packet
+        return True
+
+    # Counts a finished TLS handshake, error is the exception if it failed
+    def handshakeDone(self, client, session, error=None):
+
+        if error is not None:
+            self.tlsStats['failed'] += 1
+            log.info('TLS handshake with %s failed: %s', client.getClientAddress(), error)
+            return
+
+        self.tlsStats['handshakes'] += 1
+
+        if session.tls.session_reused:
+            self.tlsStats['resumed'] += 1
+
+    # Reads and handles the client's lines until the connection ends (threaded mode). session is the TLS session of a connection
+    # on one of the TLS_LISTENERS, once the handshake is done.
+    def readClient(self, rawConn, client, session=None):
+
+        (framer, pending) = self.connections[client] # Partial line kept between reads, and lines held back while the client is throttled
+        delay = self.handleLines(client, pending) if pending else 0 # Taken over by a hot restart with lines still to handle
+        restartable = self.restartListener is not None # Waits before each read, so a hot restart can stop it in between
+
+        # poll() rather than select(), which fails for descriptors over FD_SETSIZE (1024)
+        poller = select.poll()
+        poller.register(rawConn, select.POLLIN)
+
+        while delay is not None: # Until QUIT
 
-        while True: # Until QUIT
-            
             try:
-                data = conn.recv(1024) # Waiting to receive data on socket
+                if restartable:
+                    self.readerWaiting(True)
+
+                    try:
+                        readable = poller.poll(delay * 1000 if delay > 0 else None)
+                    finally:
+                        self.readerWaiting(False)
+                else:
+                    readable = delay <= 0 or poller.poll(delay * 1000)
+
+                # Throttled, handle the next lines once the bucket has refilled unless more input arrives first
+                if not readable:
+                    if delay > 0:
+                        delay = self.handleLines(client, pending)
+
+                    continue
+
+                data = rawConn.recv(65536) # Waiting to receive data on socket
+                received = len(data)
+
+                if session is not None and data: # The complete TLS records, maybe none yet
+                    data = session.decrypt(data)
             except:
-                
-                if nickname != '' and realname != '':
-                    
-                    line = 'QUIT :[Errno 104] Connection reset by peer'                    
-                    self.clientDisconnected(line, client)
-                
+                rawConn.close()
+                self.connectionLost(client)
                 return False # Connection dropped
 
-            if data: # Data received
-                print("Incoming data: " + data.decode())
-                incomingData = data.decode().splitlines()
-                
-                for line in incomingData:
-                    
-                    print("Line: " + line)
-                    
-                    lineCheck = line.split()
-                    
-                    if (lineCheck[0] == 'NICK'):
-
-                        nickReply = self.checkNickMessage(line) # Validation
-
-                        # If client is setting up nickname for the first time and they get an error.
-                        if (nickReply == 'ERR_ERRONEUSNICKNAME' or nickReply == 'ERR_NICKNAMEINUSE') and nickname == '':
-                            conn.sendall((nickReply + '\r\n').encode())
-                            conn.shutdown(socket.SHUT_RDWR) # Terminate connection
-                            conn.close()
-                            return False
-
-                        # Client trying to change nickname and they get an error.
-                        elif (nickReply == 'ERR_ERRONEUSNICKNAME' or nickReply == 'ERR_NICKNAMEINUSE') and nickname != '':
-                            conn.sendall((nickReply + '\r\n').encode())
-
-                        # If client is changing nickname. 
-                        elif nickReply != 'ERR_ERRONEUSNICKNAME' and nickReply != 'ERR_NICKNAMEINUSE' and nickname != '':
-
-                            client.changeNickname(nickReply)
-
-                            conn.sendall((':' + nickname + '!' + nickname + '@' + str(addr[0]) + ' NICK ' + nickReply + '\r\n').encode())
-
-                            self.broadcastNickChange(client, nickname)
-
-                            nickname = nickReply # Success, new nickname
-
-                        else:
-                            nickname = nickReply
-
-                    elif (lineCheck[0] == 'USER' and nickname != ''): # Empty nickname as username can only be set on connection
-                        
-                        replyUser = self.checkUserMessage(line, nickname)
-                        
-                        if replyUser[0] == 'ERR_ERRONEOUSINPUT'and client.getNickname != '':
-                            conn.sendall((replyUser + '\r\n').encode())
-                            conn.shutdown(socket.SHUT_RDWR)
-                            conn.close()
-                            return False
-                        
-                        username = replyUser[0]
-                        realname = replyUser[1]
-
-                        client = Client(nickname, username, realname, conn, addr) 
-                        self.clientList.append(client) # New client registered
-
-                        RPL_WELCOME = ReplyCode('001') # Send welcome message to client
-                        
-                        conn.sendall(('001 ' + nickname + ' :' + RPL_WELCOME.getMessage() + '\r\n').encode())
-                    
-                    elif (lineCheck[0] == 'JOIN' and nickname != ''):
-                        
-                        replyJoin = self.checkJoinMessage(line, client)
-                        targetChannel = None # Set it to empty until they have joined channel (for broadcasting).
-                        
-                        if replyJoin != 'ERR_UNKNOWNCOMMAND' and replyJoin != 'ERR_NOSUCHCHANNEL' and replyJoin != 'ERR_TOOMANYCHANNELS' and replyJoin != 0: # Correct input
-                            
-                            if len(self.channelList) != 0: # Channels exist on server
-                                
-                                for chan in self.channelList:
-
-                                    # If channel exists, add to channel
-                                    if chan.getChannelName() == replyJoin:
-                                        targetChannel = chan
-                                        chan.addClient(client) # Channel object list which stores clients
-                                        client.addToChannel(chan) # Client object list which stores channels
-                                        break
-
-                                # Channel doesn't exists, create and add user
-                                else:
-                                    channel = Channel(replyJoin)
-                                    targetChannel = channel
-                                    self.channelList.append(channel)
-                                    channel.addClient(client)
-                                    client.addToChannel(channel)
-                                    
-                            else: # First channel, create and join it
-                                channel = Channel(replyJoin)
-                                targetChannel = channel
-                                channel.addClient(client)
-                                self.channelList.append(channel)
-                                client.addToChannel(channel)
-
-                            reply = ':' + nickname + '!' + client.getUsername() + '@' + str(addr[0]) + ' JOIN ' + str(replyJoin) + ' * :' + realname
-
-                            # Tell clients (inc. you) in channel that user joined.
-                            self.broadcastToChannel(targetChannel, reply)
-
-                            #Send names list
-                            conn.sendall((self.sendNamesList(targetChannel, client.getNickname()) + '\r\n').encode())
-
-                        elif replyJoin == 0: # Leave all channels
-                            
-                            allClientsChannels = client.getChannels()
-
-                            for chan in allClientsChannels:
-
-                                msg = ':' + nickname + '!' + client.getUsername() + '@' + str(addr[0]) + ' PART ' + chan.getChannelName()
-                                
-                                self.broadcastToChannel(chan, msg) # Tells every user in channel that user is leaving
-                                # Remove from appropriate lists
-                                chan.removeClient(client)
-                                client.leaveChannel(chan)
-
-                            # If client is not in any channel
-                            else:
-                                replyCode = ReplyCode('441')
-                                conn.sendall((replyCode.getMessage() + '\r\n').encode())
-
-                        else:
-                            conn.sendall((replyJoin + '\r\n').encode())
-
-                    elif (lineCheck[0] == 'PRIVMSG' and nickname != ''):
-
-                        replyMessage = self.checkPrivMessage(line, client)
-
-                        if replyMessage[2]: # True, broadcast to channel
-                            
-                            cList = replyMessage[1].getClientList() # Get clients in user input channel
-
-                            for c in cList:
-                                
-                                if c == client: # Don't send message to yourself
-                                    continue
-                                
-                                (targetConn, targetAddress) = c.getClientSocket()
-
-                                targetConn.send((replyMessage[0] + '\r\n').encode()) # For each client
-
-                        else: # If there is error in message, send error to client only
-                            (targetConn, targetAddress) = replyMessage[1].getClientSocket() # Get targets socket object
-
-                            targetConn.send((replyMessage[0] + '\r\n').encode())
-
-                    elif (lineCheck[0] == 'PART' and nickname != ''):
-
-                        replyPart = self.checkPartMessage(line, client)
-                        conn.sendall((replyPart + '\r\n').encode())
-                    
-                    elif (lineCheck[0] == 'QUIT'):
-                        
-                        msg = self.checkQuitMessage(line)
-                        conn.sendall((msg + '\r\n').encode())
-                        conn.shutdown(socket.SHUT_RDWR)
-                        conn.close() # Close socket
-
-                        self.clientDisconnected(line, client)
-
-                        return False # Terminate
-
-                    elif lineCheck[0] == 'WHO' and nickname != '':
-                        
-                        msg = self.checkWhoMessage(line, client)
-                        conn.sendall(msg.encode())
-                        
-                    elif (lineCheck[0] == 'CAP' or lineCheck[0] == 'MODE'): # Server doesn't support these commands, next line
-                        continue
-
-                    else: # Unknown command
-                        replycode = ReplyCode('421')
-                        conn.sendall((replycode.getMessage() + '\r\n').encode())
-
-    # Sets up socket and handles incoming clients.
-    def socket(self):
-        
-        # Connects socket using ipv6.
-        with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as s:
-            
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Allows to reuse socket.
-            
-            s.bind((self.HOST, self.PORT))
-            print ('Socket successfully created at port: ' + str(self.PORT))
-            s.listen(5) # Buffer which stores max 5 clients waiting to connect.
-            
-            threads = list() # Stores a list of active thread (1 thread for each client).
-            
-            while True:
-                
-                conn, addr = s.accept() # Accepts new client
+            if not received: # Peer closed the connection
+                self.connectionLost(client)
+                return False
 
-                # Handle client in new thread
-                x = threading.Thread(target=self.handleClient, args=(conn, addr))
-                threads.append(x)
-                x.start()
-                
-                # If client has disconnected and thread is finished
-                for t in threads:
-                    if not t.is_alive():
-                        t.join()
+            self.metrics.bytesIn += received
+            pending.extend(framer.feed(data))
+            delay = self.handleLines(client, pending)
 
-# ErrorCode class handles error codes that are sent to the client
-class ReplyCode:
-    
-    # Constructor
-    def __init__(self, id):
-        
-        replies = [
-            ['001', 'Welcome to the internet relay network'],
-            ['401', 'ERR_NOSUCHNICK'],
-            ['403', 'ERR_NOSUCHCHANNEL'],
-            ['404', 'ERR_CANNOTSENDTOCHAN'],
-            ['405', 'ERR_TOOMANYCHANNELS'],
-            ['412', 'ERR_NOTEXTTOSEND'],
-            ['421', 'ERR_UNKNOWNCOMMAND'],
-            ['432', 'ERR_ERRONEUSNICKNAME'],
-            ['433', 'ERR_NICKNAMEINUSE'],
-            ['441', 'ERR_USERNOTINCHANNEL'],
-            ['461', 'ERR_NEEDMOREPARAMS']
-            ]
-        self.errorID = id
+            if delay is not None and self.checkRecvQueue(client, pending):
+                return False # Terminate
 
-        # Return error name corresponding to error ID
-        for i in replies:
-            if i[0] == self.errorID:
-                self.errorMessage = i[1]
+        return False
 
-    # returns message to be sent
-    def getMessage(self):
-        return (self.errorMessage)
-    
-# Channel class holds information about the channels on a server
-class Channel:
-    
-    # Constructor
-    def __init__(self, name):
-        self.channelName = name
-        self.clientList = [] # Stores list of clients connected to channel
+    # Checks a client whose timer has expired: drops it if it hasn't registered in time or didn't answer a PING, sends a PING if it has
+    # been idle, and otherwise sets the timer again for when it will have been idle for PING_INTERVAL.
+    def checkLiveness(self, client):
 
-    def getChannelName(self):
-        return self.channelName
+        if client not in self.connections: # Disconnected since the timer expired
+            return
 
-    def addClient(self, client):
-        self.clientList.append(client)
-        print('Added ' + client.getNickname() + ' to ' + self.channelName)
+        now = time.monotonic()
+        delay = None
 
-    def removeClient(self, client):
-        if client in self.clientList:
-            self.clientList.remove(client)
-            print('Removed ' + client.getNickname() + ' from ' + self.channelName)
+        if not client.isRegistered():
+            self.timeoutStats['registration'] += 1
+            self.dropClient(client, 'Registration timeout')
 
-    def getClientList(self):
-        return self.clientList
+        elif client.pingSentAt and client.lastActive < client.pingSentAt: # No answer yet
+
+            waited = now - client.pingSentAt
+
+            if waited >= self.PING_TIMEOUT:
+                self.timeoutStats['ping'] += 1
+                self.dropClient(client, 'Ping timeout: %d seconds' % (now - client.lastActive))
+            else:
+                delay = self.PING_TIMEOUT - waited
+
+        elif now - client.lastActive >= self.PING_INTERVAL:
+            client.pingSentAt = now
+            self.timeoutStats['pings'] += 1
+            client.getClientSocket()[0].sendall(('PING :' + self.serverName + '\r\n').encode())
+            delay = self.PING_TIMEOUT
 
-    def isEmpty(self): # Check if channel has no users
-        if len(self.clientList) == 0:
-            return True
         else:
+            client.pingSentAt = 0.0
+            delay = self.PING_INTERVAL - (now - client.lastActive)
+
+        if delay is None or client.getClientSocket()[0].closeReason is not None: # Dropped, e.g. the PING overflowed its SendQ
+            return
+
+        self.timers.schedule(client, delay, self.TIMER_TICK)
+
+        if client not in self.connections: # Its reader finished in the meantime and may have removed the timer before it was set
+            self.timers.remove(client)
+
+    # Disconnects a client the server has given up on. The thread or protocol reading the connection sees it end and cleans up with
+    # reason as the QUIT message, so the client's channels are only changed from there.
+    def dropClient(self, client, reason):
+
+        log.info('%s, dropping %s', reason, client.getNickname() or client.getClientAddress())
+
+        conn = client.getClientSocket()[0]
+        conn.closeReason = reason
+        conn.abort(('ERROR :Closing Link: ' + reason + '\r\n').encode())
+
+    # Runs the clients whose timers expire in the next slot of the timing wheel, called every TIMER_TICK seconds
+    def runTimers(self):
+
+        if self.frozen: # Handing over, the clients belong to the new process now
+            return
+
+        for client in self.timers.advance():
+            self.checkLiveness(client)
+
+    # Handles queued lines until the client runs out of flood tokens. Returns how long to wait before handling the rest (0 once they are all
+    # handled), or None when the connection has been closed.
+    def handleLines(self, client, pending):
+
+        started = self.startBatch()
+        batch = self.batches
+
+        try:
+            while pending:
+
+                delay = self.getFloodDelay(client)
+
+                if delay > 0:
+                    return delay
+
+                if not self.handleLine(client, pending.popleft()):
+                    return None
+
+                batch.lines += 1
+
+                if batch.lines >= self.COALESCE_LINES: # Keeps the wait for the first lines short
+                    self.flushBatch()
+
+            return 0
+        finally:
+            if started:
+                self.endBatch()
+
+    # Starts a batch on this thread, see COALESCE_LINES. Returns False if one is already running, which then takes the output.
+    def startBatch(self):
+
+        if getattr(self.batches, 'sockets', None) is not None:
+            return False
+
+        self.batches.sockets = []
+        self.batches.lines = 0
+        return True
+
+    # asyncio mode, starts a batch for this pass of the event loop unless there is one, it ends at the start of the next pass
+    def startLoopBatch(self):
+
+        if self.startBatch():
+            self.loop.call_soon(self.endBatch)
+
+    # Called by a SendQueue with its lock held. Returns True if there is a batch running on this thread, which then writes
+    # conn when it ends.
+    def deferWrite(self, conn):
+
+        sockets = getattr(self.batches, 'sockets', None)
+
+        if sockets is None:
             return False
 
-server = Server("Team5") # Creates instance of our test server
+        conn.deferred = True
+        sockets.append(conn)
+        return True
+
+    # Writes the clients that got output in the batch so far, one send each
+    def flushBatch(self):
+
+        sockets = self.batches.sockets
+        self.batches.sockets = []
+        self.batches.lines = 0
+
+        for conn in sockets:
+            conn.writeDeferred()
+
+    def endBatch(self):
+        self.flushBatch()
+        self.batches.sockets = None
+
+    # Takes cost tokens from the client's bucket. The balance may go negative, the client is then throttled until it has refilled.
+    def chargeFlood(self, client, cost, now=None):
+
+        if now is None:
+            now = time.monotonic()
+
+        tokens = min(self.FLOOD_BURST, client.tokens + (now - client.tokensAt) * self.FLOOD_RATE)
+
+        if tokens - cost < 0 <= tokens: # Throttled from now on
+            self.floodStats['throttled'] += 1
+
+        client.tokens = tokens - cost
+        client.tokensAt = now
+
+    # Seconds until the client's bucket is back to zero
+    def getFloodDelay(self, client):
+
+        if client.tokens >= 0:
+            return 0
+
+        tokens = client.tokens + (time.monotonic() - client.tokensAt) * self.FLOOD_RATE
+        return 0 if tokens >= 0 else -tokens / self.FLOOD_RATE
+
+    # Disconnects a client whose held back input has grown over FLOOD_RECVQ bytes. Returns True if it was disconnected.
+    def checkRecvQueue(self, client, pending):
+
+        if len(pending) < self.FLOOD_RECVQ // 510 or sum(map(len, pending)) <= self.FLOOD_RECVQ: # Lines are at most 510 bytes, skip the sum for short queues
+            return False
+
+        self.floodStats['killed'] += 1
+        log.warning('Excess flood from %s, disconnecting', client.getNickname() or client.getClientAddress())
+
+        conn = client.getClientSocket()[0]
+        conn.sendall(b'ERROR :Closing Link: Excess Flood\r\n')
+        conn.shutdown(socket.SHUT_RDWR)
+        conn.close()
+
+        if client.isRegistered():
+            self.clientDisconnected('QUIT :Excess Flood', client)
+
+        return True
+
+    # Cleans up after a connection which was dropped without a QUIT message.
+    def connectionLost(self, client):
+
+        if client.isRegistered():
+            self.clientDisconnected('QUIT :' + (client.getClientSocket()[0].closeReason or '[Errno 104] Connection reset by peer'), client)
+
+    # Outbound queue depth (bytes, lines) of every local client, with the dropped message and evicted client counts
+    def getSendQueueReport(self):
+
+        depths = {}
+
+        for client in self.clients:
+            if not client.isRemote():
+                depths[client.getNickname()] = client.getClientSocket()[0].getQueueDepth()
+
+        return (depths, dict(self.sendqStats))
+
+    # Logs the recently received lines (oldest first) and returns them. Sent SIGUSR1, a running server dumps its ring to the log.
+    def dumpTraffic(self):
+
+        lines = list(self.traffic)
+        log.info('Last %d received lines:', len(lines))
+
+        for (received, nickname, rawLine) in lines:
+            log.info('%s %s: %s', time.strftime('%H:%M:%S', time.localtime(received)), nickname or '*', rawLine.decode('utf-8', 'replace'))
+
+        return lines
+
+    # Starts the background log writer for this process and installs the SIGUSR1 traffic dump.
+    def startLogging(self):
+
+        self.traffic = collections.deque(self.traffic, maxlen=self.TRAFFIC_LINES)
+        self.logListener = startLogging(self.LOG_LEVEL)
+
+        if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread(): # Not on Windows or when embedded
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dumpTraffic())
+
+    # Starts the Prometheus text endpoint if METRICS_PORT or METRICS_PATH is set. Workers add their id to the port or path.
+    def startMetrics(self):
+
+        if self.metricsSocket is not None: # Taken over by a hot restart
+            listener = self.metricsSocket
+        elif self.METRICS_PORT is not None:
+            port = self.METRICS_PORT + (self.workerId or 0)
+            listener = socket.create_server(('localhost', port))
+        elif self.METRICS_PATH is not None:
+            path = self.METRICS_PATH if self.workerId is None else self.METRICS_PATH + '.' + str(self.workerId)
+
+            if os.path.exists(path):
+                os.unlink(path) # Left over from an earlier run
+
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(path)
+            listener.listen()
+        else:
+            return
+
+        self.metricsSocket = listener
+        MetricsListener(self, listener).start()
+
+    # Adds a command to the dispatch table. Handlers are called with the client and the parsed Message and return False when they closed the connection.
+    def registerCommand(self, command, handler, needsRegistration=True):
+        self.commands[command] = (handler, needsRegistration)
+        self.metrics.addCommand(command)
+
+    # Processes one line (bytes, without CR LF) from a client. Shared by the threaded and asyncio modes, returns False when the connection has been closed.
+    def handleLine(self, client, rawLine):
+
+        message = parseMessage(rawLine)
+
+        if message is None: # Empty line
+            return True
+
+        self.traffic.append((time.time(), client.nickname, rawLine))
+
+        if log.isEnabledFor(logging.DEBUG): # Sampled, logging every line would cost more than handling it
+            self.linesSeen += 1
+
+            if self.linesSeen % self.LOG_SAMPLE == 0:
+                log.debug('Line from %s: %s', client.nickname, rawLine.decode('utf-8', 'replace'))
+
+        now = time.monotonic()
+        client.lastActive = now
+        self.chargeFlood(client, self.COMMAND_COSTS.get(message.command, 1), now)
+
+        entry = self.commands.get(message.command)
+
+        if entry is None: # Unknown command
+            self.sendReply(client, ReplyCode('421', message.command))
+            return True
+
+        (handler, needsRegistration) = entry
+
+        if needsRegistration and not client.isRegistered(): # NICK and USER must come first
+            self.sendReply(client, ReplyCode('451'))
+            return True
+
+        start = time.perf_counter()
+        result = handler(client, message)
+        self.metrics.commandDone(message.command, client, time.perf_counter() - start)
+
+        return result is not False
+
+    # Sends a numeric reply, ':server NNN nick params :text'
+    def sendReply(self, client, reply, text=None):
+        client.getClientSocket()[0].sendall(reply.render(self, client, text))
+
+    def onNick(self, client, message):
+
+        (conn, addr) = client.getClientSocket()
+        nickname = client.getNickname()
+
+        nickReply = self.checkNickMessage(message, client) # Validation
+
+        # If client is setting up nickname for the first time and they get an error.
+        if isinstance(nickReply, ReplyCode) and nickname == '':
+            self.sendReply(client, nickReply)
+            conn.shutdown(socket.SHUT_RDWR) # Terminate connection
+            conn.close()
+            return False
+
+        # Client trying to change nickname and they get an error.
+        elif isinstance(nickReply, ReplyCode):
+            self.sendReply(client, nickReply)
+
+        # If client is changing nickname.
+        elif client.isRegistered():
+
+            if not self.clients.rename(nickname, nickReply, client): # Taken since it was checked
+                self.sendReply(client, ReplyCode('433', nickReply))
+                return
+
+            nickLine = client.getPrefix() + ' NICK ' + nickReply # Old prefix, the cache is dropped by changeNickname
+            client.changeNickname(nickReply)
+
+            conn.sendall((nickLine + '\r\n').encode())
+
+            self.broadcastNickChange(client, nickLine)
+            self.busPublish('NICK', nickname, nickReply, nickLine)
+
+        else:
+            client.changeNickname(nickReply)
+
+    def onUser(self, client, message):
+
+        (conn, addr) = client.getClientSocket()
+        nickname = client.getNickname()
+
+        if nickname == '': # Username can only be set after the nickname
+            self.sendReply(client, ReplyCode('451'))
+            return
+
+        if client.isRegistered():
+            self.sendReply(client, ReplyCode('462'))
+            return
+
+        replyUser = self.checkUserMessage(message, nickname)
+
+        if isinstance(replyUser, ReplyCode):
+            self.sendReply(client, replyUser)
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
+            return False
+
+        client.changeUsername(replyUser[0])
+        client.changeRealname(replyUser[1])
+
+        if not self.clients.add(nickname, client): # Nickname taken since it was checked
+            self.sendReply(client, ReplyCode('433', nickname))
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
+            return False
+
+        client.registered = True
+        self.busPublish('REG', nickname, client.getUsername(), client.getHost(), client.getRealname())
+
+        RPL_WELCOME = ReplyCode('001') # Send welcome message to client
+
+        self.sendReply(client, RPL_WELCOME, RPL_WELCOME.getText() + ' ' + client.getPrefix()[1:])
+
+    def onJoin(self, client, message):
+
+        (conn, addr) = client.getClientSocket()
+        nickname = client.getNickname()
+
+        replyJoin = self.checkJoinMessage(message, client)
+
+        if replyJoin == 0: # Leave all channels
+
+            parted = []
+
+            for chan in list(client.getChannels()):
+
+                msg = client.getPrefix() + ' PART ' + chan.getChannelName()
+
+                self.partChannel(client, chan) # Remove from appropriate lists
+                self.busPublish('PART', nickname, chan.getChannelName(), msg)
+                parted.append((chan, (msg + '\r\n').encode()))
+
+            if parted:
+                self.broadcastBatch(parted) # Tells every user in the channels that user is leaving
+                conn.sendall(b''.join(data for (chan, data) in parted))
+
+        elif isinstance(replyJoin, ReplyCode):
+            self.sendReply(client, replyJoin)
+
+        else: # Correct input
+
+            (joins, errors) = replyJoin
+            joined = [] # (channel, JOIN line)
+
+            for (name, key) in joins:
+
+                targetChannel = self.channels.find(name)
+
+                if targetChannel is not None and targetChannel.hasClient(client): # Already in the channel
+                    continue
+
+                # Max channel limit is 10.
+                if len(client.getChannels()) > 9:
+                    errors.append(ReplyCode('405', name))
+                    continue
+
+                if targetChannel is not None and targetChannel.getKey() not in (None, key):
+                    errors.append(ReplyCode('475', name))
+                    continue
+
+                targetChannel = self.joinChannel(client, name, key)
+
+                reply = client.getPrefix() + ' JOIN ' + targetChannel.getChannelName() + ' * :' + client.getRealname()
+
+                joined.append((targetChannel, (reply + '\r\n').encode()))
+                self.busPublish('JOIN', nickname, targetChannel.getChannelName(), key or '', reply)
+
+            self.chargeFlood(client, max(len(joined) - 1, 0) * self.COMMAND_COSTS.get('JOIN', 1)) # Each channel after the first costs another JOIN
+
+            # Tell the other clients in the channels that user joined, one write each
+            self.broadcastBatch(joined, exclude=client)
+
+            # The client gets its own JOIN followed by the names list and the latest messages for every channel, then the errors
+            replies = [itertools.chain((data,), self.generateNames(client, channel), self.getReplay(channel)) for (channel, data) in joined]
+            replies.extend((reply.render(self, client),) for reply in errors)
+
+            if replies:
+                conn.stream(itertools.chain.from_iterable(replies))
+
+    # PRIVMSG and NOTICE to one or more channels and nicks. A recipient gets the message once however many of the targets it is
+    # reached through, the first target that reaches it names the target in its copy. NOTICE never gets an error reply.
+    def onPrivmsg(self, client, message):
+
+        replyMessage = self.checkPrivMessage(message, client)
+        notice = message.command == 'NOTICE'
+
+        if len(replyMessage) == 1: # Nothing to send
+            if not notice:
+                self.sendReply(client, replyMessage[0])
+
+            return
+
+        (text, channels, clients, errors) = replyMessage
+
+        # Serialized once, only the target name differs between the copies
+        head = client.getPrefixBytes() + b' ' + message.command.encode() + b' '
+        tail = b' :' + text + b'\r\n'
+
+        # Every target after the first costs like another command, large channels cost more
+        self.chargeFlood(client, max(len(channels) + len(clients) - 1, 0) + sum(c.getMemberCount() for c in channels) * self.FANOUT_COST)
+
+        recipients = ()
+
+        if len(channels) == 1 and not clients: # Plain channel message, nobody to deduplicate against
+            (channel, target) = next(iter(channels.items()))
+            data = head + target.encode() + tail
+            remoteMembers = self.broadcastToChannel(channel, data, exclude=client)
+            self.recordHistory(channel, data)
+        elif channels:
+            (recipients, remoteMembers) = self.broadcastToChannels(channels, head, tail, exclude=client)
+        else:
+            remoteMembers = False
+
+        # Not sent back to the sender. Members on other workers get one bus message for all the channels.
+        if remoteMembers:
+            self.busPublish('CHAN', ','.join(channels.values()), client.getNickname(), head.decode('utf-8', 'surrogateescape'), text.decode('utf-8', 'surrogateescape'))
+
+        for (targetClient, target) in clients.items():
+
+            if targetClient in recipients: # Already got it through a channel
+                continue
+
+            (targetConn, targetAddress) = targetClient.getClientSocket() # Get targets socket object
+            targetConn.send(head + target.encode() + tail)
+
+        if not notice:
+            for reply in errors:
+                self.sendReply(client, reply)
+
+    def onPart(self, client, message):
+
+        replyPart = self.checkPartMessage(message, client)
+        client.getClientSocket()[0].sendall(replyPart)
+
+    def onQuit(self, client, message):
+
+        conn = client.getClientSocket()[0]
+
+        msg = self.checkQuitMessage(message)
+        conn.sendall((msg + '\r\n').encode())
+        conn.shutdown(socket.SHUT_RDWR)
+        conn.close() # Close socket
+
+        if client.isRegistered():
+            self.clientDisconnected('QUIT ' + msg, client)
+
+        return False # Terminate
+
+    def onWho(self, client, message):
+
+        lines = self.checkWhoMessage(message, client)
+        client.getClientSocket()[0].stream(lines)
+
+    # Lines replayed to a client joining the channel
+    def getReplay(self, channel):
+
+        if not self.HISTORY_REPLAY or not self.HISTORY_LINES or (channel.history is None and not self.HISTORY_DIR):
+            return ()
+
+        return self.getHistory(channel).getLines(self.HISTORY_REPLAY)
+
+    # CHATHISTORY LATEST|BEFORE|AFTER <channel> *|timestamp=<ISO 8601 time> <limit> sends stored channel messages, oldest first
+    # and exactly as they were sent. LATEST gives the latest ones (after the time if there is one), BEFORE the latest ones before
+    # the time and AFTER the earliest ones after it.
+    def onChathistory(self, client, message):
+
+        args = message.getArguments()
+
+        if len(args) != 4 or args[0].upper() not in ('LATEST', 'BEFORE', 'AFTER') or not args[3].isdigit() or not self.HISTORY_LINES:
+            self.sendReply(client, ReplyCode('461', 'CHATHISTORY'))
+            return
+
+        (subcommand, name, criteria, limit) = (args[0].upper(), args[1], args[2], min(int(args[3]), self.HISTORY_LIMIT))
+        channel = self.channels.find(name)
+
+        if channel is None:
+            self.sendReply(client, ReplyCode('403', name))
+            return
+
+        if not channel.hasClient(client):
+            self.sendReply(client, ReplyCode('442', name))
+            return
+
+        when = None
+
+        if criteria.startswith('timestamp='):
+            try:
+                when = datetime.datetime.fromisoformat(criteria[10:].replace('Z', '+00:00')).timestamp()
+            except ValueError:
+                pass
+
+        if when is None and (subcommand != 'LATEST' or criteria != '*'):
+            self.sendReply(client, ReplyCode('461', 'CHATHISTORY'))
+            return
+
+        history = self.getHistory(channel)
+
+        if subcommand == 'AFTER':
+            lines = history.getLines(limit, after=when, latest=False)
+        elif subcommand == 'BEFORE':
+            lines = history.getLines(limit, before=when)
+        else:
+            lines = history.getLines(limit, after=when)
+
+        client.getClientSocket()[0].stream(lines)
+
+    # NAMES #a,#b lists the members of each channel. Channels that don't exist only get the 366 end of list, and so does NAMES
+    # without channels, which would otherwise list the whole server.
+    def onNames(self, client, message):
+
+        names = message.params[0].split(',') if message.params else ['*']
+        lines = []
+
+        for name in names:
+            channel = self.channels.find(name) if name[:1] in ('#', '&', '+', '!') else None
+
+            if channel is None:
+                lines.append((ReplyCode('366', name).render(self, client),))
+            else:
+                lines.append(self.generateNames(client, channel))
+
+        client.getClientSocket()[0].stream(itertools.chain.from_iterable(lines))
+
+    # LIST [masks and conditions] lists channels and their member counts. Masks are channel names, which may have * and ?
+    # wildcards, >N and <N keep the channels with more or fewer than N members. Streamed, so listing every channel neither
+    # holds up the other clients nor builds the whole reply at once.
+    def onList(self, client, message):
+
+        masks = []
+        (low, high) = (1, sys.maxsize)
+        params = list(message.params)
+
+        if message.trailing is not None:
+            params.append(message.trailing.decode('utf-8', 'replace'))
+
+        for item in ','.join(params).split(','):
+
+            if item[:1] == '>' and item[1:].isdigit():
+                low = max(low, int(item[1:]) + 1)
+            elif item[:1] == '<' and item[1:].isdigit():
+                high = min(high, int(item[1:]) - 1)
+            elif item:
+                masks.append(item)
+
+        client.getClientSocket()[0].stream(self.generateList(client, masks, low, high))
+
+    # WHOIS [server] nick,nick... describes each nick, then 318. A mask answers for up to WHOIS_MATCHES of the nicks it
+    # matches, found through the name index.
+    def onWhois(self, client, message):
+
+        params = list(message.params)
+
+        if message.trailing is not None:
+            params.append(message.trailing.decode('utf-8', 'replace'))
+
+        if not params:
+            self.sendReply(client, ReplyCode('431'))
+            return
+
+        masks = params[-1].split(',')[:self.MAX_TARGETS]
+        self.chargeFlood(client, len(masks) - 1)
+        lines = []
+
+        for mask in masks:
+            targets = list(itertools.islice(self.clients.match(mask), self.WHOIS_MATCHES))
+
+            if not targets:
+                lines.append((ReplyCode('401', mask).render(self, client),))
+
+            for target in targets:
+                lines.append(self.generateWhois(client, target))
+
+            lines.append((ReplyCode('318', mask).render(self, client),))
+
+        client.getClientSocket()[0].stream(itertools.chain.from_iterable(lines))
+
+    # ISON nick nick... replies with the nicks that are online, all looked up at once. Lets clients poll for presence
+    # without messaging the nicks to see which fail.
+    def onIson(self, client, message):
+
+        nicks = list(message.params)
+
+        if message.trailing is not None:
+            nicks += message.trailing.decode('utf-8', 'replace').split()
+
+        if not nicks:
+            self.sendReply(client, ReplyCode('461', 'ISON'))
+            return
+
+        online = dict.fromkeys(target.getNickname().encode() for target in self.clients.findAll(nicks) if target is not None)
+        head = self.numerics['303'] + (client.getNickname() + ' :').encode()
+        client.getClientSocket()[0].sendall(b''.join(packWords(head, online)) or head + b'\r\n')
+
+    # STATS m: command counts and latency, STATS u: uptime, any other query: traffic, fan-out and connection counters
+    def onStats(self, client, message):
+
+        query = message.params[0][:1] if message.params else '*'
+        replies = []
+
+        if query == 'm':
+            for (command, histogram) in self.metrics.commands.items():
+                if histogram.getCount():
+                    text = 'avg %.0fus p99 <= %.0fus' % (histogram.getAverage() * 1e6, histogram.getPercentile(0.99) * 1e6)
+                    replies.append(ReplyCode('212', command, str(histogram.getCount())).render(self, client, text))
+
+        elif query == 'u':
+            uptime = int(time.time() - self.metrics.started)
+            text = 'Server Up %d days %d:%02d:%02d' % (uptime // 86400, uptime // 3600 % 24, uptime // 60 % 60, uptime % 60)
+            replies.append(ReplyCode('242').render(self, client, text))
+
+        else:
+            for line in self.metrics.getSummary(self):
+                replies.append(ReplyCode('249').render(self, client, line))
+
+        replies.append(ReplyCode('219', query).render(self, client))
+        client.getClientSocket()[0].sendall(b''.join(replies))
+
+    def onPing(self, client, message):
+
+        token = message.params[0] if message.params else (message.trailing or b'').decode('utf-8', 'replace')
+        client.getClientSocket()[0].sendall((':' + self.serverName + ' PONG ' + self.serverName + ' :' + token + '\r\n').encode())
+
+    # Any line counts as a sign of life, a PONG only has to clear the pending PING
+    def onPong(self, client, message):
+        client.pingSentAt = 0.0
+
+    # Server doesn't support these commands, next line
+    def onIgnored(self, client, message):
+        pass
+
+    # Starts the server in the selected mode and serves until stop() is called, the process gets SIGTERM or Ctrl-C is pressed.
+    def serve(self, workers=None, takeover=False):
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # Shut down cleanly, through the finally below
+
+        self.start(workers, takeover)
+
+        try:
+            while self.serveThread.is_alive():
+                self.serveThread.join(1.0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    # Opens the listeners and starts serving in the background. Returns once connections are being accepted, except in workers
+    # mode where it returns once the workers have been forked. A stopped server can't be started again. With takeover, the
+    # listeners and clients are taken over from the server running with the same RESTART_PATH instead.
+    def start(self, workers=None, takeover=False):
+
+        self.startLogging()
+
+        if self.TLS_LISTENERS:
+            if self.RESTART_PATH or takeover:
+                raise ValueError('Hot restart does not work with TLS listeners') # TLS sessions can't be handed over
+
+            self.tlsContext = self.createTlsContext() # Before forking, so the workers share the session ticket keys
+
+        if self.mode == 'workers':
+            if self.LINK_LISTEN or self.LINKS:
+                raise ValueError('Server links need the threaded or asyncio mode')
+
+            if self.RESTART_PATH or takeover:
+                raise ValueError('Hot restart needs the threaded or asyncio mode')
+
+            hubSockets = self.forkWorkers(workers or os.cpu_count() or 1)
+            self.serveThread = threading.Thread(target=self.runWorkers, args=(hubSockets,), name='bus-hub')
+            self.serveThread.start()
+            return
+
+        if self.RESTART_PATH and (self.LINK_LISTEN or self.LINKS):
+            raise ValueError('Hot restart does not work with server links') # The other servers' clients can't be handed over
+
+        if takeover:
+            restored = self.takeOver()
+        else:
+            self.listeners = self.openListeners()
+            restored = []
+
+        self.startMetrics()
+
+        if self.RESTART_PATH:
+            self.openRestartListener()
+
+        if self.mode == 'asyncio':
+            self.serveThread = threading.Thread(target=lambda: asyncio.run(self.serveAsync(self.listeners, restored=restored)), name='event-loop')
+            self.serveThread.start()
+            self.ready.wait()
+        else:
+            self.flusher = OutputFlusher(self)
+            self.flusher.start()
+            self.timerThread = TimerThread(self)
+            self.timerThread.start()
+
+            for (client, sock, output) in restored: # Every client needs its socket before any of them broadcasts
+                sock.setblocking(True) # The flag is shared with the old process's copy, which may have been non-blocking
+                client.socket = ThreadedSocket(sock, self)
+
+            for (client, sock, output) in restored: # Carry on from where the old process stopped
+                if output:
+                    client.socket.sendall(output)
+
+                threading.Thread(target=self.handleClient, args=(sock, client), daemon=True).start()
+
+            self.wakeup = socket.socketpair()
+            self.serveThread = threading.Thread(target=self.acceptClients, args=(self.listeners,), name='accept')
+            self.serveThread.start()
+
+        self.startLinks()
+
+    # Stops accepting, disconnects every client and waits for the server to wind down
+    def stop(self):
+
+        if self.stopping or self.serveThread is None:
+            return
+
+        self.stopping = True
+        log.info('Shutting down')
+        self.stopLinks()
+
+        if self.mode == 'asyncio':
+            self.loop.call_soon_threadsafe(self.stopEvent.set)
+        elif self.mode == 'workers':
+            for pid in self.workerPids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        else:
+            self.wakeup[1].send(b'\0')
+
+        self.serveThread.join(5.0)
+
+        for thread in (self.timerThread, self.flusher): # Only after the clients are gone, their last output may need the flusher
+            if thread is not None:
+                thread.stop()
+
+        (self.timerThread, self.flusher) = (None, None)
+
+        if self.wakeup is not None and not self.serveThread.is_alive():
+            for s in self.wakeup:
+                s.close()
+
+        if self.HISTORY_DIR:
+            for channel in self.channels: # Keep the history for the next start
+                if channel.history is not None:
+                    channel.history.close()
+
+        if self.metricsSocket is not None:
+            try:
+                self.metricsSocket.shutdown(socket.SHUT_RDWR) # Wakes up its accept()
+            except OSError:
+                pass
+
+            self.metricsSocket.close()
+
+        if self.restartListener is not None:
+            self.restartListener.close()
+
+            try:
+                os.unlink(self.RESTART_PATH)
+            except OSError:
+                pass
+
+        self.logListener.stop() # Writes out what is still queued
+
+    # Applies settings from a config file or the command line. Names are the upper case attributes set in the constructor.
+    def configure(self, settings):
+
+        for (name, value) in settings.items():
+
+            if not name.isupper() or not hasattr(self, name):
+                raise ValueError('Unknown setting ' + name)
+
+            setattr(self, name, value)
+
+    # TLS server context for the TLS_LISTENERS. Sessions resume from tickets (stateless, encrypted with keys the context makes up
+    # when it is created) and from OpenSSL's session cache for clients without ticket support.
+    def createTlsContext(self):
+
+        if not self.TLS_CERT:
+            raise ValueError('TLS_LISTENERS need TLS_CERT')
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.load_cert_chain(self.TLS_CERT, self.TLS_KEY)
+        return context
+
+    # Loads TLS_CERT and TLS_KEY again, e.g. after the certificate was renewed. New handshakes use them straight away, and
+    # sessions from before still resume since the context and its ticket keys stay the same. A certificate that doesn't load is
+    # logged and the old one kept. Returns True if the certificate was reloaded.
+    def reloadCertificates(self):
+
+        if self.tlsContext is None:
+            return False
+
+        try:
+            ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER).load_cert_chain(self.TLS_CERT, self.TLS_KEY) # A bad pair would leave the context without a key
+
+            with self.tlsLock:
+                self.tlsContext.load_cert_chain(self.TLS_CERT, self.TLS_KEY)
+        except OSError as e: # ssl.SSLError too
+            log.error('Could not reload the TLS certificate, keeping the old one: %s', e)
+            return False
+
+        log.info('Reloaded the TLS certificate from %s', self.TLS_CERT)
+
+        if self.workerId is None:
+            for pid in self.workerPids: # Each worker has its own copy of the context
+                try:
+                    os.kill(pid, signal.SIGHUP)
+                except OSError:
+                    pass
+
+        return True
+
+    # TLS session for a connection accepted on one of the TLS_LISTENERS
+    def newTlsSession(self):
+
+        with self.tlsLock: # The SSL object copies the certificate from the context
+            return TlsSession(self.tlsContext)
+
+    # Addresses to listen on as (host, port), from LISTENERS or else HOST and PORT
+    def getListenAddresses(self):
+
+        if self.LISTENERS is None:
+            return [(self.HOST, self.PORT)]
+
+        return [parseListenAddress(address) if isinstance(address, str) else tuple(address) for address in self.LISTENERS]
+
+    # Creates a bound and listening socket for every address, then for every TLS_LISTENERS address. With reusePort several worker
+    # processes can listen on the same port.
+    def openListeners(self, reusePort=False):
+
+        plainAddresses = self.getListenAddresses()
+        addresses = plainAddresses + [parseListenAddress(address) if isinstance(address, str) else tuple(address) for address in self.TLS_LISTENERS]
+        ipv4Ports = set(port for (host, port) in addresses if ':' not in host)
+        listeners = []
+
+        for (i, (host, port)) in enumerate(addresses):
+
+            (family, kind, proto, canonName, address) = socket.getaddrinfo(host or None, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+            s = socket.socket(family, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Allows to reuse socket.
+
+            if reusePort: # The kernel spreads connections between the workers
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+            if family == socket.AF_INET6: # Only leave IPv4 to the IPv6 socket if there is no IPv4 listener for the port
+                s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, int(port in ipv4Ports))
+
+            # Accepted connections inherit the buffer sizes, and the receive window is chosen before listen()
+            if self.SO_SNDBUF:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SO_SNDBUF)
+
+            if self.SO_RCVBUF:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.SO_RCVBUF)
+
+            s.bind(address)
+            s.listen(self.BACKLOG) # Buffer which stores clients waiting to connect.
+            listeners.append(s)
+
+            if i >= len(plainAddresses):
+                self.tlsListeners.add(s)
+                log.info('Listening on %s port %d (TLS)', address[0], port)
+            else:
+                log.info('Listening on %s port %d', address[0], port)
+
+        return listeners
+
+    # Options for an accepted client socket
+    def setClientSocketOptions(self, sock):
+
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.TCP_NODELAY))
+
+    # Accepts clients on every listener and starts a thread for each of them (threaded mode). Each wakeup accepts up to ACCEPT_BATCH
+    # connections per listener, so a reconnect storm empties the backlog quickly.
+    def acceptClients(self, listeners):
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.wakeup[0], selectors.EVENT_READ, None) # stop() writes to it
+
+        for s in listeners:
+            s.setblocking(False)
+            selector.register(s, selectors.EVENT_READ, s)
+
+        if self.restartListener is not None:
+            selector.register(self.restartListener, selectors.EVENT_READ, None)
+
+        while not self.stopping:
+
+            for (key, events) in selector.select():
+
+                if key.fileobj is self.restartListener:
+                    self.acceptRestart()
+
+                if key.data is None:
+                    continue
+
+                for i in range(self.ACCEPT_BATCH):
+
+                    try:
+                        (conn, addr) = key.data.accept() # Accepts new client
+                    except BlockingIOError: # Backlog is empty
+                        break
+                    except OSError as e: # Out of file descriptors for example, try again on the next wakeup
+                        log.warning('accept failed: %s', e)
+                        break
+
+                    conn.setblocking(True)
+                    self.setClientSocketOptions(conn)
+
+                    # Handle client in new thread, it ends with the connection
+                    client = self.addConnection(conn, addr, key.data in self.tlsListeners)
+                    threading.Thread(target=self.handleClient, args=(conn, client), daemon=True).start()
+
+        selector.close()
+
+        for s in listeners:
+            s.close()
+
+        self.dropAllClients()
+
+        deadline = time.monotonic() + 2.0
+
+        while self.connections and time.monotonic() < deadline: # Give the client threads time to clean up
+            time.sleep(0.01)
+
+    # Disconnects every local connection when shutting down
+    def dropAllClients(self):
+
+        for client in list(self.connections):
+            self.dropClient(client, 'Server shutting down')
+
+    # Timing wheel tick for asyncio mode, runs on the event loop so the checks don't need any locking against the clients
+    def runTimersAsync(self):
+        asyncio.get_running_loop().call_later(self.TIMER_TICK, self.runTimersAsync)
+        self.runTimers()
+
+    # Serves every client on the listeners from a single asyncio event loop, until stopEvent is set. restored are the clients
+    # taken over by a hot restart, as (client, socket, output not written yet).
+    async def serveAsync(self, listeners, busSocket=None, restored=()):
+
+        raiseFileLimit() # Each connection needs a file descriptor
+
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+        self.stopEvent = asyncio.Event()
+
+        if busSocket is not None:
+            (self.bus, protocol) = await loop.create_unix_connection(lambda: BusProtocol(self), sock=busSocket)
+            loop.add_signal_handler(signal.SIGTERM, self.stopEvent.set) # Sent by the parent to stop the worker
+
+        # All at once, the clients have been waiting since the old process stopped
+        await asyncio.gather(*[loop.connect_accepted_socket(lambda client=client, output=output: ClientProtocol(self, client, output), sock) for (client, sock, output) in restored])
+
+        if self.tlsListeners:
+            self.handshakePool = concurrent.futures.ThreadPoolExecutor(self.TLS_HANDSHAKE_THREADS, thread_name_prefix='tls-handshake')
+
+        # asyncio accepts up to backlog connections per wakeup
+        servers = []
+
+        for s in listeners:
+            if s in self.tlsListeners:
+                factory = lambda: ClientProtocol(self, session=self.newTlsSession())
+            else:
+                factory = lambda: ClientProtocol(self)
+
+            servers.append(await loop.create_server(factory, sock=s, backlog=self.BACKLOG))
+        loop.call_later(self.TIMER_TICK, self.runTimersAsync)
+
+        if self.restartListener is not None:
+            loop.add_reader(self.restartListener, self.acceptRestart)
+
+        if self.workerId is not None:
+            log.info('Worker %d serving (asyncio)', self.workerId)
+
+        self.ready.set()
+        await self.stopEvent.wait()
+
+        # Connections accepted in the last loop pass only get their transport now, and Server.close() makes that fail
+        # without closing the socket. Let them through first, connection_made() drops them since stopping is set.
+        await asyncio.sleep(0.05)
+
+        for listener in servers:
+            listener.close()
+
+        self.dropAllClients()
+
+        deadline = time.monotonic() + 2.0
+
+        while self.connections and time.monotonic() < deadline: # Let the transports flush and close
+            await asyncio.sleep(0.01)
+
+        if self.handshakePool is not None:
+            self.handshakePool.shutdown(wait=False)
+
+    # Forks the asyncio workers. Each one listens on the same ports with SO_REUSEPORT and shares nick and channel state over the bus.
+    # Returns the hub end of each worker's bus connection.
+    def forkWorkers(self, workers):
+
+        hubSockets = []
+
+        for workerId in range(workers):
+
+            (hubEnd, workerEnd) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            pid = os.fork()
+
+            if pid == 0: # Worker process
+                hubEnd.close()
+
+                for other in hubSockets:
+                    other.close()
+
+                self.workerId = workerId
+                self.startLogging() # The parent's writer thread doesn't survive the fork
+
+                try:
+                    listeners = self.openListeners(reusePort=True)
+                    self.startMetrics()
+                    asyncio.run(self.serveAsync(listeners, workerEnd))
+                finally:
+                    self.logListener.stop()
+                    os._exit(0)
+
+            workerEnd.close()
+            hubSockets.append(hubEnd)
+            self.workerPids.append(pid)
+
+        return hubSockets
+
+    # Runs the bus hub until every worker has exited
+    def runWorkers(self, hubSockets):
+
+        try:
+            self.runBusHub(hubSockets)
+        finally:
+            for pid in self.workerPids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+
+    # Relays bus events between workers. Each event is one line, addressed to one worker or to all of them ('*').
+    def runBusHub(self, hubSockets):
+
+        selector = selectors.DefaultSelector()
+        buffers = {}
+
+        for (workerId, sock) in enumerate(hubSockets):
+            selector.register(sock, selectors.EVENT_READ, workerId)
+            buffers[workerId] = b''
+
+        while buffers:
+
+            outgoing = {} # Batched writes per worker for this wakeup
+
+            for (key, events) in selector.select():
+
+                workerId = key.data
+
+                try:
+                    data = key.fileobj.recv(262144)
+                except OSError:
+                    data = b''
+
+                if not data: # Worker exited, the others drop its clients
+                    selector.unregister(key.fileobj)
+                    del buffers[workerId]
+                    lines = [b'* SPLIT']
+                else:
+                    lines = (buffers[workerId] + data).split(b'\n')
+                    buffers[workerId] = lines.pop() # Incomplete line
+
+                origin = str(workerId).encode() + b'\t'
+
+                for line in lines:
+
+                    (dest, sep, payload) = line.partition(b' ')
+                    event = origin + payload + b'\n'
+
+                    if dest == b'*':
+                        for other in buffers:
+                            if other != workerId:
+                                outgoing.setdefault(other, []).append(event)
+
+                    elif int(dest) in buffers:
+                        outgoing.setdefault(int(dest), []).append(event)
+
+            for (workerId, events) in outgoing.items():
+                try:
+                    hubSockets[workerId].sendall(b''.join(events))
+                except OSError:
+                    pass
+
+    # Sends an event to the other workers, or to the other servers when linked. Does nothing for a lone server.
+    def busPublish(self, *fields, dest='*'):
+
+        if self.bus is not None:
+            self.bus.write((str(dest) + ' ' + '\t'.join(fields) + '\n').encode('utf-8', 'surrogateescape'))
+        elif self.links:
+            self.linkSend(getLinkLine(dest, self.serverName, fields))
+
+    # Resolves two workers, or two servers, claiming the same nick at once. The claim from the lower worker id or server name wins
+    # everywhere, so all replicas agree without another round trip.
+    def claimNick(self, nickname, origin):
+
+        holder = self.clients.find(nickname)
+
+        if holder is None:
+            return True
+
+        holderWorker = holder.worker if holder.isRemote() else (self.serverName if self.workerId is None else self.workerId)
+
+        if holderWorker < origin: # Existing claim wins, the origin worker drops its own client
+            return False
+
+        if holder.isRemote():
+            self.removeRemoteClient(holder, holder.getPrefix() + ' QUIT :Nick collision')
+        else: # The nick is free for the winner now, the rest is cleaned up like any dropped client, on the client's own thread
+            self.sendReply(holder, ReplyCode('433', nickname))
+            self.clients.remove(nickname, holder)
+            self.dropClient(holder, 'Nick collision')
+
+        return True
+
+    # Removes a client of another worker and tells local clients it has quit.
+    def removeRemoteClient(self, client, quitLine):
+
+        self.broadcastQuitMessage(client, quitLine)
+
+        for c in list(client.getChannels()):
+            self.partChannel(client, c)
+
+        self.clients.remove(client.getNickname(), client)
+
+    # Applies an event from another worker to the local copy of the shared state and delivers it to local clients.
+    def busReceived(self, origin, command, args):
+
+        if command == 'TO': # Private message for a local client
+            target = self.clients.find(args[0])
+
+            if target is not None and not target.isRemote():
+                target.getClientSocket()[0].sendall((args[1] + '\r\n').encode('utf-8', 'surrogateescape'))
+
+            return
+
+        if command == 'CHAN': # Channel message, delivered to local members once each
+            channels = {}
+
+            for target in args[0].split(','):
+                channel = self.channels.find(target)
+
+                if channel is not None:
+                    channels.setdefault(channel, target)
+
+            # The sender is remote so it isn't delivered to
+            self.broadcastToChannels(channels, args[2].encode('utf-8', 'surrogateescape'), b' :' + args[3].encode('utf-8', 'surrogateescape') + b'\r\n')
+            return
+
+        if command == 'REG':
+            if self.claimNick(args[0], origin):
+                self.clients.add(args[0], RemoteClient(args[0], args[1], args[3], self, origin, (args[2], 0)))
+
+            return
+
+        if command == 'SPLIT': # Worker exited or server split from the network
+            reason = 'Worker exited' if self.workerId is not None else self.serverName + ' ' + origin
+
+            for c in self.clients:
+                if c.isRemote() and c.worker == origin:
+                    self.removeRemoteClient(c, c.getPrefix() + ' QUIT :' + reason)
+
+            return
+
+        client = self.clients.find(args[0])
+
+        if client is None or not client.isRemote() or client.worker != origin: # Lost a nick collision here
+            return
+
+        if command == 'NICK':
+            if not self.claimNick(args[1], origin):
+                self.removeRemoteClient(client, client.getPrefix() + ' QUIT :Nick collision')
+                return
+
+            self.clients.rename(args[0], args[1], client)
+            client.changeNickname(args[1])
+            data = (args[2] + '\r\n').encode()
+            notified = set()
+
+            for chan in client.getChannels():
+                for c in chan.getClientList():
+                    if not c.isRemote() and c not in notified:
+                        notified.add(c)
+                        c.getClientSocket()[0].sendall(data)
+
+        elif command == 'JOIN':
+            channel = self.channels.find(args[1])
+
+            if channel is not None and channel.hasClient(client): # Already known, e.g. from a burst that overlapped the live JOIN
+                return
+
+            channel = self.joinChannel(client, args[1], args[2] or None)
+            self.broadcastToChannel(channel, args[3])
+
+        elif command == 'PART':
+            channel = self.channels.find(args[1])
+
+            if channel is not None and channel.hasClient(client):
+                self.partChannel(client, channel)
+                self.broadcastToChannel(channel, args[2])
+
+        elif command == 'QUIT':
+            self.removeRemoteClient(client, args[1])
+
+    # Listens on RESTART_PATH for a new process to hand over to
+    def openRestartListener(self):
+
+        if os.path.exists(self.RESTART_PATH):
+            os.unlink(self.RESTART_PATH) # Left over from an earlier run, or the old process's after a takeover
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.RESTART_PATH)
+        listener.listen()
+        listener.setblocking(False)
+        self.restartListener = listener
+
+    # A new process connected to RESTART_PATH. Stops the readers, passes it the sockets and the state, and exits once it confirms
+    # it has them, or else carries on. Runs on the accept thread or the event loop, so nothing is accepted meanwhile.
+    def acceptRestart(self):
+
+        try:
+            (conn, addr) = self.restartListener.accept()
+        except OSError:
+            return
+
+        with conn:
+            conn.setblocking(True)
+            start = time.perf_counter()
+
+            if not self.freezeReaders():
+                log.warning('Hot restart failed, some readers did not stop')
+                self.thawReaders()
+                return
+
+            try:
+                (state, fds) = self.getRestartState()
+                frozenFor = time.perf_counter() - start
+                sendHandoff(conn, state, fds)
+                conn.settimeout(self.RESTART_TIMEOUT)
+
+                if conn.recv(2) != b'OK':
+                    raise ConnectionError('the new process did not confirm')
+            except OSError as e:
+                log.warning('Hot restart failed, carrying on: %s', e)
+                self.thawReaders()
+                return
+
+        log.info('Handed %d clients and %d channels over, state taken in %.1f ms, %.1f ms in all. Exiting', len(state['clients']), len(state['channels']), frozenFor * 1e3, (time.perf_counter() - start) * 1e3)
+        self.logListener.stop()
+        os._exit(0) # Without closing the connections, the new process has them
+
+    # Waits until no reader thread is handling input and stops the output flusher (threaded mode), so the state holds still while
+    # it is handed over. Nothing else runs on the event loop meanwhile in asyncio mode. False if some reader didn't stop in time.
+    def freezeReaders(self):
+
+        if self.mode != 'threaded':
+            return True
+
+        self.flusher.running.acquire()
+
+        with self.thaw:
+            self.frozen = True
+            return self.thaw.wait_for(lambda: self.busyReaders == 0, 2.0)
+
+    def thawReaders(self):
+
+        if self.mode != 'threaded':
+            return
+
+        with self.thaw:
+            self.frozen = False
+            self.thaw.notify_all()
+
+        self.flusher.running.release()
+
+    # What a new process needs to carry on, with the file descriptors to pass it: the listeners, the metrics socket and the client
+    # sockets in that order. A client is a list in the order restoreState() unpacks it rather than an object, which makes the
+    # document half the size and much faster to write and read. Bytes are sent as latin-1 strings, which JSON keeps as they are.
+    def getRestartState(self):
+
+        now = time.monotonic()
+        clients = list(self.connections)
+        channels = list(self.channels)
+        clientIndex = dict((client, i) for (i, client) in enumerate(clients))
+        channelIndex = dict((channel, i) for (i, channel) in enumerate(channels))
+        clientEntries = []
+        fds = [s.fileno() for s in self.listeners] + ([self.metricsSocket.fileno()] if self.metricsSocket is not None else [])
+
+        for client in clients:
+
+            (framer, pending) = self.connections[client]
+            conn = client.getClientSocket()[0]
+
+            with conn.lock:
+                output = conn.getUnsent()
+
+            fds.append(conn.fileno())
+            clientEntries.append([
+                client.nickname,
+                client.username,
+                client.realname,
+                client.host,
+                client.port,
+                client.registered,
+                [channelIndex[channel] for channel in client.getChannels() if channel in channelIndex],
+                min(self.FLOOD_BURST, client.tokens + (now - client.tokensAt) * self.FLOOD_RATE),
+                now - client.lastActive,
+                now - client.pingSentAt if client.pingSentAt else None,
+                framer.buffer.decode('latin-1') if framer.buffer else '', # Partial line
+                framer.discarding,
+                [line.decode('latin-1') for line in pending],
+                output.decode('latin-1') if output else '',
+            ])
+
+        channelEntries = []
+
+        for channel in channels:
+            channelEntries.append([
+                channel.getChannelName(),
+                channel.getKey(),
+                [clientIndex[client] for client in channel.getClientList() if client in clientIndex],
+                [(when, data.decode('latin-1')) for (when, data) in channel.history.getEntries()] if channel.history is not None else [],
+            ])
+
+        state = {'listeners': len(self.listeners), 'metrics': self.metricsSocket is not None, 'clients': clientEntries, 'channels': channelEntries}
+        return (state, fds)
+
+    # Takes the listeners and clients over from the server running with the same RESTART_PATH. Returns what restoreState() returns.
+    def takeOver(self):
+
+        start = time.perf_counter()
+        raiseFileLimit()
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(self.RESTART_PATH)
+            (state, fds) = receiveHandoff(conn)
+            conn.sendall(b'OK') # The old process exits, the sockets are only ours now
+
+        received = time.perf_counter()
+        restored = self.restoreState(state, fds)
+        log.info('Took over %d clients and %d channels, %.1f ms to receive them and %.1f ms to restore them', len(restored), len(state['channels']), (received - start) * 1e3, (time.perf_counter() - received) * 1e3)
+        return restored
+
+    # Rebuilds the listeners, nicks, channels and history from getRestartState(). Returns (client, socket, output not written yet)
+    # for every client, to be served from where the old process stopped.
+    def restoreState(self, state, fds):
+
+        sockets = [socket.socket(fileno=fd) for fd in fds[:state['listeners'] + state['metrics']]]
+        self.listeners = sockets[:state['listeners']]
+
+        if state['metrics']:
+            self.metricsSocket = sockets[-1]
+
+        now = time.monotonic()
+        clients = []
+        restored = []
+
+        for (entry, fd) in zip(state['clients'], fds[len(sockets):]):
+
+            (nickname, username, realname, host, port, registered, channels, tokens, idle, pinged, partial, discarding, pending, output) = entry
+            family = socket.AF_INET6 if ':' in host else socket.AF_INET # Given, so the socket doesn't have to be asked
+            client = Client(nickname, username, realname, None, (host, port))
+            client.registered = registered
+            client.tokens = tokens
+            client.tokensAt = now
+            client.lastActive = now - idle
+            client.pingSentAt = now - pinged if pinged is not None else 0.0
+
+            framer = LineFramer()
+            framer.buffer += partial.encode('latin-1')
+            framer.discarding = discarding
+            self.connections[client] = (framer, collections.deque(line.encode('latin-1') for line in pending))
+
+            if registered:
+                self.clients.add(nickname, client)
+                self.timers.schedule(client, max(self.TIMER_TICK, self.PING_INTERVAL - idle), self.TIMER_TICK)
+            else:
+                self.timers.schedule(client, self.REGISTRATION_TIMEOUT, self.TIMER_TICK)
+
+            clients.append(client)
+            restored.append((client, socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP, fd), output.encode('latin-1')))
+
+        channels = []
+
+        for (name, key, members, history) in state['channels']:
+
+            channel = Channel(name, key)
+            channel.members = dict.fromkeys(clients[i] for i in members)
+            channel.snapshot = None
+            self.channels.add(name, channel)
+            self.memberCounts.update(channel)
+            channels.append(channel)
+
+            for (when, line) in history:
+                self.getHistory(channel).append(line.encode('latin-1'), when)
+
+        for (client, entry) in zip(clients, state['clients']):
+            for i in entry[6]:
+                client.addToChannel(channels[i])
+
+        return restored
+
+    # Calls func on the thread that owns the server state: the event loop in asyncio mode, the calling thread otherwise
+    def runOnLoop(self, func, *args):
+
+        if self.mode != 'asyncio':
+            func(*args)
+            return
+
+        try:
+            self.loop.call_soon_threadsafe(func, *args)
+        except RuntimeError: # Loop already closed, shutting down
+            pass
+
+    # Listens on LINK_LISTEN and connects to the LINKS servers, every link connection has a thread reading it
+    def startLinks(self):
+
+        if self.LINK_LISTEN is None and not self.LINKS:
+            return
+
+        if self.flusher is None: # Links are written like threaded mode clients, in asyncio mode too
+            self.flusher = OutputFlusher(self)
+            self.flusher.start()
+
+        if self.LINK_LISTEN is not None:
+            (host, port) = parseListenAddress(self.LINK_LISTEN)
+            self.linkListener = socket.create_server((host, port), family=socket.AF_INET6 if ':' in host else socket.AF_INET)
+            log.info('Accepting server links on %s port %d', host, port)
+            threading.Thread(target=self.acceptLinks, name='link-accept', daemon=True).start()
+
+        for address in self.LINKS:
+            threading.Thread(target=self.connectLink, args=(parseListenAddress(address),), name='link-' + address, daemon=True).start()
+
+    def stopLinks(self):
+
+        self.linksStopped.set()
+
+        if self.linkListener is not None:
+            try:
+                self.linkListener.shutdown(socket.SHUT_RDWR) # Wakes up its accept()
+            except OSError:
+                pass
+
+            self.linkListener.close()
+
+        for link in list(self.linkConnections):
+            link.abort()
+
+    def acceptLinks(self):
+
+        while True:
+
+            try:
+                (sock, address) = self.linkListener.accept()
+            except OSError: # Closed by stopLinks()
+                return
+
+            threading.Thread(target=self.runLink, args=(sock, address), name='link', daemon=True).start()
+
+    # Keeps a link to address up, reconnecting LINK_RETRY seconds after it is lost or refused
+    def connectLink(self, address):
+
+        while not self.linksStopped.is_set():
+
+            try:
+                sock = socket.create_connection(address, timeout=5.0)
+                sock.settimeout(None)
+            except OSError as e:
+                log.warning('Link to %s port %d failed: %s', address[0], address[1], e)
+            else:
+                self.runLink(sock, address)
+
+            self.linksStopped.wait(self.LINK_RETRY)
+
+    # Reads a link connection until it closes. Both ends start with 'SERVER name password', every line after that is an event.
+    def runLink(self, sock, address):
+
+        self.setClientSocketOptions(sock)
+        link = Link(self, sock, address)
+        self.linkConnections.add(link)
+        buffer = b''
+
+        try:
+            link.send(('SERVER\t' + self.serverName + '\t' + (self.LINK_PASSWORD or '') + '\n').encode())
+
+            while True:
+                data = sock.recv(262144)
+
+                if not data:
+                    break
+
+                lines = (buffer + data).split(b'\n')
+                buffer = lines.pop() # Incomplete line
+                self.runOnLoop(self.linkReceived, link, lines)
+
+        except OSError:
+            pass
+        finally:
+            self.linkConnections.discard(link)
+            self.runOnLoop(self.linkLost, link)
+            sock.close()
+
+    # Checks the peer's SERVER line. On success the peer is sent everything on this side of the network, then live events.
+    def linkHandshake(self, link, line):
+
+        fields = line.decode('utf-8', 'replace').split('\t')
+
+        if len(fields) != 3 or fields[0] != 'SERVER':
+            reason = 'Not a server link'
+        elif self.LINK_PASSWORD is not None and fields[2] != self.LINK_PASSWORD:
+            reason = 'Bad link password'
+        elif fields[1] == self.serverName or fields[1] in self.servers: # Would close a loop in the tree
+            reason = 'Server ' + fields[1] + ' already exists'
+        else:
+            link.peerName = fields[1]
+            link.output.stream(self.generateBurst(link)) # Queued before any live event can be
+            self.links[link.peerName] = link
+            log.info('Linked to %s at %s', link.peerName, link.address)
+            return True
+
+        log.warning('Link with %s refused: %s', link.address, reason)
+        link.output.sendall(('ERROR\t' + reason + '\n').encode())
+        link.abort()
+        return False
+
+    # Introduces this side of the network to a new link: the servers, then every client with its channels. The servers, nicks
+    # and channels are recorded when the burst starts, as the live events queued behind it only cover what changes after
+    # that. The lines are generated as they are sent, so the burst of a big network never sits in memory.
+    def generateBurst(self, link):
+
+        servers = [self.serverName] + list(self.servers)
+        clients = [(client, client.getNickname(), tuple(client.getChannels())) for client in self.clients]
+
+        return self.generateBurstLines(servers, clients)
+
+    def generateBurstLines(self, servers, clients):
+
+        for name in servers:
+            yield getLinkLine('*', name, ('SRV',))
+
+        for (client, nickname, channels) in clients:
+
+            origin = client.worker if client.isRemote() else self.serverName
+            prefix = ':' + nickname + '!' + client.getUsername() + '@' + client.getHost() # As it was when the burst started
+
+            yield getLinkLine('*', origin, ('REG', nickname, client.getUsername(), client.getHost(), client.getRealname()))
+
+            for channel in channels:
+                line = prefix + ' JOIN ' + channel.getChannelName() + ' * :' + client.getRealname()
+                yield getLinkLine('*', origin, ('JOIN', nickname, channel.getChannelName(), channel.getKey() or '', line))
+
+    # Lines read from a link, the local clients' output from all of them is written as one batch
+    def linkReceived(self, link, lines):
+
+        started = self.startBatch()
+
+        try:
+            self.handleLinkLines(link, lines)
+        finally:
+            if started:
+                self.endBatch()
+
+    # Events from a link, 'dest origin\tcommand\targs'. Events for every server are applied here and passed on to the other
+    # links, those for one server only go on towards it. The network is a tree, so each event crosses each link once.
+    def handleLinkLines(self, link, lines):
+
+        for line in lines:
+
+            if link.peerName is None:
+                if not self.linkHandshake(link, line):
+                    return
+
+                continue
+
+            if line.startswith(b'ERROR\t'):
+                log.warning('Link with %s closed by peer: %s', link.peerName, line[6:].decode('utf-8', 'replace'))
+                link.abort()
+                return
+
+            (dest, sep, payload) = line.decode('utf-8', 'surrogateescape').partition(' ')
+            fields = payload.split('\t', 2) # Origin server, command, arguments
+            (origin, command) = (fields[0], fields[1])
+
+            if command == 'SRV': # A server behind this link
+
+                if origin == self.serverName or origin in self.servers:
+                    log.warning('Server %s is already linked, closing the link with %s', origin, link.peerName)
+                    link.abort()
+                    return
+
+                self.servers[origin] = link
+
+            elif command == 'SPLIT':
+                self.servers.pop(origin, None)
+
+            if dest != '*' and dest != self.serverName: # Towards another server
+                target = self.servers.get(dest)
+
+                if target is not None and target is not link:
+                    target.send(line + b'\n')
+
+                continue
+
+            if dest == '*':
+                self.linkSend(line + b'\n', exclude=link)
+
+            if command != 'SRV':
+                count = BUS_FIELDS[command]
+                self.busReceived(origin, command, fields[2].split('\t', count - 1) if count else [])
+
+    # Sends an encoded event down every link it has to cross, all of them for '*'
+    def linkSend(self, data, exclude=None):
+
+        (dest, sep, rest) = data.partition(b' ')
+
+        if dest == b'*':
+            for link in list(self.links.values()):
+                if link is not exclude:
+                    link.send(data)
+        else:
+            link = self.servers.get(dest.decode('utf-8', 'surrogateescape'))
+
+            if link is not None:
+                link.send(data)
+
+    # Netsplit: every server that was reached through the link is gone, with its clients
+    def linkLost(self, link):
+
+        if link.peerName is None or self.links.get(link.peerName) is not link:
+            return
+
+        del self.links[link.peerName]
+        lost = [name for (name, other) in self.servers.items() if other is link]
+        log.warning('Link with %s lost, %d servers split', link.peerName, len(lost))
+
+        for name in lost:
+            del self.servers[name]
+            self.busReceived(name, 'SPLIT', [])
+            self.linkSend(getLinkLine('*', name, ('SPLIT',)))
+
+
+# One parsed IRC line: [':' prefix ' '] command {' ' param} [' :' trailing]. The trailing parameter is kept as the
+# received bytes so message text can be relayed without decoding it, everything else is decoded.
+class Message:
+
+    __slots__ = ('prefix', 'command', 'params', 'trailing')
+
+    def __init__(self, prefix, command, params, trailing):
+        self.prefix = prefix
+        self.command = command
+        self.params = params # Middle parameters
+        self.trailing = trailing # Bytes after ' :', None if there is no trailing parameter
+
+    # All parameters with the trailing one decoded
+    def getArguments(self):
+        if self.trailing is None:
+            return self.params
+
+        return self.params + [self.trailing.decode('utf-8', 'replace')]
+
+
+# Parses a line (bytes without CR LF) in one pass, returns None for an empty line
+def parseMessage(line):
+
+    prefix = None
+
+    if line[:1] == b':':
+        (prefix, sep, line) = line.partition(b' ')
+        prefix = prefix[1:].decode('utf-8', 'replace')
+
+    if line[:1] == b':': # No command, only a trailing parameter
+        return None
+
+    (head, sep, trailing) = line.partition(b' :')
+    params = head.decode('utf-8', 'replace').split()
+
+    if not params:
+        return None
+
+    return Message(prefix, params[0].upper(), params[1:], trailing if sep else None)
+
+
+# Lines of head followed by as many of words (bytes) as fit in 510 bytes, separated by spaces. Nothing for no words.
+def packWords(head, words):
+
+    room = 510 - len(head)
+    line = []
+    size = -1 # No space before the first word
+
+    for word in words:
+
+        if line and size + 1 + len(word) > room:
+            yield head + b' '.join(line) + b'\r\n'
+            line = []
+            size = -1
+
+        line.append(word)
+        size += 1 + len(word)
+
+    if line:
+        yield head + b' '.join(line) + b'\r\n'
+
+
+# Characters a channel name can't have. A space or comma would make it read as several names, and a tab would split the
+# tab separated bus and link lines. NUL, BEL, CR and LF aren't allowed by RFC 2812.
+CHANNEL_NAME_FORBIDDEN = frozenset(' ,\x00\x07\t\r\n')
+
+# RFC 1459 casemapping, {}|^ are the lower case forms of []\\~
+RFC1459_CASEMAP = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~', 'abcdefghijklmnopqrstuvwxyz{}|^')
+
+
+# Nickname or channel name index with O(1) lookup. Names are compared with RFC 1459 casemapping. The names are also kept
+# sorted, so those starting with a prefix are found with a bisect.
+class Registry:
+
+    MATCH_CHUNK = 256 # Names looked at per hold of the lock by match()
+
+    def __init__(self):
+        self.entries = {} # Casemapped name -> object
+        self.names = SortedNames() # The casemapped names
+        self.lock = threading.Lock() # Makes check-and-set operations atomic in threaded mode
+
+    def find(self, name):
+        return self.entries.get(name.translate(RFC1459_CASEMAP))
+
+    # Entries for several names at once, None for those not found
+    def findAll(self, names):
+        entries = self.entries
+        return [entries.get(name.translate(RFC1459_CASEMAP)) for name in names]
+
+    # Adds an entry, False if the name is taken
+    def add(self, name, item):
+        key = name.translate(RFC1459_CASEMAP)
+
+        with self.lock:
+            if key in self.entries:
+                return False
+
+            self.entries[key] = item
+            self.names.add(key)
+            return True
+
+    # Returns the existing entry for name, or adds and returns item
+    def setdefault(self, name, item):
+        key = name.translate(RFC1459_CASEMAP)
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = item
+                self.names.add(key)
+
+            return self.entries[key]
+
+    # Moves an entry to a new name in one step, False if the new name belongs to another entry
+    def rename(self, oldName, newName, item):
+        oldKey = oldName.translate(RFC1459_CASEMAP)
+        newKey = newName.translate(RFC1459_CASEMAP)
+
+        with self.lock:
+            if self.entries.get(newKey, item) is not item:
+                return False
+
+            if self.entries.get(oldKey) is item:
+                del self.entries[oldKey]
+                self.names.remove(oldKey)
+
+            if newKey not in self.entries:
+                self.names.add(newKey)
+
+            self.entries[newKey] = item
+            return True
+
+    # Removes the entry for name, only if it is item when item is given
+    def remove(self, name, item=None):
+        key = name.translate(RFC1459_CASEMAP)
+
+        with self.lock:
+            if key in self.entries and (item is None or self.entries[key] is item):
+                del self.entries[key]
+                self.names.remove(key)
+
+    # Entries whose names match an IRC mask, where * matches any run of characters and ? any one, in name order. Only the
+    # names starting with the part of the mask before the first wildcard are looked at. The names are read MATCH_CHUNK at a
+    # time, carrying on after the last one seen, so a long match can be iterated slowly while entries come and go.
+    def match(self, mask):
+
+        mask = mask.translate(RFC1459_CASEMAP) # No [ or ] left, so fnmatch only knows * and ?
+        prefix = mask.split('*', 1)[0].split('?', 1)[0]
+
+        if prefix == mask: # No wildcards
+            item = self.entries.get(mask)
+
+            if item is not None:
+                yield item
+
+            return
+
+        last = None
+
+        while True:
+
+            with self.lock:
+                chunk = self.names.getSlice(prefix, self.MATCH_CHUNK) if last is None else self.names.getSlice(last, self.MATCH_CHUNK, after=True)
+
+            for key in chunk:
+
+                if not key.startswith(prefix): # Past the names with the prefix
+                    return
+
+                if fnmatch.fnmatchcase(key, mask):
+                    item = self.entries.get(key)
+
+                    if item is not None:
+                        yield item
+
+            if len(chunk) < self.MATCH_CHUNK:
+                return
+
+            last = chunk[-1]
+
+    def __contains__(self, name):
+        return name.translate(RFC1459_CASEMAP) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Iterates over a snapshot so entries can be removed while iterating
+    def __iter__(self):
+        return iter(tuple(self.entries.values()))
+
+
+# Sorted strings in blocks of up to 2 * BLOCK, so adding or removing one moves at most a block's worth of references rather
+# than half of all of them. The last string of each block is kept in a list of its own that is bisected first.
+class SortedNames:
+
+    BLOCK = 500
+
+    def __init__(self):
+        self.blocks = []
+        self.lasts = [] # Last string of each block
+
+    def add(self, name):
+
+        if not self.blocks:
+            self.blocks.append([name])
+            self.lasts.append(name)
+            return
+
+        i = bisect.bisect_left(self.lasts, name)
+
+        if i == len(self.blocks): # After all of them, goes on the end of the last block
+            i -= 1
+            self.blocks[i].append(name)
+            self.lasts[i] = name
+        else:
+            bisect.insort(self.blocks[i], name)
+
+        block = self.blocks[i]
+
+        if len(block) > 2 * self.BLOCK: # Split in two
+            self.blocks.insert(i + 1, block[self.BLOCK:])
+            del block[self.BLOCK:]
+            self.lasts.insert(i, block[-1])
+
+    def remove(self, name):
+
+        i = bisect.bisect_left(self.lasts, name)
+
+        if i == len(self.blocks):
+            return
+
+        block = self.blocks[i]
+        j = bisect.bisect_left(block, name)
+
+        if j == len(block) or block[j] != name:
+            return
+
+        del block[j]
+
+        if not block:
+            del self.blocks[i]
+            del self.lasts[i]
+        elif j == len(block):
+            self.lasts[i] = block[-1]
+
+    # Up to count strings in order from the first one not below name, or above it with after set
+    def getSlice(self, name, count, after=False):
+
+        find = bisect.bisect_right if after else bisect.bisect_left
+        i = find(self.lasts, name)
+        names = []
+
+        while i < len(self.blocks) and len(names) < count:
+            block = self.blocks[i]
+            j = find(block, name) # 0 past the first block
+            names += block[j:j + count - len(names)]
+            i += 1
+
+        return names
+
+
+log = logging.getLogger('ircserver')
+
+
+# Sends log records through a queue to a thread that writes them to stdout, so a slow terminal or pipe never holds up a client. Returns the listener, stop() writes out what is left.
+def startLogging(level):
+
+    records = queue.SimpleQueue() # put() is reentrant, records may come from the SIGUSR1 handler
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter('%(asctime)s %(process)d %(levelname)s %(message)s'))
+
+    log.handlers[:] = [logging.handlers.QueueHandler(records)]
+    log.setLevel(level)
+    log.propagate = False
+
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    return listener
+
+
+# Histogram with fixed bucket bounds, observing a value is one bisect and two additions.
+class Histogram:
+
+    __slots__ = ('bounds', 'counts', 'total')
+
+    def __init__(self, bounds):
+        self.bounds = bounds # Upper bounds, ascending. Values above the last one go in an overflow bucket.
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    def getCount(self):
+        return sum(self.counts)
+
+    def getAverage(self):
+        count = self.getCount()
+        return self.total / count if count else 0
+
+    # Upper bound of the bucket holding the given fraction of the observations, the overflow bucket reports the last bound
+    def getPercentile(self, fraction):
+
+        wanted = fraction * self.getCount()
+        seen = 0
+
+        for (i, count) in enumerate(self.counts):
+            seen += count
+
+            if seen >= wanted and count:
+                return self.bounds[min(i, len(self.bounds) - 1)]
+
+        return 0
+
+    # Prometheus histogram lines, the buckets are cumulative there
+    def getPrometheusLines(self, name, labels=''):
+
+        lines = []
+        seen = 0
+
+        for (bound, count) in zip(self.bounds, self.counts):
+            seen += count
+            lines.append('%s_bucket{%sle="%g"} %d' % (name, labels, bound, seen))
+
+        lines.append('%s_bucket{%sle="+Inf"} %d' % (name, labels, seen + self.counts[-1]))
+
+        labels = '{' + labels.rstrip(',') + '}' if labels else ''
+        lines.append('%s_sum%s %g' % (name, labels, self.total))
+        lines.append('%s_count%s %d' % (name, labels, seen + self.counts[-1]))
+        return lines
+
+
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0) # Seconds
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000) # Recipients
+
+
+# Server counters. Updated without a lock, so in threaded mode a concurrent update can occasionally be lost.
+class Metrics:
+
+    def __init__(self):
+        self.started = time.time()
+        self.commands = {} # Command name -> latency Histogram
+        self.fanout = Histogram(FANOUT_BUCKETS)
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.linesOut = 0
+        self.writes = 0 # Sends to client sockets and transports
+        self.accepted = 0
+
+        # Called after every command with (command, client, seconds) and after every channel broadcast with (channel, recipients, seconds)
+        self.dispatchHooks = []
+        self.broadcastHooks = []
+
+    def addCommand(self, command):
+        self.commands.setdefault(command, Histogram(LATENCY_BUCKETS))
+
+    def commandDone(self, command, client, elapsed):
+
+        self.commands[command].observe(elapsed)
+
+        for hook in self.dispatchHooks:
+            hook(command, client, elapsed)
+
+    def broadcastDone(self, channel, recipients, elapsed):
+
+        self.fanout.observe(recipients)
+
+        for hook in self.broadcastHooks:
+            hook(channel, recipients, elapsed)
+
+    # Lines for STATS
+    def getSummary(self, server):
+
+        uptime = max(time.time() - self.started, 1)
+
+        return [
+            'clients %d channels %d' % (len(server.clients), len(server.channels)),
+            'bytes in %d out %d' % (self.bytesIn, self.bytesOut),
+            'lines out %d writes %d (%.3f per line)' % (self.linesOut, self.writes, self.writes / max(self.linesOut, 1)),
+            'accepted %d (%.2f/s)' % (self.accepted, self.accepted / uptime),
+            'flood throttled %d killed %d' % (server.floodStats['throttled'], server.floodStats['killed']),
+            'pings %d timeouts registration %d ping %d' % (server.timeoutStats['pings'], server.timeoutStats['registration'], server.timeoutStats['ping']),
+            'tls handshakes %d resumed %d failed %d' % (server.tlsStats['handshakes'], server.tlsStats['resumed'], server.tlsStats['failed']),
+            'broadcasts %d fan-out avg %.1f p99 <= %d' % (self.fanout.getCount(), self.fanout.getAverage(), self.fanout.getPercentile(0.99)),
+        ]
+
+    # Prometheus text exposition format
+    def getPrometheusText(self, server):
+
+        lines = ['# TYPE ircd_command_seconds histogram']
+
+        for (command, histogram) in self.commands.items():
+            lines += histogram.getPrometheusLines('ircd_command_seconds', 'command="' + command + '",')
+
+        lines.append('# TYPE ircd_broadcast_recipients histogram')
+        lines += self.fanout.getPrometheusLines('ircd_broadcast_recipients')
+
+        for (name, kind, value) in (
+                ('ircd_received_bytes_total', 'counter', self.bytesIn),
+                ('ircd_sent_bytes_total', 'counter', self.bytesOut),
+                ('ircd_sent_lines_total', 'counter', self.linesOut),
+                ('ircd_socket_writes_total', 'counter', self.writes),
+                ('ircd_accepted_connections_total', 'counter', self.accepted),
+                ('ircd_flood_throttled_total', 'counter', server.floodStats['throttled']),
+                ('ircd_flood_killed_total', 'counter', server.floodStats['killed']),
+                ('ircd_pings_sent_total', 'counter', server.timeoutStats['pings']),
+                ('ircd_registration_timeouts_total', 'counter', server.timeoutStats['registration']),
+                ('ircd_ping_timeouts_total', 'counter', server.timeoutStats['ping']),
+                ('ircd_tls_handshakes_total', 'counter', server.tlsStats['handshakes']),
+                ('ircd_tls_resumed_total', 'counter', server.tlsStats['resumed']),
+                ('ircd_tls_handshake_failures_total', 'counter', server.tlsStats['failed']),
+                ('ircd_clients', 'gauge', len(server.clients)),
+                ('ircd_channels', 'gauge', len(server.channels)),
+                ('ircd_linked_servers', 'gauge', len(server.servers)),
+                ('ircd_start_time_seconds', 'gauge', self.started)):
+            lines.append('# TYPE ' + name + ' ' + kind)
+            lines.append('%s %d' % (name, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+# Hashed timing wheel. Each client is in one slot, the slot for the tick its timer expires in, with the number of further turns
+# of the wheel to wait when the delay is longer than one turn. Scheduling and removal are O(1) and a tick only looks at one slot,
+# so the cost doesn't grow with the number of connections.
+class TimingWheel:
+
+    def __init__(self, slotCount):
+        self.slots = [{} for i in range(slotCount)] # Client -> turns left
+        self.current = 0
+        self.lock = threading.Lock() # The threaded mode schedules from every client thread
+
+    # Sets (or moves) the client's timer to expire after delay seconds
+    def schedule(self, client, delay, tick):
+
+        ticks = max(1, math.ceil(delay / tick))
+
+        with self.lock:
+
+            if client.timerSlot is not None:
+                self.slots[client.timerSlot].pop(client, None)
+
+            slot = (self.current + ticks) % len(self.slots)
+            self.slots[slot][client] = (ticks - 1) // len(self.slots)
+            client.timerSlot = slot
+
+    def remove(self, client):
+
+        with self.lock:
+
+            if client.timerSlot is not None:
+                self.slots[client.timerSlot].pop(client, None)
+                client.timerSlot = None
+
+    # Moves to the next slot and returns the clients whose timers have expired, they are no longer scheduled
+    def advance(self):
+
+        with self.lock:
+
+            self.current = (self.current + 1) % len(self.slots)
+            slot = self.slots[self.current]
+            expired = []
+
+            for (client, turns) in list(slot.items()):
+
+                if turns:
+                    slot[client] = turns - 1
+                else:
+                    del slot[client]
+                    client.timerSlot = None
+                    expired.append(client)
+
+            return expired
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+
+# Ticks the timing wheel in threaded mode
+class TimerThread(threading.Thread):
+
+    def __init__(self, server):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = server
+        self.stopped = threading.Event()
+
+    def run(self):
+
+        nextTick = time.monotonic() + self.server.TIMER_TICK
+
+        while not self.stopped.wait(max(0, nextTick - time.monotonic())):
+            nextTick += self.server.TIMER_TICK
+
+            try:
+                self.server.runTimers()
+            except Exception:
+                log.exception('Timer check failed')
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+# Thread answering every connection on the metrics socket with the Prometheus text dump, as a minimal HTTP response so it can be scraped directly.
+class MetricsListener(threading.Thread):
+
+    def __init__(self, server, listener):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = server
+        self.listener = listener
+
+    def run(self):
+
+        while True:
+
+            try:
+                (conn, addr) = self.listener.accept()
+            except OSError: # Closed by stop()
+                return
+
+            try:
+                conn.settimeout(1.0)
+
+                try:
+                    conn.recv(4096) # The request itself doesn't matter
+                except OSError:
+                    pass
+
+                body = self.server.metrics.getPrometheusText(self.server).encode()
+                conn.sendall(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+
+# Splits 'host:port' into (host, port). IPv6 hosts go in brackets, '[::1]:6667', and a bare port listens on every address.
+def parseListenAddress(text):
+
+    (host, sep, port) = text.rpartition(':')
+
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    elif not sep:
+        host = '::'
+
+    return (host, int(port))
+
+
+# Number of tab separated fields after the command of each bus event. The last field may hold any text.
+BUS_FIELDS = {'REG': 4, 'NICK': 3, 'JOIN': 4, 'PART': 3, 'QUIT': 2, 'CHAN': 4, 'TO': 2, 'SPLIT': 0, 'SRV': 0}
+
+
+# Raises the soft open file limit to the hard limit so one process can hold tens of thousands of connections.
+def raiseFileLimit():
+
+    try:
+        import resource
+    except ImportError: # Not available on Windows
+        return
+
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+# Bounded outbound buffer owned by each client connection. Output the connection can't take yet waits here instead of
+# blocking the sender, and a client that stays over the server's high-water mark for too long is disconnected.
+class SendQueue:
+
+    __slots__ = ('server', 'queue', 'queuedBytes', 'streams', 'overSince', 'evicted', 'closeReason', 'lock', 'deferred')
+
+    STREAM_LINES = 32 # Lines moved from a stream into the queue at once, at most 16 KiB
+    STREAM_BYTES = 16384 # Streamed lines are only queued while less than this is waiting
+
+    def __init__(self, server):
+        self.server = server
+        self.queue = [] # Encoded messages not yet handed to the connection, a list is much smaller than a deque when idle
+        self.queuedBytes = 0
+        self.streams = None # Iterators of lines still to send, see stream()
+        self.overSince = None # When the queue went over the high-water mark
+        self.evicted = False
+        self.closeReason = None # Why the server closed the connection, for the QUIT sent to the client's channels
+        self.lock = threading.Lock()
+        self.deferred = False # Written when the batch it was queued in ends, see Server.deferWrite()
+
+    def sendall(self, data):
+
+        with self.lock:
+
+            if self.evicted:
+                self.server.sendqStats['dropped'] += 1
+                return
+
+            self.queue.append(data)
+            self.queuedBytes += len(data)
+            self.server.metrics.bytesOut += len(data)
+            self.server.metrics.linesOut += data.count(b'\n')
+            self.write()
+
+    # Called with the lock held once output was added. Written straight away, or when the batch being handled ends (see
+    # Server.startBatch()) unless COALESCE_BYTES are waiting by then.
+    def write(self):
+
+        if self.queuedBytes < self.server.COALESCE_BYTES and (self.deferred or self.server.deferWrite(self)):
+            return
+
+        self.flush()
+
+    # Called with the lock held. Hands the queue and as much of the streams as it takes to the connection, and checks the
+    # limits on what is left.
+    def flush(self):
+
+        while True:
+
+            if self.streams:
+                self.pump()
+
+            self.drain()
+
+            if not self.streams or self.queue: # Done, or the connection won't take more for now
+                break
+
+        if self.queue:
+            self.checkLimits()
+        else:
+            self.overSince = None
+
+    # Writes what was queued during a batch
+    def writeDeferred(self):
+
+        with self.lock:
+            self.deferred = False
+
+            if not self.evicted:
+                self.flush()
+
+    # Sends the lines an iterator yields, a chunk at a time whenever the output before it has been written, so a long reply
+    # like NAMES for a big channel is never held in memory at once. Other messages may go out between two chunks.
+    def stream(self, lines):
+
+        with self.lock:
+
+            if self.evicted:
+                self.server.sendqStats['dropped'] += 1
+                return
+
+            if self.streams is None:
+                self.streams = []
+
+            self.streams.append(iter(lines))
+            self.pump() # The first chunks go ahead of whatever is sent later in the batch
+            self.write()
+
+    # Called with the lock held. Queues the next chunks of streamed lines while less than STREAM_BYTES is waiting, behind
+    # whatever was queued before them.
+    def pump(self):
+
+        while self.streams and self.queuedBytes < self.STREAM_BYTES:
+
+            chunk = b''.join(itertools.islice(self.streams[0], self.STREAM_LINES))
+
+            if not chunk: # Finished
+                self.streams.pop(0)
+                continue
+
+            self.queue.append(chunk)
+            self.queuedBytes += len(chunk)
+            self.server.metrics.bytesOut += len(chunk)
+            self.server.metrics.linesOut += chunk.count(b'\n')
+
+        if not self.streams:
+            self.streams = None
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    # Called with the lock held. Everything queued and not written yet, for a hot restart. The rest of the streams is moved
+    # to the queue, so nothing is lost if the restart fails.
+    def getUnsent(self):
+
+        if self.streams:
+            rest = b''.join(itertools.chain.from_iterable(self.streams))
+            self.streams = None
+            self.queue.append(rest)
+            self.queuedBytes += len(rest)
+
+        return b''.join(self.queue)
+
+    def getQueueDepth(self):
+        return (self.queuedBytes, len(self.queue))
+
+    # Called with the lock held
+    def checkLimits(self):
+
+        server = self.server
+
+        if self.queuedBytes <= server.SENDQ_BYTES and len(self.queue) <= server.SENDQ_LINES:
+            self.overSince = None
+            return
+
+        now = time.monotonic()
+
+        if self.overSince is None:
+            self.overSince = now
+            self.scheduleCheck()
+
+        if now - self.overSince >= server.SENDQ_TIMEOUT or self.queuedBytes > 4 * server.SENDQ_BYTES:
+            log.warning('SendQ exceeded, closing link with %d bytes queued', self.queuedBytes)
+            self.evicted = True
+            self.closeReason = 'SendQ exceeded'
+            self.queue.clear()
+            self.queuedBytes = 0
+            self.streams = None
+            server.sendqStats['evicted'] += 1
+            self.abort(b'ERROR :Closing Link: SendQ exceeded\r\n')
+
+    # Re-checks the limits later in case no more output arrives
+    def scheduleCheck(self):
+        pass
+
+    def checkLimitsLater(self):
+        with self.lock:
+            if not self.evicted:
+                self.checkLimits()
+
+
+# Client socket in threaded mode. Output is written without blocking, whatever the kernel won't take is left to the OutputFlusher thread.
+class ThreadedSocket(SendQueue):
+
+    __slots__ = ('sock', 'waiting')
+
+    def __init__(self, sock, server):
+        SendQueue.__init__(self, server)
+        self.sock = sock
+        self.waiting = False # Socket was full, the flusher writes once it is writable again
+
+    # Called with the lock held
+    def drain(self):
+
+        if self.waiting or not self.queue:
+            return
+
+        data = self.queue[0] if len(self.queue) == 1 else b''.join(self.queue) # One send for everything queued, faster than sendmsg() for short lines
+        self.server.metrics.writes += 1
+
+        try:
+            sent = self.sock.send(data, getattr(socket, 'MSG_DONTWAIT', 0))
+        except BlockingIOError:
+            sent = 0
+        except OSError: # Connection broken, the reading thread cleans up
+            sent = len(data)
+
+        if sent == len(data):
+            self.queue.clear()
+            self.queuedBytes = 0
+            return
+
+        self.queue[:] = [memoryview(data)[sent:]] # No copy of the unsent part
+        self.queuedBytes = len(data) - sent
+        self.waiting = True
+        self.server.flusher.watch(self) # Finish when the socket is writable
+
+    # Shuts the socket down, the reading thread then sees the connection end
+    def abort(self, errorLine):
+
+        try:
+            self.sock.send(errorLine, getattr(socket, 'MSG_DONTWAIT', 0))
+        except OSError:
+            pass
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    # Writes out anything still queued before the connection is closed
+    def flushBlocking(self):
+
+        with self.lock:
+
+            if self.evicted or not self.queue:
+                return
+
+            try:
+                self.server.metrics.writes += 1
+                self.sock.settimeout(2.0)
+                self.sock.sendall(b''.join(self.queue))
+            except OSError:
+                pass
+
+            self.queue.clear()
+            self.queuedBytes = 0
+
+    def shutdown(self, how):
+        self.flushBlocking()
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.flushBlocking()
+        self.sock.close()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+# ThreadedSocket for a TLS connection. Output is encrypted as it is queued, so whatever waits in the queue is ready to go
+# out as it is and the flusher and the limits work the same as for plain text.
+class TlsThreadedSocket(ThreadedSocket):
+
+    __slots__ = ('session', 'sealed')
+
+    def __init__(self, sock, server, session):
+        ThreadedSocket.__init__(self, sock, server)
+        self.session = session
+        self.sealed = 0 # Leading entries of the queue that are already encrypted
+
+    # Called with the lock held
+    def drain(self):
+        self.seal()
+        ThreadedSocket.drain(self)
+        self.sealed = len(self.queue)
+
+    # Called with the lock held. Encrypts what was queued since the last time.
+    def seal(self):
+
+        if len(self.queue) > self.sealed:
+            plain = b''.join(self.queue[self.sealed:])
+            record = self.session.encrypt(plain)
+            self.queue[self.sealed:] = [record]
+            self.queuedBytes += len(record) - len(plain)
+            self.sealed = len(self.queue)
+
+    def flushBlocking(self):
+
+        with self.lock: # Output waiting for the end of a batch isn't encrypted yet
+            self.seal()
+
+        ThreadedSocket.flushBlocking(self)
+
+    # The ERROR line only goes out if nothing is waiting ahead of it, TLS records can't be sent out of order
+    def abort(self, errorLine):
+        ThreadedSocket.abort(self, self.session.encrypt(errorLine) if not self.queue and not self.waiting else b'')
+
+    # Ends the TLS session after whatever is queued
+    def shutdown(self, how):
+
+        with self.lock:
+            if not self.evicted:
+                self.seal()
+                self.queue.append(self.session.unwrap())
+                self.sealed = len(self.queue)
+
+        ThreadedSocket.shutdown(self, how)
+
+
+# Thread which writes queued output to threaded mode sockets once they become writable, and evicts clients that stay over their limits.
+class OutputFlusher(threading.Thread):
+
+    def __init__(self, server):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = server
+        self.selector = selectors.DefaultSelector()
+        self.pending = set() # Sockets to start watching
+        self.lock = threading.Lock()
+        self.running = threading.Lock() # Held while writing, a hot restart takes it to stop the flusher
+        self.stopped = threading.Event()
+        (self.wakeReader, self.wakeWriter) = socket.socketpair()
+        self.selector.register(self.wakeReader, selectors.EVENT_READ, None)
+
+    def watch(self, sock):
+
+        with self.lock:
+            self.pending.add(sock)
+
+        try:
+            self.wakeWriter.send(b'x', getattr(socket, 'MSG_DONTWAIT', 0))
+        except OSError:
+            pass # Already woken
+
+    def run(self):
+
+        while not self.stopped.is_set():
+
+            ready = self.selector.select(1.0)
+
+            with self.running:
+                self.writeReady(ready)
+
+    # Called once nothing is sent any more, by Server.stop()
+    def stop(self):
+
+        self.stopped.set()
+
+        try:
+            self.wakeWriter.send(b'x', getattr(socket, 'MSG_DONTWAIT', 0))
+        except OSError:
+            pass
+
+        self.join()
+        self.selector.close()
+        self.wakeReader.close()
+        self.wakeWriter.close()
+
+    def writeReady(self, ready):
+
+        for (key, events) in ready:
+
+            if key.data is None: # Woken up to watch new sockets
+                self.wakeReader.recv(4096)
+                continue
+
+            sock = key.data
+
+            with sock.lock:
+                sock.waiting = False
+                sock.flush()
+                done = not sock.waiting
+
+            if done:
+                self.selector.unregister(key.fileobj)
+
+        with self.lock:
+            pending = self.pending
+            self.pending = set()
+
+        for sock in pending:
+            try:
+                self.selector.register(sock.sock, selectors.EVENT_WRITE, sock)
+            except (KeyError, ValueError): # Already watched or closed
+                pass
+
+        for key in list(self.selector.get_map().values()):
+
+            if key.data is not None:
+                key.data.checkLimitsLater()
+
+                if key.data.evicted or key.fileobj.fileno() == -1:
+                    self.selector.unregister(key.fileobj)
+
+
+# Socket-like wrapper around an asyncio transport so the command handlers can use the same calls in both modes. Output
+# goes straight to the transport until it signals backpressure, then waits in the queue until the transport resumes.
+class TransportSocket(SendQueue):
+
+    __slots__ = ('transport', 'paused')
+
+    def __init__(self, transport, server):
+        SendQueue.__init__(self, server)
+        self.transport = transport
+        self.paused = False
+        self.transport.set_write_buffer_limits(high=65536)
+
+    # Called with the lock held
+    def drain(self):
+
+        if self.paused or self.transport.is_closing():
+            return
+
+        self.server.metrics.writes += 1
+        self.transport.writelines(self.queue)
+        self.queue.clear()
+        self.queuedBytes = 0
+
+    def pauseWriting(self):
+        self.paused = True
+
+    def resumeWriting(self):
+        with self.lock:
+            self.paused = False
+            self.flush()
+
+    def scheduleCheck(self):
+        asyncio.get_running_loop().call_later(self.server.SENDQ_TIMEOUT, self.checkLimitsLater)
+
+    def abort(self, errorLine):
+        self.transport.write(errorLine)
+        self.transport.close()
+        asyncio.get_running_loop().call_later(1.0, self.transport.abort) # Don't wait for a client that isn't reading
+
+    def shutdown(self, how):
+        pass # close() flushes the write buffer before closing
+
+    # Called with the lock held. The transport's own buffer comes first, it isn't public but nothing else holds what it
+    # hasn't written (a bytearray before Python 3.12, a deque of buffers since).
+    def getUnsent(self):
+        buffered = self.transport._buffer
+        return (bytes(buffered) if isinstance(buffered, bytearray) else b''.join(buffered)) + SendQueue.getUnsent(self)
+
+    def fileno(self):
+        return self.transport.get_extra_info('socket').fileno()
+
+    def close(self):
+
+        with self.lock:
+            self.paused = False
+            self.drain()
+
+        self.transport.close()
+
+
+# TransportSocket for a TLS connection, the output is encrypted on its way to the transport
+class TlsTransportSocket(TransportSocket):
+
+    __slots__ = ('session',)
+
+    def __init__(self, transport, server, session):
+        TransportSocket.__init__(self, transport, server)
+        self.session = session
+
+    # Called with the lock held
+    def drain(self):
+
+        if self.paused or self.transport.is_closing():
+            return
+
+        self.server.metrics.writes += 1
+        self.transport.write(self.session.encrypt(b''.join(self.queue)))
+        self.queue.clear()
+        self.queuedBytes = 0
+
+    def abort(self, errorLine):
+        TransportSocket.abort(self, self.session.encrypt(errorLine))
+
+    def close(self):
+
+        with self.lock:
+            self.paused = False
+            self.drain()
+
+            if not self.transport.is_closing():
+                self.transport.write(self.session.unwrap())
+
+        self.transport.close()
+
+
+# TLS state of one client connection. The SSL object reads and writes memory buffers instead of the socket, so the handshake
+# can run on any thread and the encrypted bytes go through the same sockets and transports as plain text. The lock keeps
+# the threads using the SSL object at the same time (the reader, the writers and a handshake thread) apart.
+class TlsSession:
+
+    __slots__ = ('tls', 'incoming', 'outgoing', 'lock', 'established', 'received', 'busy')
+
+    def __init__(self, context):
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.tls = context.wrap_bio(self.incoming, self.outgoing, server_side=True)
+        self.lock = threading.Lock()
+        self.established = False # Handshake done
+        self.received = bytearray() # asyncio mode, input waiting for a handshake step that is still running
+        self.busy = False # asyncio mode, a handshake step is running
+
+    # Carries the handshake on with the bytes received. Returns (bytes to send, True once it is done), raises ssl.SSLError if it failed.
+    def handshake(self, data):
+
+        with self.lock:
+            self.incoming.write(data)
+
+            try:
+                self.tls.do_handshake() # Lets other threads run meanwhile
+            except ssl.SSLWantReadError:
+                return (self.outgoing.read(), False)
+
+            self.established = True
+            return (self.outgoing.read(), True)
+
+    # Returns the plain text of the complete records received so far. Raises ssl.SSLError if the client sent garbage.
+    def decrypt(self, data):
+
+        with self.lock:
+            self.incoming.write(data)
+            chunks = []
+
+            try:
+                while True:
+                    chunk = self.tls.read(65536)
+
+                    if not chunk: # close_notify, the connection ends next
+                        break
+
+                    chunks.append(chunk)
+            except ssl.SSLWantReadError:
+                pass
+
+            return b''.join(chunks)
+
+    # Returns data as TLS records, together with anything the SSL object had to send, e.g. after a key update
+    def encrypt(self, data):
+
+        if not self.established: # Nothing goes out before the handshake is done, without waiting on a handshake thread
+            return b''
+
+        with self.lock:
+            try:
+                if data:
+                    self.tls.write(data)
+            except ssl.SSLError: # Closed or broken, the reader sees the connection end
+                pass
+
+            return self.outgoing.read()
+
+    # Returns the close_notify alert ending the session, the client's isn't waited for
+    def unwrap(self):
+
+        if not self.established:
+            return b''
+
+        with self.lock:
+            try:
+                self.tls.unwrap()
+            except ssl.SSLError:
+                pass
+
+            return self.outgoing.read()
+
+
+# Socket-like object for a client on another worker, messages are forwarded to that worker over the bus.
+class BusSocket:
+
+    __slots__ = ('server', 'client')
+
+    def __init__(self, server, client):
+        self.server = server
+        self.client = client
+
+    def sendall(self, data):
+        for line in bytes(data).split(b'\r\n'):
+            if line:
+                self.server.busPublish('TO', self.client.getNickname(), line.decode('utf-8', 'surrogateescape'), dest=self.client.worker)
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+# asyncio protocol for a worker's connection to the bus hub.
+class BusProtocol(asyncio.Protocol):
+
+    def __init__(self, server):
+        self.server = server
+        self.buffer = b''
+
+    def data_received(self, data):
+
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop() # Incomplete line
+        self.server.startLoopBatch()
+
+        for line in lines:
+            fields = line.decode('utf-8', 'surrogateescape').split('\t', 2) # Origin worker, command, arguments
+            count = BUS_FIELDS[fields[1]]
+            args = fields[2].split('\t', count - 1) if count else []
+
+            self.server.busReceived(int(fields[0]), fields[1], args)
+
+    def connection_lost(self, exc):
+        os._exit(1) # The hub is gone, this worker can't keep its state in sync
+
+
+# Encodes a link event, 'dest origin\tcommand\targs\n'. dest is a server name or '*' for all of them.
+def getLinkLine(dest, origin, fields):
+    return (str(dest) + ' ' + origin + '\t' + '\t'.join(fields) + '\n').encode('utf-8', 'surrogateescape')
+
+
+# Connection to another server. Output goes through a ThreadedSocket send queue, so a slow link never blocks a client.
+class Link:
+
+    __slots__ = ('sock', 'output', 'address', 'peerName')
+
+    def __init__(self, server, sock, address):
+        self.sock = sock
+        self.output = ThreadedSocket(sock, server)
+        self.address = address
+        self.peerName = None # Set once the handshake is done
+
+    # Live events wait behind a burst that is still being sent
+    def send(self, data):
+
+        if self.output.streams:
+            self.output.stream((data,))
+        else:
+            self.output.sendall(data)
+
+    # Closes the connection, the thread reading it then cleans up
+    def abort(self):
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+HANDOFF_FDS = 253 # File descriptors per message at most (SCM_MAX_FD on Linux)
+
+
+# Sends the state of a hot restart as a length prefixed JSON document, then the file descriptors in one byte messages
+def sendHandoff(sock, state, fds):
+
+    state['fds'] = len(fds)
+    data = json.dumps(state, separators=(',', ':')).encode()
+    sock.sendall(struct.pack('!Q', len(data)) + data)
+
+    for i in range(0, len(fds), HANDOFF_FDS):
+        socket.send_fds(sock, [b'F'], fds[i:i + HANDOFF_FDS])
+
+
+# Receives what sendHandoff() sent, returns (state, file descriptors)
+def receiveHandoff(sock):
+
+    def read(size):
+        data = bytearray()
+
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+
+            if not chunk:
+                raise ConnectionError('The running server did not hand over')
+
+            data += chunk
+
+        return data
+
+    (size,) = struct.unpack('!Q', read(8))
+    state = json.loads(read(size))
+    fds = []
+
+    while len(fds) < state['fds']:
+        (data, received, flags, address) = socket.recv_fds(sock, 1, HANDOFF_FDS)
+        fds += received
+
+        if not data or flags & socket.MSG_CTRUNC:
+            raise ConnectionError('File descriptors lost in the hot restart') # Over the open file limit for example
+
+    return (state, fds)
+
+
+# Splits a client's byte stream into IRC lines. A line split across reads is kept in the buffer until the rest arrives,
+# and a line over the 512 byte limit (which includes CR LF) is cut to 510 bytes with the rest of it skipped.
+class LineFramer:
+
+    __slots__ = ('buffer', 'discarding')
+
+    MAX_LINE = 510
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.discarding = False # Skipping the rest of an over-long line
+
+    # Adds received data, returns the complete lines as bytes without the line ending
+    def feed(self, data):
+
+        buffer = self.buffer
+        buffer += data
+        lines = []
+        start = 0
+
+        with memoryview(buffer) as view:
+
+            while True:
+
+                end = buffer.find(b'\n', start)
+
+                if end == -1:
+                    break
+
+                if self.discarding: # Tail of a line that was already cut
+                    self.discarding = False
+                    start = end + 1
+                    continue
+
+                stop = end - 1 if end > start and buffer[end - 1] == 13 else end # Without CR
+
+                if stop - start > self.MAX_LINE:
+                    stop = start + self.MAX_LINE
+
+                lines.append(bytes(view[start:stop]))
+                start = end + 1
+
+        del buffer[:start]
+
+        if len(buffer) > self.MAX_LINE: # No line ending within the limit
+            if not self.discarding:
+                lines.append(bytes(buffer[:self.MAX_LINE]))
+                self.discarding = True
+
+            buffer.clear()
+
+        return lines
+
+
+# asyncio protocol for one client connection. Holds no thread or stack, only the Client object.
+class ClientProtocol(asyncio.Protocol):
+
+    __slots__ = ('server', 'client', 'closed', 'framer', 'pending', 'resumeHandle', 'output', 'session')
+
+    # client and output are given for a connection taken over by a hot restart, with the output the old process hadn't written yet.
+    # session is the TLS session of a connection on one of the TLS_LISTENERS.
+    def __init__(self, server, client=None, output=b'', session=None):
+        self.server = server
+        self.client = client
+        self.closed = False
+        self.pending = collections.deque() # Lines not handled yet, held back while the client is throttled
+        self.resumeHandle = None # Timer handling the pending lines once the client has refilled its flood tokens
+        self.output = output
+        self.session = session
+
+    def connection_made(self, transport):
+
+        if self.client is not None: # Carries on from where the old process stopped
+            self.client.socket = TransportSocket(transport, self.server)
+            (self.framer, self.pending) = self.server.connections[self.client]
+
+            if self.output:
+                self.client.socket.sendall(self.output)
+                self.output = b''
+
+            if self.pending:
+                self.resumeHandle = asyncio.get_running_loop().call_soon(self.handlePending)
+
+            return
+
+        addr = transport.get_extra_info('peername')
+        log.info('Connected by %s', addr)
+        self.server.metrics.accepted += 1
+        conn = TransportSocket(transport, self.server) if self.session is None else TlsTransportSocket(transport, self.server, self.session)
+        self.client = Client('', '', '', conn, addr)
+        self.framer = LineFramer() # Keeps partial lines between reads
+        self.server.setClientSocketOptions(transport.get_extra_info('socket'))
+        self.server.connections[self.client] = (self.framer, self.pending)
+
+        if self.server.stopping: # Accepted just before stop()
+            self.server.dropClient(self.client, 'Server shutting down')
+            return
+
+        self.server.timers.schedule(self.client, self.server.REGISTRATION_TIMEOUT, self.server.TIMER_TICK)
+
+    def data_received(self, data):
+
+        if self.closed:
+            return
+
+        self.server.metrics.bytesIn += len(data)
+        self.server.startLoopBatch()
+
+        if self.session is not None:
+            data = self.receiveTls(data)
+
+        self.pending.extend(self.framer.feed(data))
+
+        if self.resumeHandle is None:
+            self.handlePending()
+        elif self.server.checkRecvQueue(self.client, self.pending):
+            self.closed = True
+
+    # Returns the plain text received. Until the handshake is done the input goes to the handshake instead.
+    def receiveTls(self, data):
+
+        session = self.session
+        session.received += data
+
+        if session.busy: # Picked up once the running handshake step is done
+            return b''
+
+        if not session.established:
+            self.continueHandshake()
+            return b''
+
+        data = bytes(session.received)
+        session.received.clear()
+
+        try:
+            return session.decrypt(data)
+        except ssl.SSLError as e:
+            log.info('TLS error from %s: %s', self.client.getClientAddress(), e)
+            self.client.getClientSocket()[0].transport.abort()
+            return b''
+
+    # Runs the next handshake step on the server's handshake threads, so the key exchange never holds up the event loop
+    def continueHandshake(self):
+
+        session = self.session
+        data = bytes(session.received)
+        session.received.clear()
+        session.busy = True
+        future = asyncio.get_running_loop().run_in_executor(self.server.handshakePool, session.handshake, data)
+        future.add_done_callback(self.handshakeStepDone)
+
+    def handshakeStepDone(self, future):
+
+        self.session.busy = False
+        transport = self.client.getClientSocket()[0].transport
+
+        try:
+            (output, done) = future.result()
+        except OSError as e: # ssl.SSLError too
+            self.server.handshakeDone(self.client, self.session, e)
+            transport.abort()
+            return
+
+        if self.closed or transport.is_closing():
+            return
+
+        transport.write(output)
+
+        if done:
+            self.server.handshakeDone(self.client, self.session)
+            self.data_received(b'') # Anything sent right after the handshake
+        elif self.session.received:
+            self.continueHandshake()
+
+    def handlePending(self):
+
+        self.resumeHandle = None
+
+        if self.closed:
+            return
+
+        delay = self.server.handleLines(self.client, self.pending)
+
+        if delay is None or (delay > 0 and self.server.checkRecvQueue(self.client, self.pending)):
+            self.closed = True
+        elif delay > 0:
+            self.resumeHandle = asyncio.get_running_loop().call_later(delay, self.handlePending)
+
+    def pause_writing(self):
+        self.client.getClientSocket()[0].pauseWriting()
+
+    def resume_writing(self):
+        self.client.getClientSocket()[0].resumeWriting()
+
+    def connection_lost(self, exc):
+
+        self.server.connections.pop(self.client, None)
+        self.server.timers.remove(self.client)
+
+        if self.resumeHandle is not None:
+            self.resumeHandle.cancel()
+
+        if not self.closed:
+            self.closed = True
+            self.server.connectionLost(self.client)
+
+# Numeric replies, code -> (name, default text). Built once at import and read only afterwards.
+REPLIES = types.MappingProxyType({
+    '001': ('RPL_WELCOME', 'Welcome to the Internet Relay Network'),
+    '212': ('RPL_STATSCOMMANDS', ''),
+    '219': ('RPL_ENDOFSTATS', 'End of STATS report'),
+    '242': ('RPL_STATSUPTIME', ''),
+    '249': ('RPL_STATSDEBUG', ''),
+    '303': ('RPL_ISON', ''),
+    '311': ('RPL_WHOISUSER', ''),
+    '312': ('RPL_WHOISSERVER', 'IRC server'),
+    '318': ('RPL_ENDOFWHOIS', 'End of WHOIS list'),
+    '319': ('RPL_WHOISCHANNELS', ''),
+    '315': ('RPL_ENDOFWHO', 'End of WHO list'),
+    '352': ('RPL_WHOREPLY', ''),
+    '353': ('RPL_NAMREPLY', ''),
+    '322': ('RPL_LIST', ''),
+    '323': ('RPL_LISTEND', 'End of LIST'),
+    '366': ('RPL_ENDOFNAMES', 'End of NAMES list'),
+    '401': ('ERR_NOSUCHNICK', 'No such nick/channel'),
+    '403': ('ERR_NOSUCHCHANNEL', 'No such channel'),
+    '404': ('ERR_CANNOTSENDTOCHAN', 'Cannot send to channel'),
+    '405': ('ERR_TOOMANYCHANNELS', 'You have joined too many channels'),
+    '407': ('ERR_TOOMANYTARGETS', 'Too many recipients. No message delivered'),
+    '411': ('ERR_NORECIPIENT', 'No recipient given'),
+    '412': ('ERR_NOTEXTTOSEND', 'No text to send'),
+    '421': ('ERR_UNKNOWNCOMMAND', 'Unknown command'),
+    '431': ('ERR_NONICKNAMEGIVEN', 'No nickname given'),
+    '432': ('ERR_ERRONEUSNICKNAME', 'Erroneous nickname'),
+    '433': ('ERR_NICKNAMEINUSE', 'Nickname is already in use'),
+    '441': ('ERR_USERNOTINCHANNEL', "They aren't on that channel"),
+    '442': ('ERR_NOTONCHANNEL', "You're not on that channel"),
+    '451': ('ERR_NOTREGISTERED', 'You have not registered'),
+    '461': ('ERR_NEEDMOREPARAMS', 'Not enough parameters'),
+    '462': ('ERR_ALREADYREGISTRED', 'Unauthorized command (already registered)'),
+    '475': ('ERR_BADCHANNELKEY', 'Cannot join channel (+k)'),
+})
+
+# ErrorCode class handles error codes that are sent to the client
+class ReplyCode:
+
+    __slots__ = ('errorID', 'params')
+
+    # Constructor, params are the middle parameters after the client's nick
+    def __init__(self, id, *params):
+        self.errorID = id
+        self.params = params
+
+    # returns the reply name, e.g. ERR_NOSUCHNICK
+    def getMessage(self):
+        return REPLIES[self.errorID][0]
+
+    def getText(self):
+        return REPLIES[self.errorID][1]
+
+    # Renders the line for client using the server's pre-encoded ':server NNN ' prefix
+    def render(self, server, client, text=None):
+
+        line = client.getNickname() or '*' # Not chosen yet
+
+        for param in self.params:
+            line += ' ' + param
+
+        return server.numerics[self.errorID] + (line + ' :' + (text or self.getText()) + '\r\n').encode()
+
+# Channel class holds information about the channels on a server
+class Channel:
+
+    __slots__ = ('channelName', 'key', 'members', 'snapshot', 'closed', 'lock', 'history')
+
+    # Constructor
+    def __init__(self, name, key=None):
+        self.channelName = name
+        self.key = key # Needed to join, set by the JOIN that created the channel
+        self.members = {} # Client -> None, an insertion ordered set of clients connected to channel
+        self.snapshot = () # Immutable copy of the members, None after a change until it is next needed
+        self.closed = False # Set when the last member leaves, the channel can't be joined any more
+        self.lock = threading.Lock() # Held only while changing the members or copying them
+        self.history = None # Recent messages, created by Server.getHistory() when the first one is sent
+
+    def getChannelName(self):
+        return self.channelName
+
+    def getKey(self):
+        return self.key
+
+    # False if the channel was closed in the meantime
+    def addClient(self, client):
+
+        with self.lock:
+
+            if self.closed:
+                return False
+
+            self.members[client] = None
+            self.snapshot = None
+
+        log.debug('Added %s to %s', client.getNickname(), self.channelName)
+        return True
+
+    # True when this was the last member, the channel is then closed
+    def removeClient(self, client):
+
+        with self.lock:
+
+            if client not in self.members:
+                return False
+
+            del self.members[client]
+            self.snapshot = None
+            self.closed = not self.members
+
+        log.debug('Removed %s from %s', client.getNickname(), self.channelName)
+        return self.closed
+
+    def hasClient(self, client):
+        return client in self.members
+
+    # Snapshot of the members in join order. Copied once per membership change and shared by every broadcast until the next one,
+    # so senders iterate it without holding the lock while clients join and leave.
+    def getClientList(self):
+
+        snapshot = self.snapshot
+
+        if snapshot is None:
+            with self.lock:
+                snapshot = self.snapshot = tuple(self.members)
+
+        return snapshot
+
+    def getMemberCount(self):
+        return len(self.members)
+
+    def isEmpty(self): # Check if channel has no users
+        if len(self.members) == 0:
+            return True
+        else:
+            return False
+
+
+# Channels filed by member count for LIST >N and <N. The channels of each count are in an insertion ordered dict and the
+# counts that have channels are kept sorted, so a range of sizes is found without looking at the channels outside it.
+class MemberCounts:
+
+    def __init__(self):
+        self.counts = {} # Channel -> member count it is filed under
+        self.buckets = {} # Member count -> {Channel: None}
+        self.sizes = [] # Member counts that have channels, ascending
+        self.lock = threading.Lock()
+
+    # Files channel under its current member count, or takes it out once it is empty. Called after every membership change,
+    # so the last call after changes from several threads sees the final count.
+    def update(self, channel):
+
+        with self.lock:
+
+            count = channel.getMemberCount()
+            old = self.counts.get(channel, 0)
+
+            if count == old:
+                return
+
+            if old:
+                bucket = self.buckets[old]
+                del bucket[channel]
+
+                if not bucket:
+                    del self.buckets[old]
+                    del self.sizes[bisect.bisect_left(self.sizes, old)]
+
+            if not count:
+                del self.counts[channel]
+                return
+
+            bucket = self.buckets.get(count)
+
+            if bucket is None:
+                bucket = self.buckets[count] = {}
+                bisect.insort(self.sizes, count)
+
+            bucket[channel] = None
+            self.counts[channel] = count
+
+    # (channel, member count) for the channels with low to high members, largest first. The channels of a count are copied
+    # when it is reached, one whose count has changed by the time it comes up is skipped there and given under the new count
+    # if that is still to come.
+    def getRange(self, low, high):
+
+        while True:
+
+            with self.lock:
+                i = bisect.bisect_right(self.sizes, high)
+
+                if not i or self.sizes[i - 1] < low:
+                    return
+
+                size = self.sizes[i - 1]
+                channels = tuple(self.buckets[size])
+
+            for channel in channels:
+                if channel.getMemberCount() == size:
+                    yield (channel, size)
+
+            high = size - 1
+
+
+# Recent messages of a channel, kept as the encoded lines its members were sent so replaying them is only writing them out
+# again. A ring of at most maxLines lines and maxBytes bytes with the time of each line. Lines pushed out of the ring go on
+# to the spill files if there are any.
+class History:
+
+    __slots__ = ('lines', 'times', 'first', 'count', 'size', 'maxBytes', 'spill', 'lock')
+
+    def __init__(self, maxLines, maxBytes, spill=None):
+        self.lines = [None] * maxLines
+        self.times = array.array('d', bytes(8 * maxLines)) # Unix time of each line, 8 bytes instead of a float object
+        self.first = 0 # Index of the oldest line
+        self.count = 0
+        self.size = 0 # Bytes in the ring
+        self.maxBytes = maxBytes
+        self.spill = spill
+        self.lock = threading.Lock()
+
+    def append(self, data, when):
+
+        with self.lock:
+
+            while self.count and (self.count == len(self.lines) or self.size + len(data) > self.maxBytes):
+                self.dropOldest()
+
+            index = (self.first + self.count) % len(self.lines)
+            self.lines[index] = data
+            self.times[index] = when
+            self.count += 1
+            self.size += len(data)
+
+    # Called with the lock held
+    def dropOldest(self):
+
+        data = self.lines[self.first]
+
+        if self.spill is not None:
+            self.spill.append(data, self.times[self.first])
+
+        self.lines[self.first] = None
+        self.first = (self.first + 1) % len(self.lines)
+        self.count -= 1
+        self.size -= len(data)
+
+    # (time, line) for every line in the ring, oldest first
+    def getEntries(self):
+
+        with self.lock:
+            return [(self.times[i], self.lines[i]) for i in ((self.first + i) % len(self.lines) for i in range(self.count))]
+
+    # Up to limit lines sent after 'after' and before 'before' (Unix times, None for no bound), oldest first. These are the
+    # latest ones in the range, or the earliest ones if latest is False.
+    def getLines(self, limit, before=None, after=None, latest=True):
+
+        with self.lock:
+
+            order = [(self.first + i) % len(self.lines) for i in range(self.count)]
+            times = [self.times[i] for i in order]
+            start = 0 if after is None else bisect.bisect_right(times, after)
+            end = len(order) if before is None else bisect.bisect_left(times, before)
+
+            if latest:
+                start = max(start, end - limit)
+            else:
+                end = min(end, start + limit)
+
+            lines = [self.lines[order[i]] for i in range(start, end)]
+
+            # Older lines are in the spill files, wanted when the range goes back past the ring
+            if self.spill is not None and start == 0 and len(lines) < limit and (after is None or not times or after < times[0]):
+                older = self.spill.getLines(limit - len(lines) if latest else limit, times[0] if times else before, after, latest)
+                lines = older + lines if latest else (older + lines)[:limit]
+
+        return lines
+
+    # Moves the whole ring to the spill files, so the lines outlive the channel and the process
+    def close(self):
+
+        with self.lock:
+
+            if self.spill is not None:
+                while self.count:
+                    self.dropOldest()
+
+                self.spill.close()
+                self.spill = None # A message still on its way to the channel stays in memory
+
+
+# Append-only files a channel's history spills to, segments of at most segmentBytes bytes and maxSegments segments per channel.
+# A record is the line followed by its time and length, so the newest records can be read backwards from the end of the
+# files through mmap without an index.
+class HistorySpill:
+
+    __slots__ = ('directory', 'prefix', 'segments', 'segmentBytes', 'maxSegments', 'fd', 'written')
+
+    RECORD = struct.Struct('<dI') # Time, length
+
+    def __init__(self, directory, channelName, segmentBytes, maxSegments):
+        self.directory = directory
+        self.prefix = channelName.translate(RFC1459_CASEMAP).encode().hex() + '.' # Channel names can hold any character but a few
+        self.segments = sorted(int(name.split('.')[1]) for name in os.listdir(directory) if name.startswith(self.prefix)) or [0]
+        self.segmentBytes = segmentBytes
+        self.maxSegments = maxSegments
+        self.fd = os.open(self.getPath(self.segments[-1]), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.written = os.fstat(self.fd).st_size
+
+    def getPath(self, segment):
+        return os.path.join(self.directory, self.prefix + str(segment) + '.log')
+
+    def append(self, data, when):
+
+        if self.written and self.written + len(data) + self.RECORD.size > self.segmentBytes:
+            self.rotate()
+
+        record = data + self.RECORD.pack(when, len(data))
+        os.write(self.fd, record)
+        self.written += len(record)
+
+    # Starts a new segment and deletes the oldest ones over maxSegments
+    def rotate(self):
+
+        os.close(self.fd)
+        self.segments.append(self.segments[-1] + 1)
+
+        while len(self.segments) > self.maxSegments:
+            try:
+                os.remove(self.getPath(self.segments.pop(0)))
+            except OSError:
+                pass
+
+        self.fd = os.open(self.getPath(self.segments[-1]), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.written = 0
+
+    # (time, line) for every record, newest first
+    def readBackwards(self):
+
+        for segment in reversed(self.segments):
+
+            try:
+                with open(self.getPath(segment), 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size
+                    view = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size else None
+            except OSError:
+                continue
+
+            if view is None:
+                continue
+
+            try:
+                end = size
+
+                while end >= self.RECORD.size:
+                    (when, length) = self.RECORD.unpack_from(view, end - self.RECORD.size)
+                    start = end - self.RECORD.size - length
+
+                    if start < 0: # Cut short by a crash
+                        break
+
+                    yield (when, view[start:end - self.RECORD.size])
+                    end = start
+            finally:
+                view.close()
+
+    # Same as History.getLines() for the spilled lines
+    def getLines(self, limit, before=None, after=None, latest=True):
+
+        found = []
+
+        for (when, data) in self.readBackwards():
+
+            if before is not None and when >= before:
+                continue
+
+            if after is not None and when <= after:
+                break
+
+            found.append(data)
+
+            if latest and len(found) == limit:
+                break
+
+        found.reverse()
+        return found[:limit]
+
+    def close(self):
+        os.close(self.fd)
+
+# Command line entry point, settings come from --config, the shortcuts below and --set, in that order
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='IRC server')
+    parser.add_argument('mode', nargs='?', default='threaded', choices=('threaded', 'asyncio', 'workers'))
+    parser.add_argument('workers', nargs='?', type=int, help='worker processes in workers mode, one per core by default')
+    parser.add_argument('--name', default='Team5', help='server name')
+    parser.add_argument('--config', help='JSON file of settings, e.g. {"LISTENERS": ["[::]:6667", "0.0.0.0:6667"], "BACKLOG": 4096}')
+    parser.add_argument('--listen', action='append', metavar='HOST:PORT', help='address to listen on, may be given several times')
+    parser.add_argument('--backlog', type=int)
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='any other setting, the value is read as JSON when it parses')
+    parser.add_argument('--takeover', action='store_true', help='take the listeners and clients over from the server running with the same RESTART_PATH')
+    args = parser.parse_args(argv)
+
+    server = Server(args.name, args.mode)
+
+    try:
+        if args.config:
+            with open(args.config) as f:
+                server.configure(json.load(f))
+
+        if args.listen:
+            server.configure({'LISTENERS': args.listen})
+
+        if args.backlog:
+            server.configure({'BACKLOG': args.backlog})
+
+        for setting in args.set:
+            (name, sep, value) = setting.partition('=')
+
+            try:
+                value = json.loads(value)
+            except ValueError: # Plain string
+                pass
+
+            server.configure({name: value})
+
+        server.getListenAddresses() # Checks the addresses
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    if args.takeover and not server.RESTART_PATH:
+        parser.error('--takeover needs RESTART_PATH')
+
+    if server.RESTART_PATH and hasattr(signal, 'SIGUSR2'): # Starts this same command as a new process, which takes over from this one
+        command = [sys.executable] + sys.argv + ([] if args.takeover else ['--takeover'])
+        signal.signal(signal.SIGUSR2, lambda signum, frame: subprocess.Popen(command))
+
+    if server.TLS_LISTENERS and hasattr(signal, 'SIGHUP'): # Loads a renewed certificate
+        signal.signal(signal.SIGHUP, lambda signum, frame: server.reloadCertificates())
+
+    server.serve(args.workers, args.takeover)
+
+
+if __name__ == '__main__':
+    main()